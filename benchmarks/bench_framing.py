@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+"""WebSocket framing microbenchmarks: the per-chunk and per-message hot path.
+
+Times the server's own functions, imported from server/server.py:
+frame encoding in each payload length class (7-bit, 16-bit and 64-bit),
+decoding masked client frames of various sizes, JSON control messages,
+and the whole read -> frame -> send loop for one audio chunk in each of
+the ways stream_song() can send it. The send loops write to a local
+socket pair (or loopback TCP with --tcp) drained by a background thread,
+so they include the system calls but no network.
+
+Each case is calibrated to run for --min-time seconds and repeated
+--repeat times, with the garbage collector off as timeit does; the
+reported ns/op and MB/s are from the median run, with the best run
+alongside. Compare runs on the same machine before and after a change.
+
+    python benchmarks/bench_framing.py
+    python benchmarks/bench_framing.py --filter chunk --repeat 9
+    python benchmarks/bench_framing.py --json > framing.json
+"""
+import argparse
+import contextlib
+import gc
+import json
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "server")
+sys.path.insert(0, SERVER_DIR)
+
+with contextlib.redirect_stdout(sys.stderr):
+    # Importing the server may print about its user configuration; keep stdout for the results
+    import server as bytebeats
+from multiplex import STREAM_ID
+
+# Payload sizes for the encode cases: one per frame length class, plus a whole audio chunk
+ENCODE_SIZES = [64, 1024, bytebeats.CHUNK_SIZE, 256 * 1024]
+DECODE_SIZES = [16, 125, 1024, 16384, 65536, 256 * 1024]
+TRACK_SIZE = 4 * 1024 * 1024  # Test file for the per-chunk loops; small enough to stay in the page cache
+
+def masked_frame(payload, opcode=bytebeats.OPCODE_TEXT):
+    """A client frame, masked as RFC 6455 requires"""
+    mask = os.urandom(4)
+    length = len(payload)
+    if length < 126:
+        header = bytes((0x80 | opcode, 0x80 | length))
+    elif length < 65536:
+        header = bytes((0x80 | opcode, 0x80 | 126)) + length.to_bytes(2, "big")
+    else:
+        header = bytes((0x80 | opcode, 0x80 | 127)) + length.to_bytes(8, "big")
+    return header + mask + bytebeats.unmask_payload(payload, mask)
+
+def connected_pair(tcp):
+    if not tcp:
+        return socket.socketpair()
+    with socket.socket() as listener:
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        client = socket.create_connection(listener.getsockname())
+        server, _ = listener.accept()
+    server.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return server, client
+
+class Drain:
+    """Reads and discards everything sent to the other end of a socket pair"""
+    def __init__(self, tcp):
+        self.conn, self._peer = connected_pair(tcp)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        buffer = bytearray(1024 * 1024)
+        try:
+            while self._peer.recv_into(buffer):
+                pass
+        except OSError:
+            pass
+
+    def close(self):
+        self.conn.close()
+        self._thread.join()
+        self._peer.close()
+
+def measure(fn, min_time, repeat):
+    """Return the ns/op of each of repeat runs of fn, each calibrated to take at least min_time"""
+    number = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time / 10:
+            break
+        number *= 10
+    number = max(1, int(number * min_time / max(elapsed, 1e-9)))
+    runs = []
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            started = time.perf_counter()
+            for _ in range(number):
+                fn()
+            runs.append((time.perf_counter() - started) / number * 1e9)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    return runs
+
+def encode_cases():
+    for size in ENCODE_SIZES:
+        payload = os.urandom(size)
+        yield f"encode/frame/{size}", size, lambda payload=payload: bytebeats.encode_websocket_frame(payload, bytebeats.OPCODE_BINARY)
+    for size in ENCODE_SIZES[:3]:
+        yield f"encode/header/{size}", 0, lambda size=size: bytebeats.websocket_frame_header(size, bytebeats.OPCODE_BINARY)
+    chunk = os.urandom(bytebeats.CHUNK_SIZE)
+    prefix = STREAM_ID.pack(1)
+    yield "encode/audio-chunk", len(chunk), lambda: bytebeats.encode_audio_chunk(chunk)
+    yield "encode/audio-chunk-mux", len(chunk), lambda: bytebeats.encode_audio_chunk(chunk, prefix)
+
+def decode_cases():
+    for size in DECODE_SIZES:
+        frame = masked_frame(os.urandom(size), bytebeats.OPCODE_BINARY)
+        reader = bytebeats.WebSocketFrameReader()
+        def decode(frame=frame, reader=reader):
+            reader.feed(frame)
+            for _ in reader.messages():
+                pass
+        yield f"decode/reader/{size}", size, decode
+    for size in DECODE_SIZES[:4]:
+        payload, mask = os.urandom(size), os.urandom(4)
+        yield f"decode/unmask/{size}", size, lambda payload=payload, mask=mask: bytebeats.unmask_payload(payload, mask)
+    text = masked_frame(json.dumps({"type": "PLAY_SONG", "name": "Some Artist - Some Song.mp3"}).encode())
+    yield "decode/legacy-frame", len(text), lambda: bytebeats.decode_websocket_frame(text)
+
+def control_cases(drain):
+    metadata = {
+        "type": "SONG_METADATA", "name": "Some Artist - Some Song.mp3", "size": 3824244,
+        "etag": "3a5a74-17f1c2d3e4f5a6b7", "quality": "original", "duration": 239.02, "bitrate": 128000,
+        "title": "Some Song", "artist": "Some Artist", "replaygain": -6.5, "start_offset": 0, "start_time": 0.0,
+    }
+    ended = {"type": "SONG_ENDED"}
+    yield "control/json-metadata", 0, lambda: bytebeats.encode_websocket_frame(json.dumps(metadata))
+    yield "control/json-ended", 0, lambda: bytebeats.encode_websocket_frame(json.dumps(ended))
+    yield "control/send-metadata", 0, lambda: bytebeats.send_websocket_message(drain.conn, metadata)
+    yield "control/send-ended", 0, lambda: bytebeats.send_websocket_message(drain.conn, ended)
+
+def chunk_cases(drain, track_path):
+    """One step of each stream_song() send path: the next chunk of the track, framed and sent"""
+    chunk_size = bytebeats.CHUNK_SIZE
+    chunks = TRACK_SIZE // chunk_size
+    f = open(track_path, "rb")  # Left open for the process's lifetime
+    conn = drain.conn
+    prefix = STREAM_ID.pack(1)
+    position = [0]
+
+    def next_offset():
+        offset = position[0] * chunk_size
+        position[0] = (position[0] + 1) % chunks
+        return offset
+
+    def naive():
+        # The copying path the others replaced: read, join header and payload, sendall
+        f.seek(next_offset())
+        conn.sendall(bytebeats.encode_websocket_frame(f.read(chunk_size), bytebeats.OPCODE_BINARY))
+    yield "chunk/read-join-sendall", chunk_size, naive
+
+    frame_buffer = bytebeats.AudioFrameBuffer(chunk_size)
+    def buffered(prefix=b""):
+        frame, _ = frame_buffer.read_frame(f, next_offset(), chunk_size, prefix)
+        bytebeats.send_all(conn, (frame,))
+    yield "chunk/frame-buffer", chunk_size, buffered
+    yield "chunk/frame-buffer-mux", chunk_size, lambda: buffered(prefix)
+
+    f.seek(0)
+    entries = [bytebeats.encode_audio_chunk(f.read(chunk_size)) for _ in range(chunks)]
+    def cached(skip=0, prefix=b""):
+        buffers, _ = bytebeats.audio_frame_from_cache(entries[next_offset() // chunk_size], skip, prefix)
+        bytebeats.send_all(conn, buffers)
+    yield "chunk/cache", chunk_size, cached
+    yield "chunk/cache-mux", chunk_size, lambda: cached(0, prefix)
+
+    if hasattr(os, "sendfile"):
+        yield "chunk/sendfile", chunk_size, lambda: bytebeats.send_file_chunk(conn, f, next_offset(), chunk_size)
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmark the server's WebSocket framing")
+    parser.add_argument("--filter", default="", help="Only run cases whose name contains this")
+    parser.add_argument("--min-time", type=float, default=0.2, help="Seconds per timed run")
+    parser.add_argument("--repeat", type=int, default=5, help="Timed runs per case")
+    parser.add_argument("--tcp", action="store_true", help="Send over loopback TCP instead of a socket pair")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    args = parser.parse_args()
+
+    drain = Drain(args.tcp)
+    with tempfile.NamedTemporaryFile(suffix=".mp3") as track:
+        track.write(os.urandom(TRACK_SIZE))
+        track.flush()
+        cases = [*encode_cases(), *decode_cases(), *control_cases(drain), *chunk_cases(drain, track.name)]
+        results = []
+        if not args.json:
+            print(f"{'case':<28}{'ns/op':>12}{'best':>12}{'spread':>9}{'MB/s':>12}")
+        for name, size, fn in cases:
+            if args.filter not in name:
+                continue
+            runs = measure(fn, args.min_time, args.repeat)
+            median = statistics.median(runs)
+            results.append({
+                "case": name,
+                "payload_bytes": size,
+                "ns_per_op": round(median, 1),
+                "best_ns_per_op": round(min(runs), 1),
+                "spread_percent": round((max(runs) - min(runs)) / median * 100, 1),
+                "mb_per_s": round(size / median * 1e9 / (1024 * 1024), 1) if size else None,
+            })
+            if not args.json:
+                r = results[-1]
+                print(f"{name:<28}{r['ns_per_op']:>12,.1f}{r['best_ns_per_op']:>12,.1f}"
+                      f"{r['spread_percent']:>8}%{r['mb_per_s'] or '':>12}")
+    drain.close()
+
+    if args.json:
+        print(json.dumps({
+            "python": sys.version.split()[0],
+            "chunk_size": bytebeats.CHUNK_SIZE,
+            "socket": "tcp" if args.tcp else "socketpair",
+            "results": results,
+        }, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+"""TLS handshake benchmark: RSA vs ECDSA certificates, full vs resumed handshakes.
+
+By default this starts a throwaway TLS listener on localhost for each
+certificate type, using the server's own create_ssl_context() with freshly
+generated certificates, and reconnects to it sequentially. With --connect it
+measures a running ByteBeats server instead.
+
+Reports handshakes per second and reconnect latency (TCP connect + TLS
+handshake). Client and server share this process, so absolute numbers
+include the client's work too; compare the rows with each other.
+
+    python benchmarks/bench_tls.py
+    python benchmarks/bench_tls.py --count 500 --json
+    python benchmarks/bench_tls.py --connect 192.168.1.20:8443
+"""
+import argparse
+import json
+import os
+import socket
+import ssl
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "server")
+sys.path.insert(0, SERVER_DIR)
+
+def start_local_server(cert_type, cert_dir):
+    """Serve TLS on an ephemeral localhost port with the server's SSL settings"""
+    import server as bytebeats
+    from generate_cert import cert_paths
+
+    bytebeats.CERT_DIR = cert_dir
+    bytebeats.CERT_TYPE = cert_type
+    bytebeats.KEY_FILE, bytebeats.CERT_FILE = cert_paths(cert_dir, cert_type)
+    context = bytebeats.create_ssl_context()
+    if context is None:
+        sys.exit("Could not create an SSL context (is pyOpenSSL installed?)")
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(128)
+
+    def handle(conn):
+        # Tickets and the data byte are separate small writes; don't let Nagle hold them back
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            with context.wrap_socket(conn, server_side=True) as tls:
+                # One byte of application data so the client also receives its session tickets
+                tls.sendall(b"x")
+                tls.recv(1)
+        except (ssl.SSLError, OSError):
+            pass
+
+    def accept():
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=handle, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=accept, daemon=True).start()
+    return listener, ("127.0.0.1", listener.getsockname()[1])
+
+def connect_once(client_context, address, session=None):
+    """Do one TCP connect + TLS handshake; returns (seconds, resumed, session for the next one)"""
+    started = time.perf_counter()
+    sock = socket.create_connection(address)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    tls = client_context.wrap_socket(sock, server_hostname="localhost", session=session)
+    elapsed = time.perf_counter() - started
+    try:
+        # TLS 1.3 tickets arrive after the handshake; read a reply so they are processed.
+        # A ByteBeats server answers this plain request with a 400 and closes.
+        tls.settimeout(2.0)
+        tls.sendall(b"GET / HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        tls.recv(1)
+    except (socket.timeout, ssl.SSLError, OSError):
+        pass
+    resumed = tls.session_reused
+    next_session = tls.session
+    tls.close()
+    return elapsed, resumed, next_session
+
+def run(address, count, resume):
+    client_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    client_context.check_hostname = False
+    client_context.verify_mode = ssl.CERT_NONE
+
+    # Warm up (and get a first session to resume)
+    _, _, session = connect_once(client_context, address)
+    latencies = []
+    resumed = 0
+    started = time.perf_counter()
+    for _ in range(count):
+        elapsed, reused, next_session = connect_once(client_context, address, session if resume else None)
+        latencies.append(elapsed)
+        resumed += reused
+        if resume and next_session is not None:
+            session = next_session
+    total = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "handshake": "resumed" if resume else "full",
+        "count": count,
+        "per_second": round(count / total, 1),
+        "median_ms": round(statistics.median(latencies) * 1000, 3),
+        "p95_ms": round(latencies[int(len(latencies) * 0.95) - 1] * 1000, 3),
+        "resumed": resumed,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark TLS handshakes against the ByteBeats SSL setup")
+    parser.add_argument("--count", type=int, default=200, help="Handshakes per scenario")
+    parser.add_argument("--cert-types", default="rsa,ecdsa", help="Certificate types to compare (local mode)")
+    parser.add_argument("--connect", metavar="HOST:PORT", help="Benchmark a running server instead")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    args = parser.parse_args()
+
+    results = []
+    if args.connect:
+        host, _, port = args.connect.rpartition(":")
+        for resume in (False, True):
+            results.append(dict(run((host, int(port)), args.count, resume), cert=args.connect))
+    else:
+        with tempfile.TemporaryDirectory() as cert_dir:
+            for cert_type in args.cert_types.split(","):
+                listener, address = start_local_server(cert_type, cert_dir)
+                for resume in (False, True):
+                    results.append(dict(run(address, args.count, resume), cert=cert_type))
+                listener.close()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'cert':<22}{'handshake':<11}{'per sec':>9}{'median ms':>11}{'p95 ms':>9}{'resumed':>9}")
+    for r in results:
+        print(f"{r['cert']:<22}{r['handshake']:<11}{r['per_second']:>9}{r['median_ms']:>11}"
+              f"{r['p95_ms']:>9}{r['resumed']:>6}/{r['count']}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,441 @@
+#!/usr/bin/env python
+"""Load test: many simulated listeners streaming from a real server over loopback.
+
+Starts server/server.py (once per engine and TLS setting) on a free port,
+serving a synthetic library of generated MP3s of several sizes, and drives
+N concurrent clients through the real protocol: WebSocket handshake,
+AUTH_REQUIRED, login, PLAY_SONG and every chunk up to SONG_ENDED. Each
+scenario is preceded by an unmeasured warm-up that plays every song once.
+
+Reports, per scenario, as JSON on stdout: connect, login and
+time-to-first-byte latencies (p50/p99), per-stream and aggregate
+throughput, and the server's CPU time and RSS (read from /proc, so
+Linux only). A summary table goes to stderr. With --baseline the run is
+compared with an earlier --output file; the exit status is 1 if any
+metric got worse by more than --threshold percent.
+
+The clients run in this machine's Python too (spread over
+--client-processes event loops), so with thousands of TLS clients they
+can be the bottleneck; watch the server CPU column.
+
+    python benchmarks/load_test.py
+    python benchmarks/load_test.py --clients 1,100,2000 --tls off --mode asyncio --client-processes 4
+    python benchmarks/load_test.py --output baseline.json
+    python benchmarks/load_test.py --baseline baseline.json
+"""
+import argparse
+import asyncio
+import base64
+import json
+import multiprocessing
+import os
+import platform
+import socket
+import ssl
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER_SCRIPT = os.path.join(PROJECT_DIR, "server", "server.py")
+MUSIC_DIR = os.path.join(tempfile.gettempdir(), "bytebeats-load-test")
+
+# A silent MPEG-1 Layer III frame: 128 kbps, 44.1 kHz, so the server indexes it like any MP3
+FRAME_HEADER = bytes([0xFF, 0xFB, 0x90, 0x64])
+FRAME_SIZE = 144 * 128000 // 44100
+
+# Metrics compared against a baseline: (path in the scenario, True if higher is better)
+COMPARED_METRICS = [
+    ("aggregate_mb_per_s", True),
+    ("stream_mb_per_s.p50", True),
+    ("ttfb_ms.p50", False),
+    ("ttfb_ms.p99", False),
+    ("connect_ms.p99", False),
+    ("server.cpu_seconds", False),
+    ("server.rss_peak_mb", False),
+]
+
+def generate_library(music_dir, sizes_mb):
+    """Write one synthetic MP3 per size (reused by later runs); returns the song names"""
+    os.makedirs(music_dir, exist_ok=True)
+    frame = FRAME_HEADER + bytes(FRAME_SIZE - len(FRAME_HEADER))
+    songs = []
+    for size_mb in sizes_mb:
+        name = f"load-test-{size_mb:g}MB.mp3"
+        path = os.path.join(music_dir, name)
+        frames = max(1, int(size_mb * 1024 * 1024) // FRAME_SIZE)
+        if not os.path.exists(path) or os.path.getsize(path) != frames * FRAME_SIZE:
+            with open(path, "wb") as f:
+                for start in range(0, frames, 1000):
+                    f.write(frame * min(1000, frames - start))
+        songs.append(name)
+    return songs
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_server(args, mode, tls, port, log_path):
+    """Start server/server.py and wait until it accepts connections"""
+    command = [sys.executable, SERVER_SCRIPT, "--mode", mode, "--port", str(port),
+               "--music-dir", args.music_dir, "--pacing-multiplier", str(args.pacing_multiplier),
+               "--workers", str(args.workers)]
+    if not tls:
+        command.append("--no-ssl")
+    log = open(log_path, "w")
+    process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, cwd=PROJECT_DIR)
+    log.close()
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            sys.exit(f"Server exited with status {process.returncode}; see {log_path}")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    sys.exit(f"Server didn't start listening within 60s; see {log_path}")
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+class ServerMonitor:
+    """Samples CPU time and RSS of the server process and its workers from /proc"""
+    def __init__(self, pid, interval=0.1):
+        self.pid = pid
+        self.interval = interval
+        self.rss_peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self._ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+    def _pids(self):
+        pids = [self.pid]
+        try:
+            for entry in os.listdir("/proc"):
+                if entry.isdigit():
+                    try:
+                        with open(f"/proc/{entry}/stat") as f:
+                            if int(f.read().rsplit(")", 1)[1].split()[1]) == self.pid:
+                                pids.append(int(entry))
+                    except (OSError, ValueError, IndexError):
+                        pass
+        except OSError:
+            pass
+        return pids
+
+    def sample(self):
+        """Return (CPU seconds, RSS bytes) of the server and its workers, or (None, None) without /proc"""
+        cpu = 0.0
+        rss = 0
+        for pid in self._pids():
+            try:
+                with open(f"/proc/{pid}/stat") as f:
+                    fields = f.read().rsplit(")", 1)[1].split()
+                cpu += (int(fields[11]) + int(fields[12])) / self._ticks
+                with open(f"/proc/{pid}/statm") as f:
+                    rss += int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+            except (OSError, ValueError, IndexError):
+                if pid == self.pid:
+                    return None, None
+        return cpu, rss
+
+    def start(self):
+        self.rss_peak = 0
+        self._stop.clear()
+        self.cpu_start = self.sample()[0]
+        def run():
+            while not self._stop.wait(self.interval):
+                rss = self.sample()[1]
+                if rss is not None:
+                    self.rss_peak = max(self.rss_peak, rss)
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+
+    def stop(self, wall_seconds):
+        self._stop.set()
+        self._thread.join()
+        cpu, rss = self.sample()
+        if cpu is None or self.cpu_start is None:
+            return {"cpu_seconds": None, "cpu_percent": None, "rss_peak_mb": None, "rss_end_mb": None}
+        cpu_seconds = cpu - self.cpu_start
+        return {
+            "cpu_seconds": round(cpu_seconds, 3),
+            "cpu_percent": round(cpu_seconds / wall_seconds * 100, 1) if wall_seconds else None,
+            "rss_peak_mb": round(max(self.rss_peak, rss) / (1024 * 1024), 1),
+            "rss_end_mb": round(rss / (1024 * 1024), 1),
+        }
+
+def text_frame(text):
+    """A masked client text frame"""
+    payload = text.encode()
+    mask = os.urandom(4)
+    length = len(payload)
+    if length < 126:
+        header = struct.pack("!BB", 0x81, 0x80 | length)
+    elif length < 65536:
+        header = struct.pack("!BBH", 0x81, 0x80 | 126, length)
+    else:
+        header = struct.pack("!BBQ", 0x81, 0x80 | 127, length)
+    masked = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+    return header + mask + masked
+
+async def read_message(reader):
+    """Return (opcode, payload) of the server's next frame; the server never masks or fragments"""
+    head = await reader.readexactly(2)
+    length = head[1] & 0x7F
+    if length == 126:
+        length = struct.unpack("!H", await reader.readexactly(2))[0]
+    elif length == 127:
+        length = struct.unpack("!Q", await reader.readexactly(8))[0]
+    return head[0] & 0x0F, await reader.readexactly(length)
+
+async def read_json(reader):
+    while True:
+        opcode, payload = await read_message(reader)
+        if opcode == 0x1:
+            return json.loads(payload)
+
+async def listen(port, tls, song, credentials):
+    """One listener: connect, log in, play a song to the end; returns its timings"""
+    context = None
+    if tls:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    started = time.monotonic()
+    reader, writer = await asyncio.open_connection("127.0.0.1", port, ssl=context)
+    try:
+        key = base64.b64encode(os.urandom(16)).decode()
+        writer.write((f"GET / HTTP/1.1\r\nHost: 127.0.0.1:{port}\r\nUpgrade: websocket\r\n"
+                      f"Connection: Upgrade\r\nSec-WebSocket-Key: {key}\r\n"
+                      "Sec-WebSocket-Version: 13\r\n\r\n").encode())
+        response = await reader.readuntil(b"\r\n\r\n")
+        if not response.startswith(b"HTTP/1.1 101"):
+            raise ConnectionError(response.split(b"\r\n", 1)[0].decode(errors="replace"))
+        greeting = await read_json(reader)
+        if greeting.get("type") == "BUSY":
+            raise ConnectionError(f"BUSY ({greeting.get('reason')})")
+        if greeting.get("type") != "AUTH_REQUIRED":
+            raise ConnectionError("Expected AUTH_REQUIRED")
+        connected = time.monotonic()
+
+        writer.write(text_frame(credentials))
+        reply = await read_json(reader)
+        if reply.get("type") != "AUTH_SUCCESS":
+            raise ConnectionError(f"Login failed: {reply.get('type')}")
+        logged_in = time.monotonic()
+
+        writer.write(text_frame(json.dumps({"type": "PLAY_SONG", "name": song})))
+        first_byte = None
+        received = 0
+        while True:
+            opcode, payload = await read_message(reader)
+            if opcode == 0x2:
+                if first_byte is None:
+                    first_byte = time.monotonic()
+                received += len(payload)
+            elif opcode == 0x1:
+                message = json.loads(payload)
+                message_type = message.get("type")
+                if message_type == "SONG_ENDED":
+                    break
+                if message_type in ("STREAM_ERROR", "SONG_NOT_FOUND"):
+                    raise ConnectionError(message_type)
+                if message_type == "BUSY":
+                    # Turned away by admission control; counted as an error rather than waited out
+                    raise ConnectionError(f"BUSY ({message.get('reason')})")
+            elif opcode == 0x8:
+                raise ConnectionError("Server closed the connection")
+        ended = time.monotonic()
+        return {
+            "connect": connected - started,
+            "auth": logged_in - connected,
+            "ttfb": (first_byte or ended) - logged_in,
+            "bytes": received,
+            "stream_seconds": ended - logged_in,
+            "throughput": received / (ended - first_byte) if first_byte and ended > first_byte else None,
+            "start": logged_in,
+            "end": ended,
+        }
+    finally:
+        writer.close()
+
+async def run_clients(port, tls, songs, indexes, count, ramp, timeout, credentials):
+    """Run the listeners with the given indexes, starting them evenly over ramp seconds"""
+    async def one(index):
+        await asyncio.sleep(ramp * index / max(1, count))
+        try:
+            return await asyncio.wait_for(listen(port, tls, songs[index % len(songs)], credentials), timeout)
+        except Exception as e:
+            return {"error": f"{type(e).__name__}: {e}"}
+    return await asyncio.gather(*(one(index) for index in indexes))
+
+def run_client_process(job):
+    return asyncio.run(run_clients(*job))
+
+def percentiles(values, scale=1.0, points=(50, 99)):
+    values = sorted(v * scale for v in values if v is not None)
+    if not values:
+        return {f"p{p}": None for p in points}
+    return {f"p{p}": round(values[min(len(values) - 1, int(len(values) * p / 100))], 3) for p in points}
+
+def run_scenario(args, port, tls, songs, clients, monitor):
+    processes = max(1, min(args.client_processes, clients))
+    jobs = [(port, tls, songs, list(range(i, clients, processes)), clients, args.ramp, args.timeout,
+             f"{args.username}:{args.password}") for i in range(processes)]
+    monitor.start()
+    started = time.monotonic()
+    if processes == 1:
+        results = run_client_process(jobs[0])
+    else:
+        with multiprocessing.Pool(processes) as pool:
+            results = [r for batch in pool.map(run_client_process, jobs) for r in batch]
+    wall = time.monotonic() - started
+    server = monitor.stop(wall)
+
+    ok = [r for r in results if "error" not in r]
+    errors = [r["error"] for r in results if "error" in r]
+    total_bytes = sum(r["bytes"] for r in ok)
+    span = (max(r["end"] for r in ok) - min(r["start"] for r in ok)) if ok else 0
+    return {
+        "clients": clients,
+        "completed": len(ok),
+        "errors": len(errors),
+        "error_samples": sorted(set(errors))[:5],
+        "wall_seconds": round(wall, 3),
+        "bytes": total_bytes,
+        "aggregate_mb_per_s": round(total_bytes / span / (1024 * 1024), 2) if span else None,
+        "stream_mb_per_s": percentiles([r["throughput"] for r in ok], 1 / (1024 * 1024), (1, 50, 99)),
+        "connect_ms": percentiles([r["connect"] for r in ok], 1000),
+        "auth_ms": percentiles([r["auth"] for r in ok], 1000),
+        "ttfb_ms": percentiles([r["ttfb"] for r in ok], 1000),
+        "stream_seconds": percentiles([r["stream_seconds"] for r in ok]),
+        "server": server,
+    }
+
+def metric(scenario, path):
+    value = scenario
+    for key in path.split("."):
+        value = value.get(key) if isinstance(value, dict) else None
+    return value
+
+def compare(results, baseline, threshold):
+    """Compare scenarios that appear in both runs; returns a list of metric changes"""
+    previous = {s["name"]: s for s in baseline.get("scenarios", [])}
+    changes = []
+    for scenario in results["scenarios"]:
+        old = previous.get(scenario["name"])
+        if old is None:
+            continue
+        for path, higher_is_better in COMPARED_METRICS:
+            before, after = metric(old, path), metric(scenario, path)
+            if not before or after is None:
+                continue
+            change = (after - before) / before * 100
+            worse = -change if higher_is_better else change
+            changes.append({
+                "scenario": scenario["name"],
+                "metric": path,
+                "baseline": before,
+                "current": after,
+                "change_percent": round(change, 1),
+                "regression": worse > threshold,
+            })
+    return changes
+
+def print_summary(results):
+    out = sys.stderr
+    def cell(value, width):
+        return f"{'-' if value is None else value:>{width}}"
+    print(f"{'scenario':<24}{'ok':>6}{'err':>5}{'MB/s':>9}{'stream p50':>11}{'ttfb p50':>10}"
+          f"{'ttfb p99':>10}{'cpu %':>8}{'rss MB':>8}", file=out)
+    for s in results["scenarios"]:
+        print(f"{s['name']:<24}{s['completed']:>6}{s['errors']:>5}" + cell(s["aggregate_mb_per_s"], 9)
+              + cell(s["stream_mb_per_s"]["p50"], 11) + cell(s["ttfb_ms"]["p50"], 10)
+              + cell(s["ttfb_ms"]["p99"], 10) + cell(s["server"]["cpu_percent"], 8)
+              + cell(s["server"]["rss_peak_mb"], 8), file=out)
+    for change in results.get("comparison", []):
+        if change["regression"]:
+            print(f"REGRESSION {change['scenario']} {change['metric']}: {change['baseline']} -> "
+                  f"{change['current']} ({change['change_percent']:+}%)", file=out)
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the ByteBeats server with simulated listeners")
+    parser.add_argument("--clients", default="1,10,100",
+                        help="Comma-separated numbers of concurrent listeners, one scenario each")
+    parser.add_argument("--mode", default="threaded,asyncio", help="Server engines to test")
+    parser.add_argument("--tls", choices=["on", "off", "both"], default="both")
+    parser.add_argument("--sizes", default="1,4,16", help="Sizes in MB of the generated songs")
+    parser.add_argument("--music-dir", default=MUSIC_DIR, help="Where to generate the synthetic library")
+    parser.add_argument("--pacing-multiplier", type=float, default=0,
+                        help="Server pacing (0, the default, sends as fast as the clients read)")
+    parser.add_argument("--workers", type=int, default=1, help="Server worker processes")
+    parser.add_argument("--client-processes", type=int, default=1,
+                        help="Processes the simulated clients are spread over")
+    parser.add_argument("--ramp", type=float, default=0,
+                        help="Seconds over which clients connect (all at once by default)")
+    parser.add_argument("--timeout", type=float, default=300, help="Seconds a listener may take")
+    parser.add_argument("--username", default="user1")
+    parser.add_argument("--password", default="password1")
+    parser.add_argument("--output", help="Also write the results to this file (e.g. as a baseline)")
+    parser.add_argument("--baseline", help="Compare with the results in this file")
+    parser.add_argument("--threshold", type=float, default=10.0,
+                        help="Percent change that counts as a regression")
+    args = parser.parse_args()
+
+    songs = generate_library(args.music_dir, [float(s) for s in args.sizes.split(",")])
+    client_counts = [int(c) for c in args.clients.split(",")]
+    tls_settings = {"on": [True], "off": [False], "both": [True, False]}[args.tls]
+    results = {
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        },
+        "config": {key: value for key, value in vars(args).items() if key not in ("password", "output", "baseline")},
+        "scenarios": [],
+    }
+    log_dir = os.path.dirname(os.path.abspath(args.music_dir))
+    for mode in args.mode.split(","):
+        for tls in tls_settings:
+            port = free_port()
+            log_path = os.path.join(log_dir, f"bytebeats-load-test-{mode}-{'tls' if tls else 'plain'}.log")
+            server = start_server(args, mode, tls, port, log_path)
+            try:
+                monitor = ServerMonitor(server.pid)
+                # Warm up: fill the chunk cache and frame indexes, and generate the certificate
+                asyncio.run(run_clients(port, tls, songs, range(len(songs)), len(songs), 0, args.timeout,
+                                        f"{args.username}:{args.password}"))
+                for clients in client_counts:
+                    name = f"{mode}/{'tls' if tls else 'plain'}/{clients}"
+                    print(f"Running {name}...", file=sys.stderr)
+                    scenario = run_scenario(args, port, tls, songs, clients, monitor)
+                    results["scenarios"].append(dict(scenario, name=name, mode=mode, tls=tls))
+            finally:
+                stop_server(server)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            results["comparison"] = compare(results, json.load(f), args.threshold)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
+    print_summary(results)
+    if any(change["regression"] for change in results.get("comparison", [])):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -10,6 +10,8 @@ import signal
 import websocket
 import struct
 import ssl
+import shutil
+import hashlib
 
 # Server configuration
 HOST = input("Enter server IP address on the mobile hotspot: ")  # Allow user to input server address
@@ -20,12 +22,51 @@ PORT = int(PORT)
 use_secure = input("Use secure connection? (Y/n): ").lower() != 'n'
 ws_protocol = "wss://" if use_secure else "ws://"
 
+# Lower qualities are transcoded by the server; "auto" lets it choose from the measured connection speed
+quality = input("Streaming quality (original, 64, 128, 192 or auto) [auto]: ").strip().lower() or "auto"
+
+# Ask whether to start playing while the song is still downloading
+progressive_playback = input("Start playback while downloading? (Y/n): ").lower() != 'n'
+PREBUFFER_SECONDS = 1.0             # Audio buffered before progressive playback starts
+RING_BUFFER_SIZE = 4 * 1024 * 1024  # Max bytes held between the network and the player
+# Players that can decode MP3 from stdin, in order of preference
+STREAM_PLAYERS = [
+    ["ffplay", "-nodisp", "-autoexit", "-loglevel", "error", "-i", "pipe:0"],
+    ["mpg123", "-q", "-"],
+]
+
+# Songs that were played in full are kept here and revalidated with the server before replaying
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "bytebeats")
+CACHE_MAX_BYTES = 1024 * 1024 * 1024  # Least recently played songs are evicted beyond this
+
+# Reconnecting after a dropped connection resumes the session and the download
+RESUME_ATTEMPTS = 3
+session_token = None  # Issued by the server with AUTH_SUCCESS
+
+# Why the server may turn a connection or song away with BUSY
+BUSY_REASONS = {
+    "connections": "too many listeners are connected",
+    "streams": "too many songs are streaming",
+    "user_streams": "your account is already streaming as many songs as it may",
+    "bandwidth": "there is no bandwidth left for another song",
+}
+
+def busy_reason(reply):
+    return BUSY_REASONS.get(reply.get("reason"), reply.get("reason"))
+
+class ServerBusy(Exception):
+    """The server turned the connection away with BUSY"""
+    def __init__(self, reply):
+        super().__init__(f"Server busy: {busy_reason(reply)}")
+        self.reply = reply
+
 # Global variables for playback control
 player_process = None
 is_playing = False
 is_paused = False
 current_song = None
 stop_playback = False
+current_stream = None  # Progress of the song being received, so controls can reach the server
 
 # Connect to the server
 def connect_to_server():
@@ -49,34 +90,186 @@ def connect_to_server():
         print(f"Connection failed: {e}")
         raise
 
-# Get the list of available songs
+# Tell the user why the server is busy and wait as long as it asked; returns False if they'd rather not
+def wait_for_server(busy):
+    retry_after = busy.get("retry_after") or 1
+    if input(f"\nServer busy: {busy_reason(busy)}. Retry in {retry_after:g}s? (Y/n): ").lower() == 'n':
+        return False
+    time.sleep(retry_after)
+    return True
+
+# Log in and get the first page of available songs
 def get_song_list(client_socket):
+    """Return (songs on the first page, cursor of the next page, total number of songs).
+
+    Raises ServerBusy if the server has no room for another connection.
+    """
+    global session_token
+    
     # Wait for the AUTH_REQUIRED message
     try:
         message = client_socket.recv()
         data = json.loads(message)
+        if data.get("type") == "BUSY":
+            # The server closes the connection right after this
+            raise ServerBusy(data)
         if data.get("type") == "AUTH_REQUIRED":
-            username = input("Username: ")
-            password = input("Password: ")
-            client_socket.send(f"{username}:{password}")
-            
-            # Wait for authentication result
-            auth_result = client_socket.recv()
-            auth_data = json.loads(auth_result)
+            auth_data = None
+            if session_token:
+                # Skip the password while our session token is still valid
+                client_socket.send(json.dumps({"type": "RESUME_SESSION", "token": session_token}))
+                auth_data = json.loads(client_socket.recv())
+                if auth_data.get("type") != "AUTH_SUCCESS":
+                    print("Session expired, please log in again")
+                    session_token = None
+                    auth_data = None
+            if auth_data is None:
+                username = input("Username: ")
+                password = input("Password: ")
+                client_socket.send(f"{username}:{password}")
+                
+                # Wait for authentication result
+                auth_result = client_socket.recv()
+                auth_data = json.loads(auth_result)
             if auth_data.get("type") == "AUTH_FAILED":
                 raise Exception("Authentication failed")
             elif auth_data.get("type") == "AUTH_SUCCESS":
                 print("Authentication successful")
-                return auth_data.get("songs", [])
+                session_token = auth_data.get("token")
+                songs = auth_data.get("songs", [])
+                return songs, auth_data.get("next_cursor"), auth_data.get("total", len(songs))
         else:
             print(f"Unexpected message: {data}")
-            return []
+            return [], None, 0
     except json.JSONDecodeError:
         print(f"Error parsing server response")
-        return []
+        return [], None, 0
+    except ServerBusy:
+        raise
     except Exception as e:
         print(f"Error: {e}")
-        return []
+        return [], None, 0
+
+def request_songs(client_socket, request, reply_type):
+    """Send a GET_SONGS or SEARCH request and return the reply"""
+    client_socket.send(json.dumps(request))
+    while True:
+        reply = json.loads(client_socket.recv())
+        if reply.get("type") == reply_type:
+            return reply
+
+def choose_song(client_socket, songs, next_cursor, total):
+    """Let the user page through or search the library; returns (song name, start time) or None to quit"""
+    first = 0  # Number of the first song on this page, minus one
+    heading = f"Available songs ({total})"
+    while True:
+        print(f"\n{heading}:")
+        for i, song in enumerate(songs):
+            print(f"{first + i + 1}. {song}")
+        if next_cursor:
+            print("n. Next page")
+        print("/text. Search by name, title or artist ('/' alone goes back to the full list)")
+        print("q. Quit application")
+
+        choice = input("\nSelect a song by number, optionally with a start time like 3@1:30 (or 'q' to quit): ").strip()
+        if choice.lower() == 'q':
+            return None
+        if choice.lower() == 'n' and next_cursor:
+            reply = request_songs(client_socket, {"type": "GET_SONGS", "cursor": next_cursor}, "SONG_LIST")
+            first += len(songs)
+            songs, next_cursor = reply["songs"], reply.get("next_cursor")
+            continue
+        if choice.startswith('/'):
+            query = choice[1:].strip()
+            first = 0
+            if query:
+                reply = request_songs(client_socket, {"type": "SEARCH", "query": query}, "SEARCH_RESULTS")
+                songs, next_cursor = reply["songs"], None
+                heading = f"Songs matching '{query}' ({len(songs)})"
+            else:
+                reply = request_songs(client_socket, {"type": "GET_SONGS"}, "SONG_LIST")
+                songs, next_cursor = reply["songs"], reply.get("next_cursor")
+                heading = f"Available songs ({reply.get('total', len(songs))})"
+            continue
+
+        try:
+            number, _, start = choice.partition('@')
+            start_time = parse_start_time(start) if start else None
+            index = int(number) - 1 - first
+            if 0 <= index < len(songs):
+                return songs[index], start_time
+            print("Invalid choice")
+        except ValueError:
+            print("Please enter a valid number (and start time), 'n', '/search' or 'q'")
+
+# On-disk cache of complete songs, keyed by name and validated by the server's etag
+class TrackCache:
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(directory, "index.json")
+        self.lock = threading.Lock()
+        self.entries = {}  # name -> {"file", "etag", "size", "last_used"}
+        try:
+            with open(self.index_path) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    def _save(self):
+        os.makedirs(self.directory, exist_ok=True)
+        temp_path = self.index_path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self.entries, f)
+        os.replace(temp_path, self.index_path)
+
+    def lookup(self, song_name):
+        """Return (path, etag) of a cached song, or None"""
+        with self.lock:
+            entry = self.entries.get(song_name)
+            if not entry:
+                return None
+            path = os.path.join(self.directory, entry["file"])
+            if not os.path.exists(path):
+                del self.entries[song_name]
+                return None
+            return path, entry["etag"]
+
+    def touch(self, song_name):
+        """Mark a song as just played"""
+        with self.lock:
+            if song_name in self.entries:
+                self.entries[song_name]["last_used"] = time.time()
+                self._save()
+
+    def store(self, song_name, etag, temp_filename):
+        """Move a completely received song into the cache and return its new path"""
+        with self.lock:
+            os.makedirs(self.directory, exist_ok=True)
+            file_name = hashlib.sha1(song_name.encode("utf-8")).hexdigest() + ".mp3"
+            path = os.path.join(self.directory, file_name)
+            shutil.move(temp_filename, path)
+            self.entries[song_name] = {
+                "file": file_name,
+                "etag": etag,
+                "size": os.path.getsize(path),
+                "last_used": time.time(),
+            }
+            # Evict the least recently played songs beyond the size cap
+            total = sum(entry["size"] for entry in self.entries.values())
+            for name, entry in sorted(self.entries.items(), key=lambda item: item[1]["last_used"]):
+                if total <= self.max_bytes or name == song_name:
+                    break
+                try:
+                    os.unlink(os.path.join(self.directory, entry["file"]))
+                except OSError:
+                    pass
+                total -= entry["size"]
+                del self.entries[name]
+            self._save()
+            return path
+
+track_cache = TrackCache(CACHE_DIR, CACHE_MAX_BYTES)
 
 # Toggle pause/resume playback
 def toggle_pause():
@@ -90,15 +283,31 @@ def toggle_pause():
             # Pause playback by sending SIGSTOP
             os.kill(player_process.pid, signal.SIGSTOP)
             is_paused = True
+            send_stream_control("PAUSE")
             print("\nPlayback paused. Press 'p' to resume.")
         else:
             # Resume playback by sending SIGCONT
             os.kill(player_process.pid, signal.SIGCONT)
             is_paused = False
+            send_stream_control("RESUME")
             print("\nPlayback resumed.")
     else:
         print("Pause/Resume not supported on this platform")
 
+# Tell the server to pause, resume or stop the song it is still sending
+def send_stream_control(message_type):
+    progress = current_stream
+    if progress is None or progress["done"]:
+        return
+    if message_type == "STOP":
+        if progress["stopping"]:
+            return
+        progress["stopping"] = True
+    try:
+        progress["socket"].send(json.dumps({"type": message_type}))
+    except (websocket.WebSocketException, OSError):
+        pass
+
 # Play the MP3 file in a separate thread
 def play_music(temp_filename, song_name):
     global is_playing, player_process, stop_playback, is_paused
@@ -135,6 +344,121 @@ def play_music(temp_filename, song_name):
         is_paused = False
         player_process = None
 
+# Bounded FIFO between the thread receiving chunks and the thread feeding the player
+class RingBuffer:
+    def __init__(self, capacity):
+        self.buffer = bytearray(capacity)
+        self.capacity = capacity
+        self.start = 0
+        self.size = 0
+        self.closed = False
+        self.playing = False      # Underruns only count once playback has started
+        self.underruns = 0
+        self.underrun_time = 0.0
+        self.condition = threading.Condition()
+
+    def write(self, data):
+        """Append data, blocking while the buffer is full (which backpressures the server)"""
+        view = memoryview(data)
+        with self.condition:
+            while view and not self.closed:
+                while self.size == self.capacity and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                end = (self.start + self.size) % self.capacity
+                count = min(len(view), self.capacity - self.size, self.capacity - end)
+                self.buffer[end:end + count] = view[:count]
+                self.size += count
+                view = view[count:]
+                self.condition.notify_all()
+
+    def read(self, max_bytes):
+        """Remove up to max_bytes, blocking while empty; returns b'' once closed and drained"""
+        with self.condition:
+            if self.size == 0 and not self.closed:
+                if self.playing:
+                    self.underruns += 1
+                waited_from = time.time()
+                while self.size == 0 and not self.closed:
+                    self.condition.wait()
+                if self.playing:
+                    self.underrun_time += time.time() - waited_from
+            count = min(max_bytes, self.size, self.capacity - self.start)
+            data = bytes(self.buffer[self.start:self.start + count])
+            self.start = (self.start + count) % self.capacity
+            self.size -= count
+            self.condition.notify_all()
+            return data
+
+    def wait_for(self, nbytes):
+        """Block until nbytes are buffered or the stream has ended"""
+        with self.condition:
+            while self.size < min(nbytes, self.capacity) and not self.closed:
+                self.condition.wait()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+# Find a player that can decode MP3 from stdin
+def find_stream_player():
+    for command in STREAM_PLAYERS:
+        if shutil.which(command[0]):
+            return command
+    return None
+
+# Feed buffered audio to the player's stdin until the stream ends
+def feed_player(ring, process):
+    try:
+        while True:
+            data = ring.read(16384)
+            if not data:
+                break
+            process.stdin.write(data)
+            process.stdin.flush()
+    except (BrokenPipeError, OSError, ValueError):
+        # The player was stopped or exited
+        ring.close()
+    finally:
+        try:
+            process.stdin.close()
+        except (BrokenPipeError, OSError):
+            pass
+
+# Play audio from the ring buffer while it is still being received
+def play_stream(ring, song_name, player_command):
+    global is_playing, player_process, stop_playback, is_paused
+    
+    is_playing = True
+    is_paused = False
+    print(f"\nNow playing: {song_name}")
+    print("Playback controls:")
+    print("  p - pause/resume")
+    print("  s - stop and return to song selection")
+    print("  q - quit application")
+    
+    try:
+        player_process = subprocess.Popen(player_command, stdin=subprocess.PIPE)
+        ring.playing = True
+        feeder = threading.Thread(target=feed_player, args=(ring, player_process), daemon=True)
+        feeder.start()
+        
+        # Monitor the player process
+        while player_process.poll() is None and not stop_playback:
+            time.sleep(0.1)
+            
+        if not stop_playback and player_process.returncode == 0:
+            print(f"\nFinished playing {song_name}")
+    except Exception as e:
+        print(f"Error playing audio: {e}")
+    finally:
+        ring.close()
+        is_playing = False
+        is_paused = False
+        player_process = None
+
 # Handle playback controls
 def handle_controls():
     global is_playing, player_process, stop_playback
@@ -151,6 +475,7 @@ def handle_controls():
                         toggle_pause()
                             
                     elif command == 's':  # Stop
+                        send_stream_control("STOP")
                         if player_process and player_process.poll() is None:
                             player_process.terminate()
                             print("\nStopping playback...")
@@ -167,6 +492,7 @@ def handle_controls():
                 if command == 'p':
                     toggle_pause()
                 elif command == 's':
+                    send_stream_control("STOP")
                     if player_process and player_process.poll() is None:
                         player_process.terminate()
                     stop_playback = True
@@ -186,17 +512,124 @@ def parse_websocket_message(ws, binary=False):
         print(f"Error parsing WebSocket message: {e}")
         return None
 
+# Parse a start position given as seconds ("90") or minutes:seconds ("1:30")
+def parse_start_time(text):
+    seconds = 0.0
+    for part in text.split(":"):
+        seconds = seconds * 60 + float(part)
+    if seconds < 0:
+        raise ValueError("Start time must not be negative")
+    return seconds
+
+# Reconnect after a dropped connection and continue a song from the bytes we already have
+def resume_stream(song_name, offset, etag, stream_quality=None):
+    global session_token
+    
+    if not session_token:
+        return None
+    retry_after = 0  # Asked for by a server that was too busy on the last attempt
+    for attempt in range(RESUME_ATTEMPTS):
+        print(f"\nConnection lost, resuming from byte {offset} (attempt {attempt + 1})...")
+        time.sleep(max(retry_after, min(2 ** attempt, 5)))
+        retry_after = 0
+        try:
+            client_socket = connect_to_server()
+            greeting = json.loads(client_socket.recv())  # AUTH_REQUIRED, or BUSY
+            if greeting.get("type") == "BUSY":
+                print(f"Server busy: {busy_reason(greeting)}")
+                retry_after = greeting.get("retry_after") or 0
+                client_socket.close()
+                continue
+            client_socket.send(json.dumps({
+                "type": "RESUME_SESSION",
+                "token": session_token,
+                "name": song_name,
+                "offset": offset,
+                "quality": stream_quality,
+                "if_match": etag  # Don't splice in bytes from a file that changed meanwhile
+            }))
+            reply = json.loads(client_socket.recv())
+            if reply.get("type") != "AUTH_SUCCESS":
+                print("Session expired, cannot resume the song")
+                client_socket.close()
+                session_token = None
+                return None
+            session_token = reply.get("token")
+            # Authenticated, but the song may still not fit on the server right now
+            reply = json.loads(client_socket.recv())
+            if reply.get("type") == "BUSY":
+                print(f"Server busy: {busy_reason(reply)}")
+                retry_after = reply.get("retry_after") or 0
+                client_socket.close()
+                continue
+            if reply.get("type") != "SONG_PLAYING":
+                print(f"Cannot resume the song: {reply.get('error') or reply.get('type')}")
+                client_socket.close()
+                return None
+            return client_socket
+        except Exception as e:
+            print(f"Reconnect failed: {e}")
+    return None
+
+# Play a local file and handle controls until playback finishes
+def play_file(filename, song_name):
+    # Start playback in a separate thread
+    playback_thread = threading.Thread(target=play_music, args=(filename, song_name))
+    playback_thread.daemon = True
+    playback_thread.start()
+    
+    # Handle controls in the main thread
+    handle_controls()
+    
+    # Wait for playback to finish
+    playback_thread.join()
+
 # Stream and play the selected song
-def stream_song(client_socket, song_name):
+def stream_song(client_socket, song_name, start_time=None):
     global stop_playback
     
     # Send a play request as JSON
-    play_request = json.dumps({
+    request = {
         "type": "PLAY_SONG",
         "name": song_name
-    })
+    }
+    if start_time:
+        # The server starts at the nearest MPEG frame to this time
+        request["start"] = start_time
+    if quality != "original":
+        request["quality"] = quality
+    cached = track_cache.lookup(song_name) if not start_time else None
+    if cached:
+        # Ask the server to skip the transfer if our copy is still current
+        request["if_none_match"] = cached[1]
+    play_request = json.dumps(request)
     client_socket.send(play_request)
     stop_playback = False
+    
+    if cached:
+        reply = json.loads(client_socket.recv())
+        if reply.get("type") == "SONG_NOT_MODIFIED":
+            print("Song unchanged on the server, playing from the local cache")
+            track_cache.touch(song_name)
+            play_file(cached[0], song_name)
+            return
+        if reply.get("type") == "BUSY":
+            if wait_for_server(reply):
+                stream_song(client_socket, song_name, start_time)
+            return
+        if reply.get("type") != "SONG_PLAYING":
+            print(f"Server could not play the song: {reply.get('type')}")
+            return
+        print(f"Cached copy is out of date, server started streaming: {reply.get('name')}")
+    
+    if progressive_playback:
+        player_command = find_stream_player()
+        if player_command:
+            busy = stream_song_progressive(client_socket, song_name, player_command)
+            if busy and wait_for_server(busy):
+                stream_song(client_socket, song_name, start_time)
+            return
+        print("No streaming player found (install ffmpeg or mpg123); downloading before playback")
 
     # Create a temporary file to store the MP3
     temp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.mp3')
@@ -205,13 +638,32 @@ def stream_song(client_socket, song_name):
     # Variables to track download progress
     bytes_received = 0
     song_size = None
+    stream_start = 0
+    stream_etag = None
+    stream_quality = None
+    etag = None
     receiving_data = False
+    busy = None  # The BUSY reply, if the server had no room for the song
+    original_socket = client_socket
     
     try:
         print("Waiting for song data...")
         while True:
             # Receive WebSocket message
-            message = client_socket.recv()
+            try:
+                message = client_socket.recv()
+            except (websocket.WebSocketException, OSError):
+                resumed_socket = None
+                # Live transcodes have no etag and can't be resumed
+                if stream_etag:
+                    resumed_socket = resume_stream(song_name, stream_start + bytes_received, stream_etag,
+                                                   stream_quality)
+                if resumed_socket is None:
+                    raise
+                if client_socket is not original_socket:
+                    client_socket.close()
+                client_socket = resumed_socket
+                continue
             
             # If it's binary data (likely audio chunks)
             if isinstance(message, bytes):
@@ -229,9 +681,23 @@ def stream_song(client_socket, song_name):
                 data = json.loads(message)
                 message_type = data.get("type")
                 
-                if message_type == "SONG_METADATA":
-                    song_size = data.get("size", 0)
-                    print(f"\nSong: {data.get('name')}, Size: {song_size / (1024*1024):.2f} MB")
+                if message_type == "SONG_METADATA" and song_size is not None:
+                    # A resumed stream starts right after the bytes we already have
+                    print(f"Resumed at byte {data.get('start_offset')}")
+                
+                elif message_type == "SONG_METADATA":
+                    # Only the bytes after the start offset will be sent
+                    stream_start = data.get("start_offset") or 0
+                    stream_etag = data.get("etag")
+                    stream_quality = data.get("quality")
+                    # A live transcode doesn't know its size yet
+                    song_size = max(0, (data.get("size") or 0) - stream_start)
+                    # Only songs received from the start can be cached
+                    etag = stream_etag if not stream_start else None
+                    print(f"\nSong: {data.get('name')}, Size: {song_size / (1024*1024):.2f} MB, "
+                          f"Quality: {stream_quality}")
+                    if data.get("start_time"):
+                        print(f"Starting at {int(data['start_time'] // 60)}:{int(data['start_time'] % 60):02d}")
                 
                 elif message_type == "SONG_PLAYING":
                     print(f"Server started streaming: {data.get('name')}")
@@ -242,21 +708,22 @@ def stream_song(client_socket, song_name):
                     receiving_data = False
                     temp_file.close()
                     
-                    # Start playback in a separate thread
-                    playback_thread = threading.Thread(target=play_music, args=(temp_filename, song_name))
-                    playback_thread.daemon = True
-                    playback_thread.start()
-                    
-                    # Handle controls in the main thread
-                    handle_controls()
-                    
-                    # Wait for playback to finish
-                    playback_thread.join()
+                    play_filename = temp_filename
+                    if etag and bytes_received == song_size:
+                        try:
+                            play_filename = track_cache.store(song_name, etag, temp_filename)
+                        except OSError as e:
+                            print(f"Could not cache song: {e}")
+                    play_file(play_filename, song_name)
                     return
                     
                 elif message_type == "STREAM_ERROR":
                     print(f"\nError streaming song: {data.get('error')}")
                     return
+                
+                elif message_type == "BUSY":
+                    busy = data
+                    break
             
             except json.JSONDecodeError:
                 print(f"Received non-JSON message: {message[:50]}...")
@@ -264,12 +731,153 @@ def stream_song(client_socket, song_name):
     except Exception as e:
         print(f"\nError during streaming: {e}")
     finally:
+        if client_socket is not original_socket:
+            client_socket.close()
         # Clean up the temporary file
         try:
             if os.path.exists(temp_filename):
                 os.unlink(temp_filename)
         except:
             pass
+    
+    if busy and wait_for_server(busy):
+        stream_song(client_socket, song_name, start_time)
+
+# Receive song data into the ring buffer until the server reports the end of the song
+def receive_into_ring(client_socket, ring, progress):
+    original_socket = client_socket
+    try:
+        while True:
+            if ring.closed:
+                # Playback ended early: stop the server too, then skip what is already on its way
+                send_stream_control("STOP")
+            try:
+                message = client_socket.recv()
+            except (websocket.WebSocketException, OSError):
+                resumed_socket = None
+                if progress["stream_etag"] and not progress["stopping"]:
+                    # Playback keeps draining the buffer while we reconnect
+                    resumed_socket = resume_stream(progress["name"], progress["start"] + progress["received"],
+                                                   progress["stream_etag"], progress["quality"])
+                if resumed_socket is None:
+                    raise
+                if client_socket is not original_socket:
+                    client_socket.close()
+                client_socket = resumed_socket
+                progress["socket"] = client_socket
+                continue
+            if isinstance(message, bytes):
+                if progress["stopping"]:
+                    continue
+                if progress["cache_file"]:
+                    progress["cache_file"].write(message)
+                ring.write(message)
+                progress["received"] += len(message)
+                continue
+            
+            try:
+                data = json.loads(message)
+            except json.JSONDecodeError:
+                print(f"Received non-JSON message: {message[:50]}...")
+                continue
+            message_type = data.get("type")
+            if message_type == "SONG_METADATA" and progress["metadata"].is_set():
+                print(f"\nResumed at byte {data.get('start_offset')}")
+            elif message_type == "SONG_METADATA":
+                progress["start"] = data.get("start_offset") or 0
+                progress["stream_etag"] = data.get("etag")
+                progress["quality"] = data.get("quality")
+                progress["size"] = max(0, (data.get("size") or 0) - progress["start"])
+                if data.get("bitrate"):
+                    progress["prebuffer"] = int(data["bitrate"] / 8 * PREBUFFER_SECONDS)
+                if data.get("etag") and not data.get("start_offset"):
+                    # Keep a copy of the song so replays can come from the cache
+                    progress["etag"] = data["etag"]
+                    progress["cache_file"] = tempfile.NamedTemporaryFile(delete=False, suffix='.mp3')
+                print(f"\nSong: {data.get('name')}, Size: {progress['size'] / (1024*1024):.2f} MB, Quality: {progress['quality']}")
+                progress["metadata"].set()
+            elif message_type == "SONG_PLAYING":
+                print(f"Server started streaming: {data.get('name')}")
+            elif message_type == "SONG_ENDED":
+                progress["complete"] = not progress["stopping"]
+                break
+            elif message_type == "SONG_STOPPED":
+                break
+            elif message_type == "STREAM_ERROR":
+                print(f"\nError streaming song: {data.get('error')}")
+                break
+            elif message_type == "BUSY":
+                # No room for the song right now; the caller decides whether to wait and ask again
+                progress["busy"] = data
+                break
+    except Exception as e:
+        if not ring.closed:
+            print(f"\nError during streaming: {e}")
+    finally:
+        progress["done"] = True
+        if client_socket is not original_socket:
+            client_socket.close()
+        progress["metadata"].set()
+        ring.close()
+        cache_file = progress["cache_file"]
+        if cache_file:
+            cache_file.close()
+            try:
+                if progress["complete"] and progress["received"] == progress["size"]:
+                    track_cache.store(progress["name"], progress["etag"], cache_file.name)
+                else:
+                    os.unlink(cache_file.name)
+            except OSError as e:
+                print(f"Could not cache song: {e}")
+
+# Stream a song straight into a player, starting once a little audio is buffered;
+# returns the BUSY reply if the server had no room for the song
+def stream_song_progressive(client_socket, song_name, player_command):
+    global current_stream
+    ring = RingBuffer(RING_BUFFER_SIZE)
+    progress = {
+        "socket": client_socket,
+        "stopping": False,  # STOP sent: audio still arriving is discarded until SONG_STOPPED
+        "done": False,
+        "name": song_name,
+        "received": 0,
+        "start": 0,
+        "size": 0,
+        "stream_etag": None,
+        "quality": None,
+        "prebuffer": 64 * 1024,  # Used until the server reports the bitrate
+        "complete": False,
+        "etag": None,
+        "cache_file": None,
+        "metadata": threading.Event(),
+        "busy": None,
+    }
+    current_stream = progress
+    receiver = threading.Thread(target=receive_into_ring, args=(client_socket, ring, progress), daemon=True)
+    receiver.start()
+    
+    print("Buffering...")
+    started = time.time()
+    progress["metadata"].wait()
+    ring.wait_for(progress["prebuffer"])
+    if progress["received"] == 0:
+        current_stream = None
+        return progress["busy"]
+    print(f"Playback starting after {time.time() - started:.2f}s ({progress['received'] / 1024:.0f} KB buffered)")
+    
+    playback_thread = threading.Thread(target=play_stream, args=(ring, song_name, player_command))
+    playback_thread.daemon = True
+    playback_thread.start()
+    
+    # Handle controls in the main thread
+    handle_controls()
+    playback_thread.join()
+    # The connection is ready for the next song once the server has stopped sending this one
+    receiver.join(timeout=5)
+    current_stream = None
+    
+    print(f"Received {progress['received'] / (1024*1024):.2f} of {progress['size'] / (1024*1024):.2f} MB, "
+          f"buffer underruns: {ring.underruns} ({ring.underrun_time:.1f}s stalled)")
 
 # Main function
 def main():
@@ -286,34 +894,27 @@ def main():
             try:
                 client_socket = connect_to_server()
         
-                # Get the list of available songs
-                songs = get_song_list(client_socket)
+                # Get the first page of available songs
+                try:
+                    songs, next_cursor, total = get_song_list(client_socket)
+                except ServerBusy as e:
+                    client_socket.close()
+                    if wait_for_server(e.reply):
+                        continue
+                    break
                 if not songs:
                     print("No songs available on the server. Please add MP3 files to the music directory.")
                     client_socket.close()
                     input("Press Enter to try again...")
                     continue
-                    
-                print("\nAvailable songs:")
-                for i, song in enumerate(songs):
-                    print(f"{i + 1}. {song}")
-                print("q. Quit application")
         
                 # Select a song
-                choice = input("\nSelect a song by number (or 'q' to quit): ")
-                if choice.lower() == 'q':
+                selection = choose_song(client_socket, songs, next_cursor, total)
+                if selection is None:
                     break
-                    
-                try:
-                    choice = int(choice) - 1
-                    if 0 <= choice < len(songs):
-                        song_name = songs[choice]
-                        print(f"Streaming {song_name}...")
-                        stream_song(client_socket, song_name)
-                    else:
-                        print("Invalid choice")
-                except ValueError:
-                    print("Please enter a valid number or 'q'")
+                song_name, start_time = selection
+                print(f"Streaming {song_name}...")
+                stream_song(client_socket, song_name, start_time)
                     
                 client_socket.close()
                 
@@ -0,0 +1,188 @@
+import multiprocessing
+import random
+import threading
+import time
+
+# Defaults (overridden from server.py)
+DEFAULT_STREAM_SECONDS = 180.0  # Assumed length of a stream until some have ended
+RETRY_AFTER_MIN = 1.0           # Shortest retry_after hint in seconds
+RETRY_AFTER_MAX = 60.0          # Longest retry_after hint in seconds
+RETRY_AFTER_JITTER = 0.25       # Hints are spread by up to this fraction, so rejected clients don't return together
+
+class Busy(Exception):
+    """No room for another connection or stream; reason says which limit, retry_after when to try again"""
+    def __init__(self, reason, retry_after):
+        super().__init__(f"Server busy ({reason}), retry after {retry_after}s")
+        self.reason = reason
+        self.retry_after = retry_after
+
+class StreamSlot:
+    """Room for one stream, held from the request until the stream ends"""
+    def __init__(self, username, rate):
+        self.username = username
+        self.rate = rate  # Bytes/s the stream needs to play in real time
+        self.acquired_at = time.monotonic()
+
+class UserStreamCounts:
+    """Streams per user, counted across every worker process.
+
+    With workers > 1 the counts are in shared memory, created before the
+    workers are forked: a row per worker and a column per known user, so a
+    user's streams are the sum of their column. A restarted worker clears
+    its row with use_row(), so the streams of a worker that died aren't
+    counted forever. Users not known up front are counted per process.
+    """
+    def __init__(self, usernames=(), workers=1):
+        self._columns = {name: column for column, name in enumerate(sorted(usernames))}
+        self._local = {}  # username -> streams, for a single process or unknown users
+        self._shared = None
+        self._row = 0
+        if workers > 1 and self._columns:
+            self._shared = multiprocessing.get_context("fork").Array("i", workers * len(self._columns))
+        self._lock = self._shared.get_lock() if self._shared is not None else threading.Lock()
+
+    def use_row(self, row):
+        """Count this process's streams in row (its worker id), starting from none"""
+        self._row = row
+        if self._shared is not None:
+            width = len(self._columns)
+            with self._lock:
+                self._shared[row * width:(row + 1) * width] = [0] * width
+
+    def _cell(self, username):
+        column = self._columns.get(username)
+        if self._shared is None or column is None:
+            return None
+        return self._row * len(self._columns) + column
+
+    def _count(self, username):
+        column = self._columns.get(username)
+        if self._shared is None or column is None:
+            return self._local.get(username, 0)
+        return sum(self._shared[column::len(self._columns)])
+
+    def count(self, username):
+        """Streams username has on every worker"""
+        with self._lock:
+            return self._count(username)
+
+    def try_add(self, username, limit):
+        """Count another stream for username unless they have limit already (0 = no limit).
+
+        Returns (added, streams they had before).
+        """
+        with self._lock:
+            streams = self._count(username)
+            if limit and streams >= limit:
+                return False, streams
+            cell = self._cell(username)
+            if cell is None:
+                self._local[username] = streams + 1
+            else:
+                self._shared[cell] += 1
+            return True, streams
+
+    def remove(self, username):
+        with self._lock:
+            cell = self._cell(username)
+            if cell is not None:
+                self._shared[cell] -= 1
+            elif self._local.get(username, 0) > 1:
+                self._local[username] -= 1
+            else:
+                self._local.pop(username, None)
+
+class AdmissionControl:
+    """Decides whether a new connection or stream may start.
+
+    Limits are on open connections, on streams overall and per user (a
+    user's own limit from user_limits, or max_user_streams), and on the
+    egress rate: the real-time rates of the streams admitted must fit in
+    egress_rate, so every one of them can be sent at least as fast as it
+    plays. 0 turns a limit off. Whatever is over a limit is turned away
+    with Busy rather than admitted and starved.
+
+    The retry_after hint is how long one of the streams in the way can be
+    expected to take to end: the average stream length, learnt from the
+    streams that have ended, divided by how many there are.
+    """
+    def __init__(self, max_connections=0, max_streams=0, max_user_streams=0, user_limits=None, egress_rate=0,
+                 user_streams=None):
+        self.max_connections = max_connections
+        self.max_streams = max_streams
+        self.max_user_streams = max_user_streams
+        self.user_limits = user_limits or {}  # username -> max streams
+        self.egress_rate = egress_rate        # Bytes/s
+        self.connections = 0
+        self.streams = 0
+        self.committed_rate = 0.0
+        self.rejected = {}     # reason -> count
+        self.user_streams = user_streams or UserStreamCounts()  # Streams per user, maybe over all workers
+        self._stream_seconds = DEFAULT_STREAM_SECONDS  # Moving average of how long streams last
+        self._lock = threading.Lock()
+
+    def _retry_after(self, blocking):
+        wait = self._stream_seconds / max(1, blocking)
+        wait *= 1 + random.random() * RETRY_AFTER_JITTER
+        return round(min(RETRY_AFTER_MAX, max(RETRY_AFTER_MIN, wait)), 1)
+
+    def _reject(self, reason, blocking):
+        self.rejected[reason] = self.rejected.get(reason, 0) + 1
+        raise Busy(reason, self._retry_after(blocking))
+
+    def connect(self):
+        """Count a new connection; raises Busy if there are already max_connections"""
+        with self._lock:
+            if self.max_connections and self.connections >= self.max_connections:
+                self._reject("connections", self.connections)
+            self.connections += 1
+
+    def disconnect(self):
+        with self._lock:
+            self.connections -= 1
+
+    def user_limit(self, username):
+        return self.user_limits.get(username, self.max_user_streams)
+
+    def acquire(self, username, rate):
+        """Take a StreamSlot for a stream needing rate bytes/s; raises Busy if it is over a limit"""
+        with self._lock:
+            user_streams = self.user_streams.count(username)
+            limit = self.user_limit(username)
+            if limit and user_streams >= limit:
+                self._reject("user_streams", user_streams)
+            if self.max_streams and self.streams >= self.max_streams:
+                self._reject("streams", self.streams)
+            # A lone stream is let through even if it needs more than the whole budget
+            if self.egress_rate and self.streams and self.committed_rate + rate > self.egress_rate:
+                self._reject("bandwidth", self.streams)
+            added, user_streams = self.user_streams.try_add(username, limit)
+            if not added:
+                # Another worker started one of the user's streams since the check above
+                self._reject("user_streams", user_streams)
+            self.streams += 1
+            self.committed_rate += rate
+        return StreamSlot(username, rate)
+
+    def release(self, slot):
+        """Give back a slot once its stream has ended (or never started)"""
+        seconds = time.monotonic() - slot.acquired_at
+        with self._lock:
+            self.streams -= 1
+            self.committed_rate = max(0.0, self.committed_rate - slot.rate)
+            self.user_streams.remove(slot.username)
+            self._stream_seconds += (seconds - self._stream_seconds) * 0.1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "connections": self.connections,
+                "max_connections": self.max_connections or None,
+                "streams": self.streams,
+                "max_streams": self.max_streams or None,
+                "max_user_streams": self.max_user_streams or None,
+                "committed_rate": int(self.committed_rate),
+                "egress_rate": int(self.egress_rate) or None,
+                "average_stream_seconds": round(self._stream_seconds, 1),
+                "rejected": dict(self.rejected),
+            }
@@ -0,0 +1,444 @@
+"""Offline audio analysis: exact duration, loudness/ReplayGain and a waveform for every track.
+
+Each track is decoded once with ffmpeg and analysed with NumPy in a pool
+of worker processes. The results go to a small binary sidecar file per
+track, keyed like the frame index cache and invalidated when the file's
+size or mtime changes, so running this again only touches new or
+changed tracks. The server reads the sidecars to answer GET_ANALYSIS.
+
+    python server/analyze.py
+    python server/analyze.py --workers 8 --force
+"""
+import argparse
+import hashlib
+import math
+import multiprocessing
+import os
+import shutil
+import struct
+import subprocess
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import ffmpeg  # ffmpeg-python, used to build ffmpeg command lines
+except ImportError:
+    ffmpeg = None
+
+WAVEFORM_POINTS = 1000         # Peaks stored per track; clients can ask for fewer
+PEAKS_PER_SECOND = 100         # Resolution of the peak envelope before it is downsampled
+BLOCK_SECONDS = 30             # Audio decoded and analysed at a time, bounding memory use
+FILTER_CONTEXT_SECONDS = 0.5   # Preceding audio fed through the K-weighting filter with each block
+REPLAYGAIN_REFERENCE = -18.0   # LUFS a ReplayGain 2.0 adjusted track plays at
+ABSOLUTE_GATE = -70.0          # LUFS below which a 400 ms block counts as silence (BS.1770)
+RELATIVE_GATE = -10.0          # LU below the ungated loudness at which blocks are dropped (BS.1770)
+DECODE_TIMEOUT = 600           # Seconds before decoding one track is abandoned
+
+ANALYSIS_MAGIC = b"BBAN"
+ANALYSIS_VERSION = 1
+# magic, version, channels, sample rate, file size, mtime_ns, duration, loudness, gain, peak, points
+ANALYSIS_HEADER = struct.Struct("<4sHHIQqddddI")
+
+class TrackAnalysis:
+    """Analysis results for one version (size and mtime) of a track"""
+    def __init__(self, size, mtime_ns, sample_rate, channels, duration, loudness, gain, peak, peaks):
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.duration = duration  # Seconds, from the decoded sample count
+        self.loudness = loudness  # Integrated loudness in LUFS (-inf for silence)
+        self.gain = gain          # ReplayGain in dB (0.0 for silence)
+        self.peak = peak          # Sample peak, 1.0 = full scale
+        self.peaks = peaks        # bytes, one peak per waveform point (255 = the track's peak)
+
+    def waveform(self, points=None):
+        """Return the waveform as a list of 0-255 peaks, reduced to at most points values"""
+        peaks = self.peaks
+        if not points or points >= len(peaks):
+            return list(peaks)
+        count = len(peaks)
+        return [max(peaks[i * count // points:(i + 1) * count // points]) for i in range(points)]
+
+    def message(self, name, points=None):
+        """Build the ANALYSIS message for a track"""
+        return {
+            "type": "ANALYSIS",
+            "name": name,
+            "duration": round(self.duration, 3),
+            "loudness": round(self.loudness, 2) if math.isfinite(self.loudness) else None,
+            "replaygain": round(self.gain, 2),
+            "peak": round(self.peak, 4),
+            "sample_rate": self.sample_rate,
+            "channels": self.channels,
+            "waveform": self.waveform(points)
+        }
+
+def analysis_cache_path(cache_dir, path):
+    name = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()
+    return os.path.join(cache_dir, name + ".ana")
+
+def read_analysis(cache_file, st=None):
+    """Read a sidecar file; returns None if it is missing, damaged or (given st) stale"""
+    try:
+        with open(cache_file, "rb") as f:
+            header = f.read(ANALYSIS_HEADER.size)
+            if len(header) != ANALYSIS_HEADER.size:
+                return None
+            (magic, version, channels, sample_rate, size, mtime_ns,
+             duration, loudness, gain, peak, points) = ANALYSIS_HEADER.unpack(header)
+            if magic != ANALYSIS_MAGIC or version != ANALYSIS_VERSION:
+                return None
+            if st is not None and (size != st.st_size or mtime_ns != st.st_mtime_ns):
+                return None
+            peaks = f.read(points)
+            if len(peaks) != points:
+                return None
+    except (OSError, struct.error):
+        return None
+    return TrackAnalysis(size, mtime_ns, sample_rate, channels, duration, loudness, gain, peak, peaks)
+
+def write_analysis(cache_file, analysis):
+    header = ANALYSIS_HEADER.pack(
+        ANALYSIS_MAGIC, ANALYSIS_VERSION, analysis.channels, analysis.sample_rate, analysis.size,
+        analysis.mtime_ns, analysis.duration, analysis.loudness, analysis.gain, analysis.peak,
+        len(analysis.peaks)
+    )
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    temp_file = f"{cache_file}.{os.getpid()}.tmp"
+    with open(temp_file, "wb") as f:
+        f.write(header)
+        f.write(analysis.peaks)
+    os.replace(temp_file, cache_file)
+
+def analysis_available():
+    """Whether this machine can analyse tracks (NumPy, ffmpeg-python and an ffmpeg binary)"""
+    return np is not None and ffmpeg is not None and shutil.which("ffmpeg") is not None
+
+def decode_command(path):
+    """Build the ffmpeg arguments to decode path to 32-bit float WAV on stdout"""
+    stream = ffmpeg.output(ffmpeg.input(path).audio, "pipe:1", format="wav", acodec="pcm_f32le")
+    stream = stream.global_args("-hide_banner", "-loglevel", "error", "-nostdin")
+    return ffmpeg.compile(stream)
+
+def read_wav_header(f):
+    """Read a WAV header from a pipe up to the start of the samples; returns (channels, sample rate)"""
+    riff = f.read(12)
+    if len(riff) != 12 or riff[:4] != b"RIFF" or riff[8:12] != b"WAVE":
+        raise ValueError("decoder did not produce WAV output")
+    channels = sample_rate = None
+    while True:
+        chunk = f.read(8)
+        if len(chunk) != 8:
+            raise ValueError("WAV stream has no data chunk")
+        chunk_id, chunk_size = struct.unpack("<4sI", chunk)
+        if chunk_id == b"data":
+            if channels is None:
+                raise ValueError("WAV stream has no format chunk")
+            return channels, sample_rate
+        body = f.read(chunk_size + (chunk_size & 1))
+        if chunk_id == b"fmt ":
+            _, channels, sample_rate = struct.unpack("<HHI", body[:8])
+
+def _biquad_response(b, a, w):
+    z = np.exp(-1j * w)
+    return (b[0] + b[1] * z + b[2] * z * z) / (a[0] + a[1] * z + a[2] * z * z)
+
+def k_weighting(frequencies, sample_rate):
+    """Frequency response of the BS.1770 K-weighting filter (high shelf then high pass).
+
+    The coefficients are derived for any sample rate as in libebur128 and
+    match the ones tabulated in BS.1770 at 48 kHz.
+    """
+    w = 2 * np.pi * frequencies / sample_rate
+    # Stage 1: +4 dB high shelf modelling the head
+    k = math.tan(math.pi * 1681.974450955533 / sample_rate)
+    q = 0.7071752369554196
+    vh = 10 ** (3.999843853973347 / 20)
+    vb = vh ** 0.4996667741545416
+    a0 = 1 + k / q + k * k
+    shelf = _biquad_response(
+        ((vh + vb * k / q + k * k) / a0, 2 * (k * k - vh) / a0, (vh - vb * k / q + k * k) / a0),
+        (1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0), w)
+    # Stage 2: high pass (the RLB curve)
+    k = math.tan(math.pi * 38.13547087602444 / sample_rate)
+    q = 0.5003270373238773
+    a0 = 1 + k / q + k * k
+    high_pass = _biquad_response((1.0, -2.0, 1.0), (1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0), w)
+    return shelf * high_pass
+
+class _Accumulator:
+    """Running per-step energies and peaks over a decoded stream.
+
+    Audio arrives in blocks whose length is a whole number of 100 ms steps.
+    Each block is K-weighted in the frequency domain, with the end of the
+    previous block prepended so the filter has settled, and reduced to the
+    energy per step and channel; BS.1770's 400 ms gating blocks are then
+    sums of four consecutive steps. The peak envelope is kept at
+    PEAKS_PER_SECOND and only downsampled at the end.
+    """
+    def __init__(self, channels, sample_rate):
+        self.channels = channels
+        self.sample_rate = sample_rate
+        self.peak_hop = max(1, sample_rate // PEAKS_PER_SECOND)
+        self.step = self.peak_hop * PEAKS_PER_SECOND // 10  # ~100 ms
+        self.context = int(sample_rate * FILTER_CONTEXT_SECONDS)
+        self.samples = 0
+        self.energies = []
+        self.envelope = []
+        self._history = np.zeros((0, channels), dtype=np.float32)
+        self._responses = {}
+
+    def _response(self, length):
+        response = self._responses.get(length)
+        if response is None:
+            frequencies = np.fft.rfftfreq(length, 1.0 / self.sample_rate)
+            response = self._responses[length] = k_weighting(frequencies, self.sample_rate)
+        return response
+
+    def add(self, block):
+        """Analyse a (samples, channels) block; all but the last block must be whole steps"""
+        self.samples += len(block)
+        magnitudes = np.abs(block).max(axis=1)
+        pad = -len(magnitudes) % self.peak_hop
+        if pad:
+            magnitudes = np.concatenate((magnitudes, np.zeros(pad, dtype=magnitudes.dtype)))
+        self.envelope.append(magnitudes.reshape(-1, self.peak_hop).max(axis=1))
+
+        steps = len(block) // self.step
+        if steps:
+            signal = np.concatenate((self._history, block[:steps * self.step])).astype(np.float64)
+            # Zero padding past the end keeps the circular convolution from wrapping around
+            length = len(signal) + self.context
+            spectrum = np.fft.rfft(signal, n=length, axis=0) * self._response(length)[:, None]
+            filtered = np.fft.irfft(spectrum, n=length, axis=0)[len(self._history):len(signal)]
+            self.energies.append((filtered * filtered).reshape(steps, self.step, self.channels).sum(axis=1))
+        self._history = block[max(0, len(block) - self.context):]
+
+    def loudness(self):
+        """Gated integrated loudness in LUFS, per BS.1770-4"""
+        if not self.energies:
+            return float("-inf")
+        steps = np.concatenate(self.energies)
+        if len(steps) < 4:
+            return float("-inf")
+        # Overlapping 400 ms blocks, one every 100 ms; all channels weighted 1.0 (no surround)
+        blocks = (steps[:-3] + steps[1:-2] + steps[2:-1] + steps[3:]).sum(axis=1) / (4 * self.step)
+        with np.errstate(divide="ignore"):
+            block_loudness = -0.691 + 10 * np.log10(blocks)
+        gated = blocks[block_loudness > ABSOLUTE_GATE]
+        if not len(gated):
+            return float("-inf")
+        threshold = -0.691 + 10 * math.log10(gated.mean()) + RELATIVE_GATE
+        gated = blocks[(block_loudness > ABSOLUTE_GATE) & (block_loudness > threshold)]
+        return float(-0.691 + 10 * math.log10(gated.mean()))
+
+    def waveform(self, points=WAVEFORM_POINTS):
+        """Downsample the peak envelope to at most points values, scaled so the loudest is 255"""
+        envelope = np.concatenate(self.envelope) if self.envelope else np.zeros(0, dtype=np.float32)
+        if len(envelope) > points:
+            edges = np.linspace(0, len(envelope), points + 1).astype(np.int64)
+            envelope = np.maximum.reduceat(envelope, edges[:-1])
+        # Relative to the track's own peak: decoded masters often overshoot full scale
+        top = float(envelope.max()) if len(envelope) else 0.0
+        if top > 0:
+            envelope = envelope * (255 / top)
+        return np.clip(np.rint(envelope), 0, 255).astype(np.uint8).tobytes()
+
+def analyze_track(path, points=WAVEFORM_POINTS):
+    """Decode a track and analyse it; raises OSError or ValueError if it can't be decoded"""
+    st = os.stat(path)
+    process = subprocess.Popen(decode_command(path), stdin=subprocess.DEVNULL,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    timer = threading.Timer(DECODE_TIMEOUT, process.kill)
+    timer.start()
+    try:
+        channels, sample_rate = read_wav_header(process.stdout)
+        acc = _Accumulator(channels, sample_rate)
+        frame_bytes = 4 * channels
+        block_bytes = acc.step * max(1, int(BLOCK_SECONDS * sample_rate) // acc.step) * frame_bytes
+        peak = 0.0
+        while True:
+            data = process.stdout.read(block_bytes)
+            usable = len(data) - len(data) % frame_bytes
+            if usable:
+                block = np.frombuffer(data[:usable], dtype="<f4").reshape(-1, channels)
+                peak = max(peak, float(np.abs(block).max()))
+                acc.add(block)
+            if len(data) < block_bytes:
+                break
+        error = process.stderr.read()
+        if process.wait() != 0:
+            raise ValueError(error.decode(errors="replace").strip() or f"ffmpeg exited with {process.returncode}")
+    finally:
+        timer.cancel()
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        process.stdout.close()
+        process.stderr.close()
+
+    loudness = acc.loudness()
+    gain = REPLAYGAIN_REFERENCE - loudness if math.isfinite(loudness) else 0.0
+    return TrackAnalysis(st.st_size, st.st_mtime_ns, sample_rate, channels, acc.samples / sample_rate,
+                         loudness, gain, peak, acc.waveform(points))
+
+def analyze_to_cache(path, cache_dir, points=WAVEFORM_POINTS):
+    """Analyse one track into its sidecar file (runs in a worker process); returns a summary"""
+    started = time.time()
+    analysis = analyze_track(path, points)
+    write_analysis(analysis_cache_path(cache_dir, path), analysis)
+    return {"duration": analysis.duration, "loudness": analysis.loudness,
+            "gain": analysis.gain, "seconds": time.time() - started}
+
+class LibraryAnalyzer:
+    """Keeps an analysis sidecar for every catalog track and serves them from memory.
+
+    analyze_all() hands every track without a current sidecar to a pool of
+    worker processes; start() does that in a background thread whenever
+    the catalog changes. get() never analyses anything itself: until a
+    track has been analysed it returns None. A track found without a
+    sidecar isn't looked for again for poll_interval seconds, since the
+    server asks on every stream and the sidecar may come from another
+    process.
+    """
+    def __init__(self, catalog, cache_dir, workers=2, poll_interval=2.0, points=WAVEFORM_POINTS):
+        self.catalog = catalog
+        self.cache_dir = cache_dir
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.points = points
+        self._loaded = {}  # name -> TrackAnalysis
+        self._missing = {}  # name -> (catalog info, time.monotonic()) of the last look for its sidecar
+        self._lock = threading.Lock()
+        self._thread = None
+        self.analyzed = 0
+        self.failed = 0
+
+    def get(self, name):
+        """Return the TrackAnalysis for a catalog track, or None if it hasn't been analysed yet"""
+        info = self.catalog.info(name)
+        if info is None:
+            return None
+        analysis = self._loaded.get(name)
+        if analysis is not None and (analysis.size, analysis.mtime_ns) == info:
+            return analysis
+        missing = self._missing.get(name)
+        if missing is not None and missing[0] == info and time.monotonic() - missing[1] < self.poll_interval:
+            return None
+        path = self.catalog.path(name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            st = None
+        analysis = read_analysis(analysis_cache_path(self.cache_dir, path), st) if st is not None else None
+        with self._lock:
+            if analysis is not None:
+                self._loaded[name] = analysis
+                self._missing.pop(name, None)
+            else:
+                self._missing[name] = (info, time.monotonic())
+        return analysis
+
+    def pending(self, force=False):
+        """Return the names of catalog tracks whose sidecar is missing or stale"""
+        return [name for name in self.catalog.songs() if force or self.get(name) is None]
+
+    def analyze_all(self, force=False, verbose=False):
+        """Analyse every track that needs it in worker processes; returns the number analysed"""
+        names = self.pending(force)
+        if not names:
+            return 0
+        done = 0
+        # Spawned rather than forked: the server calling this runs other threads
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=context) as pool:
+            futures = {pool.submit(analyze_to_cache, self.catalog.path(name), self.cache_dir, self.points): name
+                       for name in names}
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    summary = future.result()
+                except Exception as e:
+                    self.failed += 1
+                    print(f"Error analysing {name}: {e}")
+                    continue
+                done += 1
+                self.analyzed += 1
+                self._missing.pop(name, None)
+                if verbose:
+                    loudness = f"{summary['loudness']:.1f} LUFS" if math.isfinite(summary["loudness"]) else "silent"
+                    print(f"[{done}/{len(names)}] {name}: {summary['duration']:.2f}s, {loudness}, "
+                          f"gain {summary['gain']:+.2f} dB ({summary['seconds']:.1f}s)")
+        return done
+
+    def start(self):
+        """Analyse the library in the background and keep up with catalog changes"""
+        if self._thread is not None or not analysis_available():
+            return
+        def run():
+            generation = None
+            while True:
+                if self.catalog.generation != generation:
+                    generation = self.catalog.generation
+                    try:
+                        started = time.time()
+                        count = self.analyze_all()
+                        if count:
+                            print(f"Analysed {count} songs in {time.time() - started:.1f}s")
+                    except Exception as e:
+                        print(f"Error analysing music library: {e}")
+                time.sleep(self.poll_interval)
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+
+    def after_fork(self):
+        """Reset state inherited from the parent process; analysis stays with the parent"""
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def stats(self):
+        """Return analysis counters"""
+        return {
+            "available": analysis_available(),
+            "loaded": len(self._loaded),
+            "analyzed": self.analyzed,
+            "failed": self.failed,
+        }
+
+def main():
+    from catalog import MusicCatalog
+
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Analyse the ByteBeats music library (duration, loudness, waveform)")
+    parser.add_argument("--music-dir", default=os.path.join(os.path.dirname(base_dir), "music"),
+                        help="Music library to analyse")
+    parser.add_argument("--cache-dir", default=os.path.join(base_dir, "cache", "analysis"),
+                        help="Directory for the analysis sidecar files")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2,
+                        help="Number of tracks analysed in parallel")
+    parser.add_argument("--points", type=int, default=WAVEFORM_POINTS,
+                        help="Waveform peaks stored per track")
+    parser.add_argument("--force", action="store_true", help="Reanalyse tracks that are up to date")
+    args = parser.parse_args()
+
+    if np is None:
+        raise SystemExit("NumPy is required: pip install numpy")
+    if not analysis_available():
+        raise SystemExit("ffmpeg and ffmpeg-python are required to decode tracks")
+    catalog = MusicCatalog(args.music_dir)
+    catalog.refresh()
+    analyzer = LibraryAnalyzer(catalog, args.cache_dir, max(1, args.workers), points=max(1, args.points))
+    started = time.time()
+    count = analyzer.analyze_all(force=args.force, verbose=True)
+    print(f"Analysed {count} of {len(catalog)} songs in {time.time() - started:.1f}s"
+          + (f", {analyzer.failed} failed" if analyzer.failed else ""))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+import bisect
+import threading
+import time
+
+# Broadcast defaults (overridden from server.py)
+DEFAULT_RING_CHUNKS = 64           # Chunks a channel keeps for listeners that fall behind
+DEFAULT_JOIN_BURST_SECONDS = 5.0   # Audio a new listener gets at once, to fill its player's buffer
+DEFAULT_BITRATE = 128000           # Bits/s assumed when a track's bitrate is unknown
+
+class ChannelTrack:
+    """One song as played on a channel"""
+    def __init__(self, name, metadata):
+        self.name = name
+        self.metadata = metadata  # SONG_METADATA for the whole track
+
+class ChannelChunk:
+    """One pre-framed chunk in a channel's ring, ending on an MPEG frame boundary"""
+    def __init__(self, seq, track, offset, start_time, duration, entry):
+        self.seq = seq
+        self.track = track
+        self.offset = offset          # Byte offset in the track
+        self.start_time = start_time  # Seconds into the track
+        self.duration = duration
+        self.entry = entry            # (frame, header_length), like a chunk cache entry
+
+class BroadcastChannel:
+    """A radio station: one producer thread reads, frames and paces each
+    track once, in real time, into a ring of chunks that every listener
+    sends from.
+
+    The producer runs join_burst_seconds ahead of the music, and listeners
+    start that far behind the live head: they all hear the same moment,
+    and get a few seconds at once to fill their players' buffers. A
+    listener that falls so far behind that the ring has moved past it is
+    skipped forward instead of holding the channel back; chunks end on
+    MPEG frame boundaries, so players resync straight away. When a track
+    ends the channel plays the next one.
+    """
+    def __init__(self, name, song, open_track, next_song, encode, chunk_size,
+                 ring_chunks=DEFAULT_RING_CHUNKS, join_burst_seconds=DEFAULT_JOIN_BURST_SECONDS):
+        self.name = name
+        self.open_track = open_track  # song -> (path, size, bitrate, TrackIndex or None, SONG_METADATA)
+        self.next_song = next_song    # song -> the song to play after it, or None
+        self.encode = encode          # payload -> (frame, header_length)
+        self.chunk_size = chunk_size
+        self.ring_chunks = ring_chunks
+        self.join_burst_seconds = join_burst_seconds
+        self.track = ChannelTrack(song, None)
+        self.listeners = 0
+        self.closed = False
+        self.error = None
+        self.next_chunk_at = time.monotonic()  # When the producer publishes its next chunk
+        self.chunks_published = 0
+        self.bytes_read = 0
+        self.skips = 0
+        self._ring = [None] * ring_chunks
+        self._head = 0  # Sequence number of the next chunk
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _publish(self, track, offset, start_time, duration, payload):
+        with self._lock:
+            chunk = ChannelChunk(self._head, track, offset, start_time, duration, self.encode(payload))
+            self._ring[self._head % self.ring_chunks] = chunk
+            self._head += 1
+        self.chunks_published += 1
+        self.bytes_read += len(payload)
+
+    def _run(self):
+        song = self.track.name
+        playing_at = time.monotonic()  # When the next track starts playing, so tracks follow on seamlessly
+        try:
+            while song is not None and not self._stop.is_set():
+                path, size, bitrate, index, metadata = self.open_track(song)
+                bitrate = bitrate or DEFAULT_BITRATE
+                track = self.track = ChannelTrack(song, metadata)
+                print(f"Channel {self.name}: playing {song}")
+                started = max(playing_at, time.monotonic() - self.join_burst_seconds)
+                offset = 0
+                with open(path, "rb") as f:
+                    while offset < size:
+                        end, start_time, duration = self._chunk_bounds(index, offset, size, bitrate)
+                        payload = f.read(end - offset)
+                        if not payload:
+                            break
+                        self._publish(track, offset, start_time, duration, payload)
+                        offset += len(payload)
+                        playing_at = started + start_time + duration
+                        # Stay join_burst_seconds ahead of what is playing
+                        self.next_chunk_at = playing_at - self.join_burst_seconds
+                        if self._stop.wait(max(0.0, self.next_chunk_at - time.monotonic())):
+                            return
+                song = self.next_song(song)
+        except Exception as e:
+            print(f"Channel {self.name} stopped: {e}")
+            self.error = str(e)
+        finally:
+            self.closed = True
+
+    def _chunk_bounds(self, index, offset, size, bitrate):
+        """Return (end offset, start time, duration) of the chunk at offset, cut at a frame boundary"""
+        if index is None or not len(index.offsets):
+            end = min(offset + self.chunk_size, size)
+            return end, offset * 8 / bitrate, (end - offset) * 8 / bitrate
+        offsets = index.offsets
+        first = bisect.bisect_left(offsets, offset)
+        if size - offset <= self.chunk_size:
+            end, last = size, len(offsets)
+        elif first == len(offsets) or offsets[first] > offset + self.chunk_size:
+            end, last = offset + self.chunk_size, first  # Tags before or after the audio
+        else:
+            # Up to the last frame that starts within a chunk (at least one frame)
+            last = max(first + 1, bisect.bisect_right(offsets, offset + self.chunk_size) - 1)
+            end = offsets[last] if last < len(offsets) else size
+        return end, first * index.frame_duration, (last - first) * index.frame_duration
+
+    def join_position(self):
+        """Sequence number a new listener starts from: join_burst_seconds behind the head, in the current track"""
+        with self._lock:
+            seq = self._head
+            buffered = 0.0
+            while seq > self._head - self.ring_chunks and seq > 0 and buffered < self.join_burst_seconds:
+                chunk = self._ring[(seq - 1) % self.ring_chunks]
+                if chunk.track is not self.track:
+                    break
+                buffered += chunk.duration
+                seq -= 1
+            return seq
+
+    def chunk(self, seq):
+        """Return the chunk with this sequence number; None if it isn't published yet, False if overwritten"""
+        with self._lock:
+            if seq >= self._head:
+                return None
+            if seq < self._head - self.ring_chunks:
+                return False
+            return self._ring[seq % self.ring_chunks]
+
+    def stats(self):
+        return {
+            "song": self.track.name,
+            "listeners": self.listeners,
+            "chunks_published": self.chunks_published,
+            "bytes_read": self.bytes_read,
+            "skips": self.skips,
+            "error": self.error,
+        }
+
+class ChannelSubscription:
+    """One listener's place in a channel.
+
+    next_message() turns the ring into the messages a client gets for each
+    song, as if it had been played with PLAY_SONG: SONG_PLAYING and
+    SONG_METADATA when a track starts (or where the listener joined it),
+    its audio chunks, and SONG_ENDED.
+    """
+    def __init__(self, broadcaster, channel):
+        self.broadcaster = broadcaster
+        self.channel = channel
+        self.cursor = channel.join_position()
+        self.track = None
+        self.error_sent = False
+        self.skips = 0
+        self.bytes_sent = 0
+        self._pending = []
+
+    def _start_track(self, chunk):
+        if self.track is not None:
+            self._pending.append({"type": "SONG_ENDED"})
+        self._pending.append({"type": "SONG_PLAYING", "name": chunk.track.name, "channel": self.channel.name})
+        self._pending.append(dict(chunk.track.metadata, channel=self.channel.name,
+                                  start_offset=chunk.offset, start_time=round(chunk.start_time, 3)))
+        self.track = chunk.track
+
+    def next_message(self):
+        """Return (message, None), (chunk, None) or (None, seconds to wait; None once the channel has ended)"""
+        if self._pending:
+            return self._pending.pop(0), None
+        channel = self.channel
+        chunk = channel.chunk(self.cursor)
+        if chunk is False:
+            # Lapped by the producer: rejoin near the head rather than slow everyone down
+            self.cursor = channel.join_position()
+            self.skips += 1
+            channel.skips += 1
+            chunk = channel.chunk(self.cursor)
+        if not chunk:
+            if channel.closed:
+                if self.track is not None:
+                    self.track = None
+                    return {"type": "SONG_ENDED"}, None
+                if channel.error and not self.error_sent:
+                    self.error_sent = True
+                    return {"type": "STREAM_ERROR", "error": channel.error}, None
+                return None, None
+            return None, max(0.0, channel.next_chunk_at - time.monotonic())
+        if chunk.track is not self.track:
+            self._start_track(chunk)
+            return self._pending.pop(0), None
+        self.cursor += 1
+        self.bytes_sent += len(chunk.entry[0]) - chunk.entry[1]
+        return chunk, None
+
+    def close(self):
+        self.broadcaster.leave(self.channel)
+
+class Broadcaster:
+    """The broadcast channels of this process, started by their first
+    listener and stopped when the last one leaves.
+
+    Disk reads and framing cost the same for one listener as for a
+    hundred. Each worker process runs its own channels.
+    """
+    def __init__(self, open_track, next_song, encode, chunk_size,
+                 ring_chunks=DEFAULT_RING_CHUNKS, join_burst_seconds=DEFAULT_JOIN_BURST_SECONDS):
+        self.open_track = open_track
+        self.next_song = next_song
+        self.encode = encode
+        self.chunk_size = chunk_size
+        self.ring_chunks = ring_chunks
+        self.join_burst_seconds = join_burst_seconds
+        self._channels = {}
+        self._lock = threading.Lock()
+
+    def current_song(self, name):
+        """The song a channel is playing, or None if it isn't running"""
+        channel = self._channels.get(name)
+        return channel.track.name if channel is not None else None
+
+    def join(self, name, song):
+        """Subscribe to a channel, starting it with song if it isn't running"""
+        with self._lock:
+            channel = self._channels.get(name)
+            if channel is None or channel.closed:
+                channel = BroadcastChannel(name, song, self.open_track, self.next_song, self.encode,
+                                           self.chunk_size, self.ring_chunks, self.join_burst_seconds)
+                self._channels[name] = channel
+                channel.start()
+            channel.listeners += 1
+            return ChannelSubscription(self, channel)
+
+    def leave(self, channel):
+        with self._lock:
+            channel.listeners -= 1
+            if channel.listeners <= 0:
+                channel.stop()
+                if self._channels.get(channel.name) is channel:
+                    del self._channels[channel.name]
+
+    def after_fork(self):
+        """Forget the parent's channels; their producer threads don't survive the fork"""
+        self._channels = {}
+        self._lock = threading.Lock()
+
+    def stats(self):
+        with self._lock:
+            return {name: channel.stats() for name, channel in self._channels.items()}
@@ -0,0 +1,282 @@
+import bisect
+import os
+import sqlite3
+import threading
+import time
+
+SNAPSHOT_VERSION = 1
+
+class MusicCatalog:
+    """In-memory index of the music library.
+
+    Tracks are keyed by their path relative to the music directory (using
+    "/" separators), so lookups are a dict access. Subdirectories are
+    scanned recursively. A refresh stats each directory: a directory is
+    listed again only when its mtime changed, which covers added, removed
+    and renamed files. The tracks of the other directories are stat'ed
+    one by one, since a file overwritten in place leaves its directory's
+    mtime alone. The index is persisted to a SQLite snapshot,
+    so a restart reloads it and only rescans what changed since then.
+    """
+    def __init__(self, root, snapshot_path=None, poll_interval=2.0, extensions=(".mp3",)):
+        self.root = root
+        self.snapshot_path = snapshot_path
+        self.poll_interval = poll_interval
+        self.extensions = tuple(extensions)
+        self.generation = 0  # Bumped whenever the set of tracks changes
+        self._lock = threading.RLock()
+        self._tracks = {}    # name -> (size, mtime_ns)
+        self._dirs = {}      # relative dir -> (mtime_ns, subdirs, track names)
+        self._sorted = None
+        self._scanned = False
+        self._poller = None
+
+    def __contains__(self, name):
+        self._ensure_scanned()
+        return name in self._tracks
+
+    def __len__(self):
+        self._ensure_scanned()
+        return len(self._tracks)
+
+    def songs(self):
+        """Return all track names, sorted"""
+        self._ensure_scanned()
+        with self._lock:
+            if self._sorted is None:
+                self._sorted = sorted(self._tracks)
+            return self._sorted
+
+    def page(self, cursor=None, limit=100):
+        """Return (names, next cursor) for up to limit tracks sorted after cursor.
+
+        The cursor is the last name of the previous page, so paging stays
+        consistent while tracks are added or removed. The next cursor is
+        None on the last page.
+        """
+        songs = self.songs()
+        start = bisect.bisect_right(songs, cursor) if cursor else 0
+        names = songs[start:start + limit]
+        return names, (names[-1] if start + limit < len(songs) else None)
+
+    def path(self, name):
+        """Return the absolute path of a track, or None if it isn't in the catalog"""
+        self._ensure_scanned()
+        if name not in self._tracks:
+            return None
+        return os.path.join(self.root, *name.split("/"))
+
+    def info(self, name):
+        """Return (size, mtime_ns) for a track, or None"""
+        self._ensure_scanned()
+        return self._tracks.get(name)
+
+    def _ensure_scanned(self):
+        if not self._scanned:
+            self.refresh()
+
+    def refresh(self):
+        """Rescan changed directories and re-stat the tracks of the rest; returns True if any track changed"""
+        with self._lock:
+            changed_dirs = set()
+            removed_dirs = set()
+            seen_dirs = set()
+            self._scan_dir("", changed_dirs, seen_dirs)
+            for rel_dir in set(self._dirs) - seen_dirs:
+                self._drop_dir(rel_dir)
+                removed_dirs.add(rel_dir)
+            self._scanned = True
+            unchanged = [(name, self._tracks.get(name)) for rel_dir, known in self._dirs.items()
+                         if rel_dir not in changed_dirs for name in known[2]]
+
+        # Without the lock, so lookups aren't held up by a stat per track
+        rewritten = {}
+        for name, info in unchanged:
+            try:
+                st = os.stat(os.path.join(self.root, *name.split("/")))
+            except OSError:
+                continue  # Removed: its directory's mtime has changed, and the next refresh lists it
+            if (st.st_size, st.st_mtime_ns) != info:
+                rewritten[name] = (st.st_size, st.st_mtime_ns)
+
+        with self._lock:
+            for name, info in rewritten.items():
+                if name in self._tracks:
+                    self._tracks[name] = info
+                    changed_dirs.add(name.rsplit("/", 1)[0] if "/" in name else "")
+            if changed_dirs or removed_dirs:
+                self.generation += 1
+                self._sorted = None
+        if (changed_dirs or removed_dirs) and self.snapshot_path:
+            self.save_snapshot(changed_dirs, removed_dirs)
+        return bool(changed_dirs or removed_dirs)
+
+    def _scan_dir(self, rel_dir, changed_dirs, seen_dirs):
+        abs_dir = os.path.join(self.root, *rel_dir.split("/")) if rel_dir else self.root
+        try:
+            mtime_ns = os.stat(abs_dir).st_mtime_ns
+        except OSError:
+            return
+        seen_dirs.add(rel_dir)
+
+        known = self._dirs.get(rel_dir)
+        if known and known[0] == mtime_ns:
+            subdirs = known[1]
+        else:
+            subdirs = self._list_dir(rel_dir, abs_dir, mtime_ns)
+            changed_dirs.add(rel_dir)
+
+        for subdir in subdirs:
+            self._scan_dir(subdir, changed_dirs, seen_dirs)
+
+    def _list_dir(self, rel_dir, abs_dir, mtime_ns):
+        """List one directory and replace its tracks in the index"""
+        subdirs = []
+        names = []
+        try:
+            with os.scandir(abs_dir) as entries:
+                for entry in entries:
+                    rel_name = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+                    try:
+                        if entry.is_dir():
+                            subdirs.append(rel_name)
+                        elif entry.name.lower().endswith(self.extensions):
+                            st = entry.stat()
+                            self._tracks[rel_name] = (st.st_size, st.st_mtime_ns)
+                            names.append(rel_name)
+                    except OSError:
+                        continue
+        except OSError as e:
+            print(f"Error scanning {abs_dir}: {e}")
+
+        known = self._dirs.get(rel_dir)
+        if known:
+            for name in set(known[2]) - set(names):
+                self._tracks.pop(name, None)
+        self._dirs[rel_dir] = (mtime_ns, subdirs, names)
+        return subdirs
+
+    def _drop_dir(self, rel_dir):
+        known = self._dirs.pop(rel_dir, None)
+        if known:
+            for name in known[2]:
+                self._tracks.pop(name, None)
+
+    def start_polling(self):
+        """Refresh the catalog in a background thread every poll_interval seconds"""
+        if self._poller is not None:
+            return
+        def poll():
+            while True:
+                time.sleep(self.poll_interval)
+                try:
+                    if self.refresh():
+                        print(f"Music catalog updated: {len(self._tracks)} songs")
+                except Exception as e:
+                    print(f"Error refreshing music catalog: {e}")
+        self._poller = threading.Thread(target=poll, daemon=True)
+        self._poller.start()
+
+    def follow_snapshot(self):
+        """Reload the snapshot whenever another process rewrites it, instead of scanning.
+
+        Used by worker processes, where the supervisor owns the scan and the
+        snapshot; the catalog is never written from here.
+        """
+        if self._poller is not None or not self.snapshot_path:
+            return
+        # A lock held by one of the parent's threads at fork time would never be released
+        self._lock = threading.RLock()
+        self._scanned = True
+        def poll():
+            try:
+                loaded = os.stat(self.snapshot_path).st_mtime_ns
+            except OSError:
+                loaded = None
+            while True:
+                time.sleep(self.poll_interval)
+                try:
+                    mtime_ns = os.stat(self.snapshot_path).st_mtime_ns
+                except OSError:
+                    continue
+                if mtime_ns != loaded and self.load_snapshot():
+                    loaded = mtime_ns
+        self._poller = threading.Thread(target=poll, daemon=True)
+        self._poller.start()
+
+    def _connect(self):
+        db = sqlite3.connect(self.snapshot_path)
+        db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        db.execute("CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, mtime_ns INTEGER)")
+        db.execute("CREATE TABLE IF NOT EXISTS tracks (name TEXT PRIMARY KEY, dir TEXT, size INTEGER, mtime_ns INTEGER)")
+        db.execute("CREATE INDEX IF NOT EXISTS tracks_dir ON tracks (dir)")
+        return db
+
+    def load_snapshot(self):
+        """Load the persisted index; returns False if there is no usable snapshot"""
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return False
+        try:
+            db = self._connect()
+            try:
+                meta = dict(db.execute("SELECT key, value FROM meta"))
+                if meta.get("version") != str(SNAPSHOT_VERSION) or meta.get("root") != self.root:
+                    return False
+                dir_mtimes = dict(db.execute("SELECT path, mtime_ns FROM dirs"))
+                tracks = {}
+                dir_tracks = {path: [] for path in dir_mtimes}
+                for name, rel_dir, size, mtime_ns in db.execute("SELECT name, dir, size, mtime_ns FROM tracks"):
+                    tracks[name] = (size, mtime_ns)
+                    dir_tracks.setdefault(rel_dir, []).append(name)
+            finally:
+                db.close()
+        except sqlite3.Error as e:
+            print(f"Error loading catalog snapshot: {e}")
+            return False
+
+        # Rebuild the directory tree from the flat list of paths
+        subdirs = {path: [] for path in dir_mtimes}
+        for path in dir_mtimes:
+            if path:
+                parent = path.rsplit("/", 1)[0] if "/" in path else ""
+                subdirs.setdefault(parent, []).append(path)
+
+        with self._lock:
+            self._tracks = tracks
+            self._dirs = {
+                path: (mtime_ns, subdirs.get(path, []), dir_tracks.get(path, []))
+                for path, mtime_ns in dir_mtimes.items()
+            }
+            self._sorted = None
+            self.generation += 1
+        return True
+
+    def save_snapshot(self, changed_dirs=None, removed_dirs=()):
+        """Write changed directories to the snapshot (all of them if changed_dirs is None)"""
+        with self._lock:
+            if changed_dirs is None:
+                changed_dirs = set(self._dirs)
+            rows = {
+                rel_dir: (self._dirs[rel_dir][0], [(name,) + self._tracks[name] for name in self._dirs[rel_dir][2]])
+                for rel_dir in changed_dirs if rel_dir in self._dirs
+            }
+        try:
+            db = self._connect()
+            try:
+                with db:
+                    db.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (str(SNAPSHOT_VERSION),))
+                    db.execute("INSERT OR REPLACE INTO meta VALUES ('root', ?)", (self.root,))
+                    for rel_dir in removed_dirs:
+                        db.execute("DELETE FROM dirs WHERE path = ?", (rel_dir,))
+                        db.execute("DELETE FROM tracks WHERE dir = ?", (rel_dir,))
+                    for rel_dir, (mtime_ns, tracks) in rows.items():
+                        db.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?)", (rel_dir, mtime_ns))
+                        db.execute("DELETE FROM tracks WHERE dir = ?", (rel_dir,))
+                        db.executemany(
+                            "INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?)",
+                            [(name, rel_dir, size, mtime_ns) for name, size, mtime_ns in tracks]
+                        )
+            finally:
+                db.close()
+        except sqlite3.Error as e:
+            print(f"Error saving catalog snapshot: {e}")
@@ -0,0 +1,124 @@
+import threading
+from collections import OrderedDict
+
+class TrackReader:
+    """Opens a track lazily, so streams served entirely from the cache never touch the disk"""
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    @property
+    def file(self):
+        if self._file is None:
+            self._file = open(self.path, "rb")
+        return self._file
+
+    def read(self, offset, length):
+        self.file.seek(offset)
+        return self.file.read(length)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class ChunkCache:
+    """Process-wide LRU cache of pre-framed audio chunks, bounded by a byte budget.
+
+    Entries are keyed by (path, size, mtime_ns, chunk number), so a file
+    that changes on disk simply stops hitting. Each entry is the complete
+    binary WebSocket frame for one chunk, and every connection can send it
+    as is. When several streams miss on the same chunk at once, one of
+    them reads it and the others wait for that read.
+    """
+    def __init__(self, budget_bytes, chunk_size, encode):
+        self.budget_bytes = budget_bytes
+        self.chunk_size = chunk_size
+        self.encode = encode  # payload -> (frame, header_length)
+        self._entries = OrderedDict()  # key -> (frame, header_length)
+        self._in_flight = {}           # key -> threading.Event
+        self._lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.collapsed = 0
+        self.evictions = 0
+
+    def lookup(self, key):
+        """Return a cached (frame, header_length) without blocking, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            return entry
+
+    def get(self, path, size, mtime_ns, chunk_number, read):
+        """Return (frame, header_length) for a chunk, calling read(offset, length) on a miss.
+
+        An empty payload (past the end of the file) is returned but not cached.
+        """
+        key = (path, size, mtime_ns, chunk_number)
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry
+                pending = self._in_flight.get(key)
+                if pending is None:
+                    pending = self._in_flight[key] = threading.Event()
+                    self.misses += 1
+                    break
+                self.collapsed += 1
+            # Another stream is already reading this chunk
+            pending.wait()
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    return entry
+            # Not cached after all (too big for the budget, or a failed read): read it ourselves
+
+        try:
+            entry = self.encode(read(chunk_number * self.chunk_size, self.chunk_size))
+            if len(entry[0]) > entry[1]:
+                self._store(key, entry)
+            return entry
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            pending.set()
+
+    def _store(self, key, entry):
+        entry_size = len(entry[0])
+        if entry_size > self.budget_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = entry
+            self.size += entry_size
+            while self.size > self.budget_bytes:
+                _, (frame, _) = self._entries.popitem(last=False)
+                self.size -= len(frame)
+                self.evictions += 1
+
+    def stats(self):
+        """Return hit/miss/eviction counters and current usage"""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "collapsed": self.collapsed,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self.size,
+                "budget_bytes": self.budget_bytes,
+            }
@@ -0,0 +1,318 @@
+import cProfile
+import itertools
+import json
+import os
+import pstats
+import random
+import re
+import sys
+import threading
+import time
+import tracemalloc
+
+DEFAULT_SAMPLE_INTERVAL = 0.005  # Seconds between stack samples of the sampling profiler
+DEFAULT_HEAP_FRAMES = 10         # Frames of traceback tracemalloc keeps per allocation
+DEFAULT_TRACE_SAMPLE_RATE = 0.1  # Share of connections traced
+
+_THREAD_NUMBER = re.compile(r"^Thread-\d+ ")
+
+class SamplingProfiler:
+    """Samples the stack of every thread at a fixed interval.
+
+    Cheap enough to leave running under real traffic, and sees every
+    thread (each connection's, in the threaded engine). Stacks are counted
+    in the "folded" format of flamegraph.pl and speedscope: one line per
+    distinct stack, thread name first, with its number of samples.
+    """
+    def __init__(self, interval=DEFAULT_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.samples = 0
+        self._stacks = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            # Connection threads are numbered; group them by what they run instead
+            names = {thread.ident: _THREAD_NUMBER.sub("", thread.name) for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                key = ";".join(reversed(stack))
+                self._stacks[key] = self._stacks.get(key, 0) + 1
+            self.samples += 1
+
+    def stop(self, path):
+        """Stop sampling and write the folded stacks to path"""
+        self._stop.set()
+        self._thread.join()
+        with open(path, "w") as f:
+            for stack, count in sorted(self._stacks.items()):
+                f.write(f"{stack} {count}\n")
+
+class CProfileSession:
+    """Deterministic profiling with cProfile.
+
+    cProfile only sees the thread that enables it, so the session profiles
+    the thread that starts it (the event loop, in the asyncio engine) and,
+    with new_threads, every thread started while it runs (connections, in
+    the threaded engine). Those threads stop their own profilers at their
+    next checkpoint() once the session is over. From Python 3.12 one
+    profiler sees every thread, and only one may run at a time.
+    """
+    def __init__(self):
+        self.running = False
+        self._profiles = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def start(self, new_threads=False):
+        self.running = True
+        if new_threads and sys.version_info < (3, 12):
+            threading.setprofile(self._thread_started)
+        self._enable()
+
+    def _thread_started(self, frame, event, arg):
+        # The first profiling event of a new thread; cProfile replaces this hook
+        if self.running:
+            self._enable()
+        else:
+            sys.setprofile(None)
+
+    def _enable(self):
+        profile = cProfile.Profile()
+        with self._lock:
+            self._profiles.append(profile)
+        self._local.profile = profile
+        profile.enable()
+
+    def checkpoint(self):
+        """Stop this thread's profiler if the session has ended; cheap enough to call per chunk"""
+        if not self.running:
+            profile = getattr(self._local, "profile", None)
+            if profile is not None:
+                profile.disable()
+                self._local.profile = None
+
+    def stop(self, path):
+        """End the session and write the combined stats of every profiled thread to path (pstats format)"""
+        self.running = False
+        threading.setprofile(None)
+        self.checkpoint()
+        with self._lock:
+            profiles, self._profiles = self._profiles, []
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        stats.dump_stats(path)
+
+class Trace:
+    """The spans of one sampled connection"""
+    def __init__(self, tracer, trace_id, started):
+        self.tracer = tracer
+        self.trace_id = trace_id
+        self.started = started
+
+    def span(self, name, start, end, **attrs):
+        """Record that name took from start to end (time.monotonic() values)"""
+        self.tracer.write(self.trace_id, name, start, end, attrs)
+
+class Tracer:
+    """Writes spans of a sample of connections (accept, TLS, handshake,
+    auth, catalog, first and last chunk) as JSON lines, one span per line.
+
+    sample() decides at accept time whether a connection is traced; the
+    hooks in the server do nothing for connections that aren't.
+    """
+    def __init__(self):
+        self.sample_rate = 0.0
+        self.path = None
+        self.spans = 0
+        self._file = None
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._clock_offset = time.time() - time.monotonic()  # Turns monotonic times into Unix times
+
+    @property
+    def running(self):
+        return self._file is not None
+
+    def start(self, path, sample_rate=DEFAULT_TRACE_SAMPLE_RATE):
+        self._file = open(path, "w")
+        self.path = path
+        self.spans = 0
+        self.sample_rate = sample_rate
+        self._clock_offset = time.time() - time.monotonic()
+
+    def sample(self, started):
+        """A Trace for a connection accepted at started, or None if it isn't sampled"""
+        if not self.sample_rate or random.random() >= self.sample_rate:
+            return None
+        return Trace(self, f"{os.getpid()}-{next(self._ids)}", started)
+
+    def write(self, trace_id, name, start, end, attrs):
+        record = {"trace": trace_id, "span": name, "start": round(start + self._clock_offset, 6),
+                  "duration": round(end - start, 6)}
+        record.update(attrs)
+        line = json.dumps(record) + "\n"
+        with self._lock:
+            if self._file is not None:
+                self._file.write(line)
+                self.spans += 1
+
+    def stop(self, chrome_path):
+        """Stop tracing and convert the spans to Chrome trace event format (chrome://tracing, Perfetto)"""
+        with self._lock:
+            self.sample_rate = 0.0
+            self._file.close()
+            self._file = None
+        events = []
+        with open(self.path) as f:
+            for line in f:
+                span = json.loads(line)
+                trace_id = span.pop("trace")
+                pid, _, tid = trace_id.partition("-")
+                events.append({
+                    "name": span.pop("span"),
+                    "cat": "bytebeats",
+                    "ph": "X",
+                    "ts": round(span.pop("start") * 1e6),
+                    "dur": round(span.pop("duration") * 1e6),
+                    "pid": int(pid),
+                    "tid": int(tid),
+                    "args": span,
+                })
+        with open(chrome_path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+class Diagnostics:
+    """On-demand profiling, heap snapshots and tracing of this process.
+
+    Results are files in directory, named after their kind, the process
+    id and the time, so workers sharing the directory don't collide.
+    Methods raise ValueError when asked for something that isn't possible
+    right now (e.g. stopping a profiler that isn't running).
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.profiler = None
+        self.profiler_kind = None
+        self.profile_started = None
+        self.tracer = Tracer()
+
+    def _path(self, kind, extension):
+        os.makedirs(self.directory, exist_ok=True)
+        now = time.time()
+        stamp = f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(now))}.{int(now * 1000) % 1000:03d}"
+        return os.path.join(self.directory, f"{kind}-{os.getpid()}-{stamp}.{extension}")
+
+    def start_profile(self, kind="sampling", interval=DEFAULT_SAMPLE_INTERVAL, new_threads=False):
+        if self.profiler is not None:
+            raise ValueError(f"A {self.profiler_kind} profile is already running")
+        if kind == "sampling":
+            profiler = SamplingProfiler(interval)
+            profiler.start()
+        elif kind == "cprofile":
+            profiler = CProfileSession()
+            profiler.start(new_threads)
+        else:
+            raise ValueError(f"Unknown profiler: {kind}")
+        self.profiler, self.profiler_kind, self.profile_started = profiler, kind, time.monotonic()
+
+    def stop_profile(self):
+        """Stop the running profiler; returns the name of its file"""
+        if self.profiler is None:
+            raise ValueError("No profile is running")
+        profiler, kind = self.profiler, self.profiler_kind
+        self.profiler = self.profiler_kind = None
+        path = self._path(kind, "folded" if kind == "sampling" else "prof")
+        profiler.stop(path)
+        return os.path.basename(path)
+
+    def checkpoint(self):
+        """Called by connection threads between chunks, so cProfile stops in them after a session"""
+        profiler = self.profiler
+        if isinstance(profiler, CProfileSession):
+            profiler.checkpoint()
+
+    def start_heap(self, frames=DEFAULT_HEAP_FRAMES):
+        if tracemalloc.is_tracing():
+            raise ValueError("Allocations are already being traced")
+        tracemalloc.start(frames)
+
+    def heap_snapshot(self, limit=10):
+        """Dump a tracemalloc snapshot; returns (file name, the top allocation sites by size)"""
+        if not tracemalloc.is_tracing():
+            raise ValueError("Allocation tracing isn't running; start it first")
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ])
+        path = self._path("heap", "tracemalloc")
+        snapshot.dump(path)
+        top = [{"location": str(stat.traceback[0]), "size": stat.size, "count": stat.count}
+               for stat in snapshot.statistics("lineno")[:limit]]
+        return os.path.basename(path), top
+
+    def stop_heap(self):
+        if not tracemalloc.is_tracing():
+            raise ValueError("Allocation tracing isn't running")
+        tracemalloc.stop()
+
+    def start_trace(self, sample_rate=DEFAULT_TRACE_SAMPLE_RATE):
+        if self.tracer.running:
+            raise ValueError("Tracing is already running")
+        if not 0 < sample_rate <= 1:
+            raise ValueError("Sample rate must be above 0 and at most 1")
+        self.tracer.start(self._path("trace", "jsonl"), sample_rate)
+
+    def stop_trace(self):
+        """Stop tracing; returns the names of the JSON lines and Chrome trace files"""
+        if not self.tracer.running:
+            raise ValueError("Tracing isn't running")
+        chrome_path = self.tracer.path[:-len(".jsonl")] + ".trace.json"
+        self.tracer.stop(chrome_path)
+        return [os.path.basename(self.tracer.path), os.path.basename(chrome_path)]
+
+    def files(self):
+        """Result files in the directory, newest first: [{"name", "size"}]"""
+        try:
+            entries = [entry for entry in os.scandir(self.directory) if entry.is_file()]
+        except FileNotFoundError:
+            return []
+        entries.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+        return [{"name": entry.name, "size": entry.stat().st_size} for entry in entries]
+
+    def file_path(self, name):
+        """Path of a result file, or None if there is no such file (or the name tries to leave the directory)"""
+        if not name or name != os.path.basename(name) or name.startswith("."):
+            return None
+        path = os.path.join(self.directory, name)
+        return path if os.path.isfile(path) else None
+
+    def status(self):
+        return {
+            "pid": os.getpid(),
+            "profile": self.profiler_kind,
+            "profile_seconds": round(time.monotonic() - self.profile_started, 1) if self.profiler else None,
+            "heap_tracing": tracemalloc.is_tracing(),
+            "trace_sample_rate": self.tracer.sample_rate if self.tracer.running else None,
+            "trace_spans": self.tracer.spans if self.tracer.running else None,
+        }
+
+    def after_fork(self):
+        """Forget the parent's profiler and trace file; their threads and file handles aren't ours"""
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self.__init__(self.directory)
@@ -3,15 +3,34 @@ import os
 from OpenSSL import crypto
 from datetime import datetime, timedelta
 
-def generate_self_signed_cert(cert_dir):
+KEY_TYPES = ("rsa", "ecdsa")
+
+def cert_paths(cert_dir, key_type="rsa"):
+    """Return (key_path, cert_path); ECDSA certificates are kept next to the RSA ones"""
+    name = "server" if key_type == "rsa" else f"server-{key_type}"
+    return os.path.join(cert_dir, f"{name}.key"), os.path.join(cert_dir, f"{name}.crt")
+
+def generate_key(key_type="rsa"):
+    """Generate an RSA-2048 or ECDSA P-256 key pair"""
+    if key_type == "ecdsa":
+        # P-256 handshakes are several times cheaper for the server than RSA-2048;
+        # pyOpenSSL can't generate EC keys itself, so use cryptography (one of its dependencies)
+        from cryptography.hazmat.primitives.asymmetric import ec
+        return crypto.PKey.from_cryptography_key(ec.generate_private_key(ec.SECP256R1()))
+    if key_type != "rsa":
+        raise ValueError(f"Unsupported key type: {key_type}")
+    k = crypto.PKey()
+    k.generate_key(crypto.TYPE_RSA, 2048)
+    return k
+
+def generate_self_signed_cert(cert_dir, key_type="rsa"):
     """Generate a self-signed certificate for development purposes"""
     
     # Create directory if it doesn't exist
     if not os.path.exists(cert_dir):
         os.makedirs(cert_dir)
         
-    key_path = os.path.join(cert_dir, "server.key")
-    cert_path = os.path.join(cert_dir, "server.crt")
+    key_path, cert_path = cert_paths(cert_dir, key_type)
     
     # Check if certificates already exist
     if os.path.exists(key_path) and os.path.exists(cert_path):
@@ -19,8 +38,7 @@ def generate_self_signed_cert(cert_dir):
         return key_path, cert_path
     
     # Create a key pair
-    k = crypto.PKey()
-    k.generate_key(crypto.TYPE_RSA, 2048)
+    k = generate_key(key_type)
     
     # Create a self-signed certificate
     cert = crypto.X509()
@@ -78,16 +96,22 @@ def generate_self_signed_cert(cert_dir):
     with open(cert_path, "wb") as cert_file:
         cert_file.write(crypto.dump_certificate(crypto.FILETYPE_PEM, cert))
     
-    print(f"Generated new self-signed certificate at {cert_dir}")
+    print(f"Generated new self-signed {key_type.upper()} certificate at {cert_dir}")
     print(f"NOTE: Since this is a self-signed certificate, browsers will show a security warning.")
     print(f"You'll need to accept the certificate in your browser or add it to your system's trusted certificates.")
     
     return key_path, cert_path
 
 if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Generate a self-signed certificate for the ByteBeats server")
+    parser.add_argument("--key-type", choices=KEY_TYPES, default="rsa",
+                        help="RSA-2048 (most compatible) or ECDSA P-256 (faster handshakes)")
+    args = parser.parse_args()
+    
     BASE_DIR = os.path.dirname(os.path.abspath(__file__))
     CERT_DIR = os.path.join(BASE_DIR, "certs")
     
-    key_path, cert_path = generate_self_signed_cert(CERT_DIR)
+    key_path, cert_path = generate_self_signed_cert(CERT_DIR, args.key_type)
     print(f"Certificate: {cert_path}")
     print(f"Private key: {key_path}")
\ No newline at end of file
@@ -0,0 +1,152 @@
+import email.utils
+import re
+from urllib.parse import parse_qs, unquote, urlsplit
+
+MAX_REQUEST_HEADER = 16384  # Largest request line plus headers accepted
+TRACKS_PREFIX = "/tracks/"  # Tracks are served at /tracks/<URL-encoded song name>
+
+REASONS = {
+    200: "OK",
+    206: "Partial Content",
+    304: "Not Modified",
+    400: "Bad Request",
+    401: "Unauthorized",
+    403: "Forbidden",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    416: "Range Not Satisfiable",
+    431: "Request Header Fields Too Large",
+    503: "Service Unavailable",
+}
+
+_RANGE = re.compile(r"bytes=(\d*)-(\d*)$")
+
+class HTTPError(Exception):
+    """A request we can only answer with an error status"""
+    def __init__(self, status, message=None):
+        super().__init__(message or REASONS.get(status, ""))
+        self.status = status
+
+class HTTPRequest:
+    """The request line and headers of one HTTP request.
+
+    raw keeps the header block as received, for the WebSocket handshake.
+    Header names are lowercased; a repeated header keeps its last value.
+    """
+    def __init__(self, raw, method, target, version, headers):
+        self.raw = raw
+        self.method = method
+        self.target = target
+        self.version = version
+        self.headers = headers
+        parts = urlsplit(target)
+        self.path = unquote(parts.path)
+        self.query = {key: values[-1] for key, values in parse_qs(parts.query).items()}
+
+    @property
+    def is_websocket_upgrade(self):
+        return "websocket" in self.headers.get("upgrade", "").lower()
+
+    @property
+    def keep_alive(self):
+        """Whether the connection stays open for another request after this one"""
+        connection = self.headers.get("connection", "").lower()
+        if "content-length" in self.headers or "transfer-encoding" in self.headers:
+            return False  # We don't read request bodies, so we couldn't find the next request
+        if self.version == "HTTP/1.0":
+            return "keep-alive" in connection
+        return "close" not in connection
+
+class HTTPRequestReader:
+    """Splits the bytes of a connection into HTTP request headers.
+
+    Like WebSocketFrameReader, it is fed whatever recv() returned and
+    hands out complete requests; bytes after one request (a pipelined
+    next request) stay buffered for the next call.
+    """
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        self._buffer += data
+
+    def next_request(self):
+        """Return the next complete HTTPRequest, or None if more data is needed"""
+        end = self._buffer.find(b"\r\n\r\n")
+        if end == -1:
+            if len(self._buffer) > MAX_REQUEST_HEADER:
+                raise HTTPError(431)
+            return None
+        if end > MAX_REQUEST_HEADER:
+            raise HTTPError(431)
+        raw = self._buffer[:end + 4].decode("latin-1")
+        del self._buffer[:end + 4]
+        lines = raw.split("\r\n")
+        request_line = lines[0].split()
+        if len(request_line) != 3 or not request_line[2].startswith("HTTP/"):
+            raise HTTPError(400, f"Malformed request line: {lines[0][:100]!r}")
+        headers = {}
+        for line in lines[1:]:
+            if not line:
+                continue
+            name, sep, value = line.partition(":")
+            if not sep:
+                raise HTTPError(400, f"Malformed header: {line[:100]!r}")
+            headers[name.strip().lower()] = value.strip()
+        method, target, version = request_line
+        return HTTPRequest(raw, method, target, version, headers)
+
+def parse_range(header, size):
+    """Return the (first, last) byte of a Range header, or None to send the whole file.
+
+    Only single byte ranges are honoured; anything else is ignored, as
+    RFC 9110 allows. Raises HTTPError(416) for a range past the end.
+    """
+    if not header:
+        return None
+    match = _RANGE.match(header.strip())
+    if not match or (not match.group(1) and not match.group(2)):
+        return None
+    first, last = match.groups()
+    if not first:
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0 or size == 0:
+            raise HTTPError(416)
+        return max(0, size - length), size - 1
+    first = int(first)
+    last = min(int(last), size - 1) if last else size - 1
+    if first >= size:
+        raise HTTPError(416)
+    if last < first:
+        return None
+    return first, last
+
+def etag_matches(header, etag):
+    """Whether an If-None-Match header lists etag (weak comparison, as RFC 9110 asks)"""
+    if header.strip() == "*":
+        return True
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == f'"{etag}"':
+            return True
+    return False
+
+def http_date(timestamp=None):
+    return email.utils.formatdate(timestamp, usegmt=True)
+
+def build_response(status, headers, keep_alive=True):
+    """Encode the status line and headers of a response; the body is sent separately"""
+    lines = [f"HTTP/1.1 {status} {REASONS.get(status, '')}", f"Date: {http_date()}"]
+    lines.extend(f"{name}: {value}" for name, value in headers.items())
+    lines.append("Connection: keep-alive" if keep_alive else "Connection: close")
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+def error_response(status, message=None, headers=None, keep_alive=True):
+    """Return (header bytes, body bytes) of a small plain-text error response"""
+    body = (message or REASONS.get(status, "")).encode()
+    all_headers = {"Content-Type": "text/plain; charset=utf-8", "Content-Length": str(len(body))}
+    all_headers.update(headers or {})
+    return build_response(status, all_headers, keep_alive), body
@@ -0,0 +1,100 @@
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+
+LOG_QUEUE_SIZE = 10000       # Records waiting for the writer thread; more are dropped rather than waited for
+RATE_LIMIT_PER_SECOND = 5.0  # Sustained records per second from any one line of code
+RATE_LIMIT_BURST = 20        # Records one line of code may log in a burst before it is limited
+LOG_FORMAT = "%(asctime)s %(levelname)s %(message)s"
+
+# The server's logger. Until setup_logging() is called, only warnings and errors reach stderr
+log = logging.getLogger("bytebeats")
+
+class RateLimitFilter(logging.Filter):
+    """A token bucket per call site (file and line), so a message logged for
+    every connection or chunk can't flood the output under load.
+
+    The next record from a call site after some were dropped says how many.
+    """
+    def __init__(self, rate=RATE_LIMIT_PER_SECOND, burst=RATE_LIMIT_BURST):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.suppressed = 0
+        self._buckets = {}  # (path, line) -> [tokens, last refill, suppressed since last record]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [self.burst, now, 0]
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                bucket[2] += 1
+                self.suppressed += 1
+                return False
+            bucket[0] -= 1
+            suppressed, bucket[2] = bucket[2], 0
+        if suppressed:
+            record.msg = f"{record.getMessage()} ({suppressed} similar messages suppressed)"
+            record.args = None
+        return True
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the writer thread, so logging never waits for stdout; drops them when it falls behind"""
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+_handler = None
+_output = None
+_listener = None
+_rate_limit = None
+
+def setup_logging(level="info", stream=None):
+    """Send the server's log through a rate limit and a queue to a writer thread printing to stream"""
+    global _handler, _output, _listener, _rate_limit
+    _output = logging.StreamHandler(stream or sys.stdout)
+    _output.setFormatter(logging.Formatter(LOG_FORMAT))
+    _rate_limit = RateLimitFilter()
+    _handler = LogQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    _handler.addFilter(_rate_limit)
+    log.addHandler(_handler)
+    log.setLevel(level.upper())
+    log.propagate = False
+    _listener = logging.handlers.QueueListener(_handler.queue, _output)
+    _listener.start()
+
+def restart_log_writer():
+    """Give a forked worker its own queue and writer thread; the parent's thread doesn't survive the fork"""
+    global _listener
+    if _handler is None:
+        return
+    _handler.queue = queue.Queue(LOG_QUEUE_SIZE)
+    _listener = logging.handlers.QueueListener(_handler.queue, _output)
+    _listener.start()
+
+def stop_logging():
+    """Write out whatever is still queued"""
+    if _listener is not None:
+        _listener.stop()
+
+def log_stats():
+    """Records dropped because the queue was full, and suppressed by the rate limit"""
+    return {
+        "dropped": _handler.dropped if _handler else 0,
+        "suppressed": _rate_limit.suppressed if _rate_limit else 0,
+    }
@@ -0,0 +1,242 @@
+import bisect
+import http.server
+import threading
+
+# Histogram buckets in seconds, from sub-millisecond sends to slow handshakes
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+MAX_SHARDS = 64  # Per-thread shards a metric keeps before folding in those of exited threads
+
+class Metric:
+    """A named counter, gauge or histogram, optionally split by labels.
+
+    Updates go to a cell owned by the updating thread, so the hot path
+    takes no lock and threads never write the same memory; scraping sums
+    the cells. A thread's cell is registered (under a lock) the first
+    time it touches the metric, and cells of threads that have exited
+    are folded together once there are MAX_SHARDS of them, so a thread
+    per connection doesn't grow the list forever.
+
+    A metric with a function reports function() instead, for values that
+    are already kept elsewhere (cache sizes, active streams).
+    """
+    kind = None
+
+    def __init__(self, name, help, labels=(), function=None):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.function = function
+        self._children = {}  # label values -> metric of the same kind
+        self._local = threading.local()
+        self._cells = []  # (thread, cell) for every thread that has updated this metric
+        self._retired = self._new_cell()  # Sum of the cells of threads that have exited
+        self._lock = threading.Lock()
+
+    def _new_cell(self):
+        return [0]
+
+    def reset(self):
+        """Start again from zero, e.g. in a forked worker (the parent's threads and locks don't carry over)"""
+        self._children = {}
+        self._local = threading.local()
+        self._cells = []
+        self._retired = self._new_cell()
+        self._lock = threading.Lock()
+
+    def _child(self):
+        return type(self)(self.name, self.help)
+
+    def labels(self, *values):
+        """The metric for one combination of label values"""
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._child())
+        return child
+
+    def _cell(self):
+        try:
+            return self._local.cell
+        except AttributeError:
+            cell = self._local.cell = self._new_cell()
+            with self._lock:
+                if len(self._cells) >= MAX_SHARDS:
+                    self._fold()
+                self._cells.append((threading.current_thread(), cell))
+            return cell
+
+    def _fold(self):
+        """Add the cells of exited threads into _retired; they are never written again"""
+        live = []
+        for thread, cell in self._cells:
+            if thread.is_alive():
+                live.append((thread, cell))
+            else:
+                for i, value in enumerate(cell):
+                    self._retired[i] += value
+        self._cells = live
+
+    def value(self):
+        """The sum of every thread's cell (a list for histograms)"""
+        if self.function is not None:
+            return [self.function()]
+        with self._lock:
+            cells = [cell for _, cell in self._cells]
+            total = list(self._retired)
+        for cell in cells:
+            for i, value in enumerate(cell):
+                total[i] += value
+        return total
+
+    def snapshot(self):
+        """Plain data for merge_snapshots() and render(); safe to send between processes"""
+        if self.label_names:
+            with self._lock:
+                children = list(self._children.items())
+            samples = [[list(values), child.value()] for values, child in children]
+        else:
+            samples = [[[], self.value()]]
+        return {"name": self.name, "help": self.help, "type": self.kind, "labels": list(self.label_names),
+                "samples": samples}
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1):
+        self._cell()[0] += amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def inc(self, amount=1):
+        self._cell()[0] += amount
+
+    def dec(self, amount=1):
+        self._cell()[0] -= amount
+
+class Histogram(Metric):
+    """Counts observations in cumulative buckets, like a Prometheus histogram.
+
+    A cell holds the count of each bucket (the last one is +Inf) followed
+    by the sum of the observations.
+    """
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, help, labels)
+
+    def _new_cell(self):
+        return [0] * (len(self.buckets) + 2)
+
+    def _child(self):
+        return Histogram(self.name, self.help, buckets=self.buckets)
+
+    def observe(self, value):
+        cell = self._cell()
+        cell[bisect.bisect_left(self.buckets, value)] += 1
+        cell[-1] += value
+
+    def snapshot(self):
+        snapshot = super().snapshot()
+        snapshot["buckets"] = list(self.buckets)
+        return snapshot
+
+class MetricsRegistry:
+    """The metrics of one process"""
+    def __init__(self):
+        self._metrics = []
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=(), function=None):
+        return self._register(Counter(name, help, labels, function))
+
+    def gauge(self, name, help, labels=(), function=None):
+        return self._register(Gauge(name, help, labels, function))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help, labels, buckets))
+
+    def after_fork(self):
+        """Count a forked worker's own work only, so merged totals don't include the parent's twice"""
+        for metric in self._metrics:
+            metric.reset()
+
+    def snapshot(self):
+        return [metric.snapshot() for metric in self._metrics]
+
+def merge_snapshots(snapshots):
+    """Add up the snapshots of several processes (the workers of a WorkerPool)"""
+    merged = {}
+    for snapshot in snapshots:
+        for metric in snapshot:
+            target = merged.get(metric["name"])
+            if target is None:
+                merged[metric["name"]] = dict(metric, samples=[[values, list(value)]
+                                                               for values, value in metric["samples"]])
+                continue
+            samples = {tuple(values): value for values, value in target["samples"]}
+            for values, value in metric["samples"]:
+                total = samples.get(tuple(values))
+                if total is None:
+                    target["samples"].append([values, list(value)])
+                else:
+                    for i, v in enumerate(value):
+                        total[i] += v
+    return list(merged.values())
+
+def _label_text(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def render(snapshot):
+    """Format a snapshot in the Prometheus text exposition format (version 0.0.4)"""
+    lines = []
+    for metric in snapshot:
+        name, names = metric["name"], metric["labels"]
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+        for values, value in metric["samples"]:
+            if metric["type"] != "histogram":
+                lines.append(f"{name}{_label_text(names, values)} {_number(value[0])}")
+                continue
+            cumulative = 0
+            for bound, count in zip(metric["buckets"] + ["+Inf"], value[:-1]):
+                cumulative += count
+                le = bound if bound == "+Inf" else _number(float(bound))
+                lines.append(f"{name}_bucket{_label_text(names, values, ('le', le))} {cumulative}")
+            lines.append(f"{name}_sum{_label_text(names, values)} {_number(value[-1])}")
+            lines.append(f"{name}_count{_label_text(names, values)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+def serve_metrics(host, port, collect):
+    """Serve collect() (Prometheus text) at /metrics from a background thread; returns the HTTP server"""
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = collect().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # A scrape every few seconds isn't worth a log line
+
+    httpd = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
@@ -0,0 +1,491 @@
+import array
+import bisect
+import hashlib
+import json
+import os
+import struct
+import threading
+import time
+
+# MPEG audio header tables, indexed by the raw header fields
+# Version bits: 0 = MPEG 2.5, 2 = MPEG 2, 3 = MPEG 1 (1 is reserved)
+BITRATES = {
+    (3, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (3, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (3, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (2, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (2, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (2, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+SAMPLE_RATES = {
+    3: [44100, 48000, 32000],
+    2: [22050, 24000, 16000],
+    0: [11025, 12000, 8000],
+}
+
+SCAN_LIMIT = 64 * 1024  # Bytes to search for the first frame after the ID3 tag
+
+def id3v2_size(header):
+    """Return the total size of an ID3v2 tag from its 10-byte header, or 0 if there is none"""
+    if len(header) < 10 or header[:3] != b"ID3":
+        return 0
+    size = 0
+    for byte in header[6:10]:
+        size = (size << 7) | (byte & 0x7F)
+    # A footer doubles the 10-byte header at the end of the tag
+    footer = 10 if header[5] & 0x10 else 0
+    return 10 + size + footer
+
+def parse_frame_header(header):
+    """Parse a 4-byte MPEG audio frame header; returns a dict or None if it is not valid"""
+    if len(header) < 4:
+        return None
+    b1, b2, b3, b4 = header[:4]
+    if b1 != 0xFF or (b2 & 0xE0) != 0xE0:
+        return None
+
+    version = (b2 >> 3) & 0x03
+    layer_bits = (b2 >> 1) & 0x03
+    bitrate_index = (b3 >> 4) & 0x0F
+    sample_rate_index = (b3 >> 2) & 0x03
+    if version == 1 or layer_bits == 0 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+
+    layer = 4 - layer_bits
+    bitrate = BITRATES[(3 if version == 3 else 2, layer)][bitrate_index] * 1000
+    sample_rate = SAMPLE_RATES[version][sample_rate_index]
+    padding = (b3 >> 1) & 0x01
+
+    if layer == 1:
+        samples = 384
+        length = (12 * bitrate // sample_rate + padding) * 4
+    else:
+        samples = 1152 if (layer == 2 or version == 3) else 576
+        length = samples // 8 * bitrate // sample_rate + padding
+
+    return {
+        "version": version,
+        "layer": layer,
+        "bitrate": bitrate,
+        "sample_rate": sample_rate,
+        "samples": samples,
+        "length": length,
+        "channel_mode": (b4 >> 6) & 0x03,
+    }
+
+def read_bitrate(path):
+    """Return the bitrate (bits/s) of the first MPEG frame in a file, or None"""
+    try:
+        with open(path, "rb") as f:
+            start = id3v2_size(f.read(10))
+            f.seek(start)
+            data = f.read(SCAN_LIMIT)
+    except OSError:
+        return None
+
+    position = data.find(b"\xff")
+    while 0 <= position < len(data) - 4:
+        frame = parse_frame_header(data[position:position + 4])
+        # Require a second header right after this frame to avoid false syncs
+        if frame:
+            following = data[position + frame["length"]:position + frame["length"] + 4]
+            if len(following) < 4 or parse_frame_header(following):
+                return frame["bitrate"]
+        position = data.find(b"\xff", position + 1)
+    return None
+
+# Frame/time index -----------------------------------------------------------
+
+INDEX_MAGIC = b"BBIX"
+INDEX_VERSION = 1
+# magic, version, typecode, file size, mtime_ns, sample rate, samples per frame,
+# audio start, audio end, flags, tags length, frame count
+INDEX_HEADER = struct.Struct("<4sBcQqIIQQBII")
+READ_BLOCK = 1024 * 1024
+MAX_FRAME_LENGTH = 2881  # Largest possible frame (MPEG 1 layer II at 384 kbps/32 kHz, padded)
+
+ID3_TEXT_FRAMES = {
+    b"TIT2": "title", b"TPE1": "artist", b"TALB": "album",
+    b"TT2": "title", b"TP1": "artist", b"TAL": "album",
+}
+
+def _decode_id3_text(data):
+    """Decode an ID3v2 text frame body (encoding byte + text)"""
+    if not data:
+        return None
+    encoding, text = data[0], data[1:]
+    try:
+        if encoding == 0:
+            value = text.decode("latin-1")
+        elif encoding == 1:
+            value = text.decode("utf-16")
+        elif encoding == 2:
+            value = text.decode("utf-16-be")
+        else:
+            value = text.decode("utf-8")
+    except UnicodeDecodeError:
+        return None
+    # Multiple values are NUL-separated; keep the first
+    value = value.split("\x00")[0].strip()
+    return value or None
+
+def parse_id3v2(tag):
+    """Extract title/artist/album from a complete ID3v2 tag (header included)"""
+    tags = {}
+    if len(tag) < 10 or tag[:3] != b"ID3":
+        return tags
+    major = tag[3]
+    flags = tag[5]
+    position = 10
+    if flags & 0x40 and major >= 3:
+        # Skip the extended header
+        if major == 4:
+            size = 0
+            for byte in tag[10:14]:
+                size = (size << 7) | (byte & 0x7F)
+            position += size
+        else:
+            position += 4 + struct.unpack(">I", tag[10:14])[0]
+
+    id_length, header_length = (3, 6) if major == 2 else (4, 10)
+    while position + header_length <= len(tag):
+        frame_id = tag[position:position + id_length]
+        if not frame_id.strip(b"\x00"):
+            break  # Padding
+        if major == 2:
+            size = int.from_bytes(tag[position + 3:position + 6], "big")
+        elif major == 4:
+            size = 0
+            for byte in tag[position + 4:position + 8]:
+                size = (size << 7) | (byte & 0x7F)
+        else:
+            size = struct.unpack(">I", tag[position + 4:position + 8])[0]
+        body = tag[position + header_length:position + header_length + size]
+        key = ID3_TEXT_FRAMES.get(frame_id)
+        if key and key not in tags:
+            value = _decode_id3_text(body)
+            if value:
+                tags[key] = value
+        position += header_length + size
+    return tags
+
+def parse_id3v1(trailer):
+    """Extract title/artist/album from a 128-byte ID3v1 trailer"""
+    if len(trailer) != 128 or trailer[:3] != b"TAG":
+        return {}
+    tags = {}
+    for key, start, end in (("title", 3, 33), ("artist", 33, 63), ("album", 63, 93)):
+        value = trailer[start:end].split(b"\x00")[0].decode("latin-1").strip()
+        if value:
+            tags[key] = value
+    return tags
+
+def parse_vbr_header(frame_data, frame):
+    """Return the frame count from a Xing/Info or VBRI header in the first frame, or None"""
+    # The Xing header follows the side information, whose size depends on version and channels
+    mono = frame["channel_mode"] == 3
+    if frame["version"] == 3:
+        side_info = 17 if mono else 32
+    else:
+        side_info = 9 if mono else 17
+    xing = 4 + side_info
+    tag = frame_data[xing:xing + 4]
+    if tag in (b"Xing", b"Info"):
+        flags = struct.unpack(">I", frame_data[xing + 4:xing + 8])[0]
+        if flags & 0x01:
+            return struct.unpack(">I", frame_data[xing + 8:xing + 12])[0], tag == b"Xing"
+        return None, tag == b"Xing"
+    # VBRI always sits 32 bytes after the frame header
+    if frame_data[36:40] == b"VBRI":
+        return struct.unpack(">I", frame_data[50:54])[0], True
+    return None
+
+class TrackIndex:
+    """Frame offsets and tags for one MP3 file.
+
+    Every MPEG frame in a stream holds the same number of samples, so
+    frame i starts at offsets[i] and at time i * samples_per_frame /
+    sample_rate. This gives exact time<->byte mapping for CBR and VBR.
+    """
+    def __init__(self, offsets, sample_rate, samples_per_frame, audio_start, audio_end,
+                 tags=None, vbr=False, size=0, mtime_ns=0):
+        self.offsets = offsets
+        self.sample_rate = sample_rate
+        self.samples_per_frame = samples_per_frame
+        self.audio_start = audio_start
+        self.audio_end = audio_end
+        self.tags = tags or {}
+        self.vbr = vbr
+        self.size = size
+        self.mtime_ns = mtime_ns
+
+    @property
+    def frame_duration(self):
+        return self.samples_per_frame / self.sample_rate if self.sample_rate else 0.0
+
+    @property
+    def duration(self):
+        return len(self.offsets) * self.frame_duration
+
+    @property
+    def bitrate(self):
+        """Average bitrate in bits/s over the audio frames"""
+        if not self.duration:
+            return None
+        return int((self.audio_end - self.audio_start) * 8 / self.duration)
+
+    def frame_at_time(self, seconds):
+        """Index of the frame playing at the given time, clamped to the track"""
+        if not self.offsets:
+            return 0
+        frame = int(max(0.0, seconds) / self.frame_duration)
+        return min(frame, len(self.offsets) - 1)
+
+    def frame_at_offset(self, offset):
+        """Index of the first frame starting at or after a byte offset"""
+        return bisect.bisect_left(self.offsets, offset)
+
+    def time_of_frame(self, frame):
+        return frame * self.frame_duration
+
+    def metadata(self):
+        """Fields reported to clients in SONG_METADATA"""
+        return {
+            "duration": round(self.duration, 3),
+            "bitrate": self.bitrate,
+            "title": self.tags.get("title"),
+            "artist": self.tags.get("artist"),
+            "album": self.tags.get("album"),
+        }
+
+def scan_track(path):
+    """Parse tags and walk every MPEG frame of a file to build its TrackIndex"""
+    st = os.stat(path)
+    size = st.st_size
+    offsets = array.array("I" if size < 2 ** 32 else "Q")
+    sample_rate = samples_per_frame = 0
+    vbr = False
+    audio_start = audio_end = 0
+
+    with open(path, "rb") as f:
+        header = f.read(10)
+        tag_size = id3v2_size(header)
+        tags = {}
+        if tag_size:
+            tags = parse_id3v2(header + f.read(tag_size - 10))
+        trailer_tags = {}
+        if size >= 128:
+            f.seek(size - 128)
+            trailer = f.read(128)
+            trailer_tags = parse_id3v1(trailer)
+            if trailer_tags or trailer[:3] == b"TAG":
+                size -= 128
+        for key, value in trailer_tags.items():
+            tags.setdefault(key, value)
+
+        f.seek(tag_size)
+        buffer = f.read(READ_BLOCK)
+        base = tag_size  # File offset of buffer[0]
+        position = 0
+        first = True
+        while True:
+            if len(buffer) - position < MAX_FRAME_LENGTH + 4:
+                # Keep at least one maximum-size frame plus the next header buffered
+                more = f.read(READ_BLOCK)
+                if more:
+                    buffer = buffer[position:] + more
+                    base += position
+                    position = 0
+            if base + position + 4 > size:
+                break
+            frame = parse_frame_header(buffer[position:position + 4])
+            if frame and sample_rate and (
+                frame["sample_rate"] != sample_rate or frame["samples"] != samples_per_frame
+            ):
+                frame = None
+            if frame is None:
+                # Lost sync: skip to the next possible frame header
+                next_sync = buffer.find(b"\xff", position + 1)
+                position = next_sync if next_sync >= 0 else len(buffer)
+                continue
+
+            if first:
+                # Confirm with the following header so a stray 0xFF doesn't start the index
+                following = buffer[position + frame["length"]:position + frame["length"] + 4]
+                if len(following) == 4 and not parse_frame_header(following):
+                    position += 1
+                    continue
+                first = False
+                sample_rate = frame["sample_rate"]
+                samples_per_frame = frame["samples"]
+                vbr_info = parse_vbr_header(buffer[position:position + frame["length"]], frame)
+                if vbr_info is not None:
+                    # The Xing/VBRI frame carries no audio; skip it
+                    vbr = vbr_info[1]
+                    position += frame["length"]
+                    continue
+
+            offset = base + position
+            if offset + frame["length"] > size:
+                break
+            if not offsets:
+                audio_start = offset
+            offsets.append(offset)
+            audio_end = offset + frame["length"]
+            position += frame["length"]
+
+    return TrackIndex(offsets, sample_rate, samples_per_frame, audio_start, audio_end,
+                      tags, vbr, st.st_size, st.st_mtime_ns)
+
+def index_cache_path(cache_dir, path):
+    name = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()
+    return os.path.join(cache_dir, name + ".idx")
+
+def _read_cached_index(cache_file, st, with_frames=True):
+    try:
+        with open(cache_file, "rb") as f:
+            header = f.read(INDEX_HEADER.size)
+            if len(header) != INDEX_HEADER.size:
+                return None
+            (magic, version, typecode, size, mtime_ns, sample_rate, samples_per_frame,
+             audio_start, audio_end, flags, tags_length, frame_count) = INDEX_HEADER.unpack(header)
+            if magic != INDEX_MAGIC or version != INDEX_VERSION:
+                return None
+            if size != st.st_size or mtime_ns != st.st_mtime_ns:
+                return None
+            tags = json.loads(f.read(tags_length).decode()) if tags_length else {}
+            offsets = array.array(typecode.decode())
+            if with_frames:
+                offsets.fromfile(f, frame_count)
+            else:
+                # Callers that only want metadata get a placeholder of the right length
+                offsets = _FrameCount(frame_count)
+    except (OSError, ValueError, EOFError, struct.error):
+        return None
+    return TrackIndex(offsets, sample_rate, samples_per_frame, audio_start, audio_end,
+                      tags, bool(flags & 0x01), size, mtime_ns)
+
+class _FrameCount:
+    """Stands in for the offsets array when only the frame count was loaded"""
+    def __init__(self, count):
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+def _write_cached_index(cache_file, index):
+    tags = json.dumps(index.tags).encode()
+    header = INDEX_HEADER.pack(
+        INDEX_MAGIC, INDEX_VERSION, index.offsets.typecode.encode(), index.size, index.mtime_ns,
+        index.sample_rate, index.samples_per_frame, index.audio_start, index.audio_end,
+        0x01 if index.vbr else 0, len(tags), len(index.offsets)
+    )
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    temp_file = f"{cache_file}.{os.getpid()}.tmp"
+    with open(temp_file, "wb") as f:
+        f.write(header)
+        f.write(tags)
+        index.offsets.tofile(f)
+    os.replace(temp_file, cache_file)
+
+def load_track_index(path, cache_dir, with_frames=True):
+    """Return the TrackIndex for a file, from the on-disk cache when it is still valid.
+
+    The cache entry is keyed by the file's absolute path and invalidated when
+    its size or mtime changes. With with_frames=False only the header is read,
+    which is enough for metadata.
+    """
+    st = os.stat(path)
+    cache_file = index_cache_path(cache_dir, path)
+    index = _read_cached_index(cache_file, st, with_frames)
+    if index is not None:
+        return index
+    index = scan_track(path)
+    try:
+        _write_cached_index(cache_file, index)
+    except OSError as e:
+        print(f"Error writing track index for {path}: {e}")
+    return index
+
+class TrackIndexer:
+    """Keeps a TrackIndex on disk for every catalog track and their metadata in memory.
+
+    A background thread indexes new or changed tracks whenever the catalog
+    changes, so nothing has to be scanned when a song starts playing.
+    """
+    def __init__(self, catalog, cache_dir, poll_interval=2.0):
+        self.catalog = catalog
+        self.cache_dir = cache_dir
+        self.poll_interval = poll_interval
+        self._metadata = {}  # name -> (size, mtime_ns, metadata dict)
+        self._lock = threading.Lock()
+        self._thread = None
+        self.generation = 0  # Bumped whenever the cached metadata changes
+
+    def metadata(self, name):
+        """Return the cached metadata for a track, indexing it now if needed"""
+        info = self.catalog.info(name)
+        cached = self._metadata.get(name)
+        if cached and info and cached[:2] == info:
+            return cached[2]
+        index = self.index(name, with_frames=False)
+        return index.metadata() if index else {}
+
+    def cached_metadata(self, name):
+        """Return the metadata already in memory for a track, or None, without indexing it"""
+        cached = self._metadata.get(name)
+        return cached[2] if cached else None
+
+    def index(self, name, with_frames=True):
+        """Return the TrackIndex for a catalog track, or None if it can't be parsed"""
+        path = self.catalog.path(name)
+        if path is None:
+            return None
+        try:
+            index = load_track_index(path, self.cache_dir, with_frames)
+        except OSError as e:
+            print(f"Error indexing {name}: {e}")
+            return None
+        entry = (index.size, index.mtime_ns, index.metadata())
+        with self._lock:
+            if self._metadata.get(name) != entry:
+                self._metadata[name] = entry
+                self.generation += 1
+        return index
+
+    def after_fork(self):
+        """Reset state inherited from the parent process; indexing stays with the parent"""
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def index_all(self):
+        """Index every catalog track whose metadata is missing or stale"""
+        for name in self.catalog.songs():
+            cached = self._metadata.get(name)
+            if cached and cached[:2] == self.catalog.info(name):
+                continue
+            self.index(name, with_frames=False)
+        with self._lock:
+            songs = set(self.catalog.songs())
+            for name in set(self._metadata) - songs:
+                del self._metadata[name]
+                self.generation += 1
+
+    def start(self):
+        """Index the library in a background thread and keep up with catalog changes"""
+        if self._thread is not None:
+            return
+        def run():
+            generation = None
+            while True:
+                if self.catalog.generation != generation:
+                    generation = self.catalog.generation
+                    try:
+                        started = time.time()
+                        self.index_all()
+                        print(f"Indexed {len(self._metadata)} songs in {time.time() - started:.1f}s")
+                    except Exception as e:
+                        print(f"Error indexing music library: {e}")
+                time.sleep(self.poll_interval)
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
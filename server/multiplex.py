@@ -0,0 +1,109 @@
+import struct
+
+MUX_SUBPROTOCOL = "bytebeats-mux"  # WebSocket subprotocol that puts a stream id in front of binary messages
+STREAM_ID = struct.Struct(">H")    # The stream id prefix of each binary message on a multiplexed connection
+MAX_STREAM_ID = 0xFFFF
+# Streams with a higher priority send first; streams of equal priority take turns
+PRIORITIES = {"playback": 1, "prefetch": 0}
+
+class OutgoingStream:
+    """One song being sent on a connection, and the client's control over it.
+
+    Stream 0 is the one every client has; a client that negotiated
+    MUX_SUBPROTOCOL can run more alongside it, e.g. to prefetch the next
+    song of a queue, and every binary message then starts with the id of
+    the stream it belongs to.
+    """
+    def __init__(self, request, multiplexed):
+        self.request = request
+        self.name = request.name
+        self.stream_id = request.stream_id
+        self.priority = request.priority
+        self.multiplexed = multiplexed
+        self.prefix = STREAM_ID.pack(self.stream_id) if multiplexed else b""
+        self.paused = False     # PAUSE for this stream only
+        self.cancelled = False  # STOP or another PLAY_SONG on this stream id: end before the next chunk
+        self.deferred = []      # Replies held back until this stream has said SONG_STOPPED
+        self.pacer = None       # Set by the engine once the stream has started
+        self.pacer_paused = False
+        self.ready_at = 0.0     # When the stream's next chunk may go out
+        self.turn = 0           # When it last sent, so streams of equal priority take turns
+        self.steps = None       # The engine's generator sending the song, one chunk per step
+        self.stats = None       # Pacing stats once the stream has finished
+
+    def tag(self, message):
+        """Add the stream id to a message about this stream, on multiplexed connections"""
+        if self.multiplexed:
+            message["stream_id"] = self.stream_id
+        return message
+
+class StreamScheduler:
+    """Decides which of a connection's streams sends the next chunk.
+
+    Each stream has a chunk waiting until its pacer lets it go (ready_at).
+    Of the streams that are ready, the highest priority sends, so the
+    playing song always goes before prefetches and those only use the gaps
+    its pacing leaves; streams of the same priority take turns. A cancelled
+    stream runs straight away so it can report SONG_STOPPED.
+    """
+    def __init__(self, max_streams):
+        self.max_streams = max_streams
+        self._streams = {}
+        self._turns = 0
+
+    def __len__(self):
+        return len(self._streams)
+
+    def __iter__(self):
+        return iter(list(self._streams.values()))
+
+    def get(self, stream_id):
+        return self._streams.get(stream_id)
+
+    def add(self, stream):
+        self._streams[stream.stream_id] = stream
+
+    def remove(self, stream):
+        if self._streams.get(stream.stream_id) is stream:
+            del self._streams[stream.stream_id]
+
+    def update_pauses(self, paused):
+        """Stop the pacing clock of paused streams, so they don't burst when resumed.
+
+        Also passes each stream's priority (which SET_PRIORITY can change)
+        on to its pacer, for sharing egress between the user's streams.
+        """
+        for stream in self._streams.values():
+            if stream.pacer is not None:
+                stream.pacer.priority = stream.priority
+            should_pause = paused or stream.paused
+            if stream.pacer is not None and should_pause != stream.pacer_paused:
+                if should_pause:
+                    stream.pacer.pause()
+                else:
+                    stream.pacer.resume()
+                stream.pacer_paused = should_pause
+
+    def next_ready(self, now, paused=False):
+        """Return (stream to run now, None), or (None, seconds until one is ready; None if none will be)"""
+        best = None
+        wait = None
+        for stream in self._streams.values():
+            if stream.cancelled:
+                return stream, None
+            if paused or stream.paused:
+                continue
+            if stream.ready_at > now:
+                delay = stream.ready_at - now
+                wait = delay if wait is None else min(wait, delay)
+            elif best is None or (-stream.priority, stream.turn) < (-best.priority, best.turn):
+                best = stream
+        if best is not None:
+            return best, None
+        return None, wait
+
+    def stepped(self, stream, delay, now):
+        """Record that a stream sent a chunk and can send its next one after delay seconds"""
+        self._turns += 1
+        stream.turn = self._turns
+        stream.ready_at = now + delay
@@ -0,0 +1,315 @@
+import socket
+import threading
+import time
+
+try:
+    import fcntl
+    import termios
+    SIOCOUTQ = termios.TIOCOUTQ  # Same ioctl number on Linux: unsent bytes in a TCP socket
+except (ImportError, AttributeError):
+    fcntl = None
+
+# Pacing defaults (overridden from server.py)
+DEFAULT_BITRATE = 320000       # Bits/s assumed when a file's bitrate can't be read
+DEFAULT_MULTIPLIER = 1.5       # Steady-state rate relative to the track's bitrate
+DEFAULT_BURST_SECONDS = 10.0   # Seconds of audio sent unpaced when a stream starts
+HIGH_WATER_FRACTION = 0.75     # Back off once the kernel send queue is this full
+MIN_BACKOFF = 0.005            # First backoff step in seconds
+MAX_BACKOFF = 0.2              # Backoff never waits longer than this per step
+REALLOCATE_INTERVAL = 0.25     # Seconds between recomputing each stream's share of the egress budget
+
+def send_queue_bytes(sock):
+    """Return the number of bytes still queued in the kernel for a socket, or None if unknown"""
+    if fcntl is None:
+        return None
+    try:
+        queued = fcntl.ioctl(sock.fileno(), SIOCOUTQ, b"\0\0\0\0")
+        return int.from_bytes(queued, "little", signed=True)
+    except (OSError, ValueError):
+        return None
+
+def send_buffer_size(sock):
+    """Return the socket's SO_SNDBUF size, or None if unknown"""
+    try:
+        return sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+    except (OSError, AttributeError):
+        return None
+
+class StreamPacer:
+    """Token-bucket pacing for one outgoing stream.
+
+    The bucket starts full with `burst_seconds` worth of audio so playback
+    can begin immediately, then refills at the track's bitrate times
+    `multiplier`. Separately, backpressure_delay() backs off exponentially
+    while the socket's send queue is above the high-water mark. With an
+    EgressScheduler, the stream also waits for its share of the server's
+    egress budget.
+    """
+    def __init__(self, bitrate=None, chunk_size=32768, multiplier=DEFAULT_MULTIPLIER,
+                 burst_seconds=DEFAULT_BURST_SECONDS, egress=None):
+        self.egress = egress
+        self.priority = 0  # Of the stream; its user's higher-priority streams get spare egress first
+        self.bitrate = bitrate or DEFAULT_BITRATE
+        self.multiplier = multiplier
+        self.rate = self.bitrate / 8 * multiplier  # Bytes per second
+        self.burst_bytes = int(self.bitrate / 8 * burst_seconds)
+        # After the initial burst the bucket only holds a couple of chunks
+        self.capacity = chunk_size * 2
+        self.tokens = float(max(self.burst_bytes, chunk_size))
+        self.started = time.monotonic()
+        self.last_refill = self.started
+        self.bytes_sent = 0
+        self.backoffs = 0
+        self.backoff_time = 0.0
+        self.paced_time = 0.0
+        self.paused_time = 0.0
+        self._paused_at = None
+        self._backoff = 0.0
+        self._recent_rate = 0.0
+        self._last_sent = self.started
+
+    def _refill(self, now):
+        ceiling = max(self.capacity, self.tokens)
+        self.tokens = min(ceiling, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def reserve(self, nbytes):
+        """Take nbytes from the bucket and return how long to wait before sending them"""
+        share_delay = self.egress.reserve(self, nbytes) if self.egress is not None else 0.0
+        if self.multiplier <= 0:
+            return share_delay
+        self._refill(time.monotonic())
+        self.tokens -= nbytes
+        if self.tokens >= 0:
+            return share_delay
+        delay = -self.tokens / self.rate
+        self.paced_time += delay
+        return max(delay, share_delay)
+
+    @property
+    def paused(self):
+        return self._paused_at is not None
+
+    def demand(self):
+        """Bytes/s this stream would send if nothing but its own pacing held it back"""
+        if self.paused:
+            return 0.0
+        if self.multiplier <= 0 or self.tokens > self.capacity:
+            return float("inf")  # Unpaced, or still sending its initial burst
+        return self.rate
+
+    def backpressure_delay(self, queued, capacity):
+        """Return how long to back off given the bytes queued and the send buffer capacity"""
+        if queued is None or not capacity or queued < capacity * HIGH_WATER_FRACTION:
+            self._backoff = 0.0
+            return 0.0
+        self._backoff = min(MAX_BACKOFF, max(MIN_BACKOFF, self._backoff * 2))
+        self.backoffs += 1
+        self.backoff_time += self._backoff
+        return self._backoff
+
+    def pause(self):
+        """Stop the clock while the client has paused the stream"""
+        if self._paused_at is None:
+            self._paused_at = time.monotonic()
+
+    def resume(self):
+        """Restart the clock; the pause neither refills the bucket nor lowers the average rate"""
+        if self._paused_at is not None:
+            now = time.monotonic()
+            self.paused_time += now - self._paused_at
+            self.last_refill = now
+            self._last_sent = now
+            self._paused_at = None
+
+    def record_sent(self, nbytes):
+        """Account for bytes handed to the socket"""
+        now = time.monotonic()
+        self.bytes_sent += nbytes
+        interval = now - self._last_sent
+        if interval > 0:
+            # Exponentially weighted rate so stats reflect the last few seconds
+            weight = min(1.0, interval / 2.0)
+            self._recent_rate += (nbytes / interval - self._recent_rate) * weight
+        self._last_sent = now
+
+    def stats(self):
+        """Return a snapshot of this stream's rate statistics"""
+        now = time.monotonic()
+        elapsed = now - self.started
+        paused = self.paused_time + (now - self._paused_at if self._paused_at is not None else 0.0)
+        active = elapsed - paused
+        return {
+            "bytes_sent": self.bytes_sent,
+            "elapsed": round(elapsed, 3),
+            "average_rate": int(self.bytes_sent / active) if active > 0 else 0,
+            "current_rate": int(self._recent_rate),
+            "target_rate": int(self.rate) if self.multiplier > 0 else None,
+            "bitrate": self.bitrate,
+            "burst_bytes": self.burst_bytes,
+            "paced_time": round(self.paced_time, 3),
+            "backoffs": self.backoffs,
+            "backoff_time": round(self.backoff_time, 3),
+            "paused_time": round(paused, 3),
+            "fair_share": self.egress.share(self) if self.egress is not None else None,
+        }
+
+def fair_shares(capacity, claims):
+    """Split capacity between (key, weight, demand) claims by weighted max-min fairness: {key: share}.
+
+    Nobody gets more than they ask for, and what they leave is split
+    between the others by weight.
+    """
+    shares = {}
+    weight_left = sum(weight for _, weight, _ in claims)
+    for key, weight, demand in sorted(claims, key=lambda claim: claim[2] / claim[1]):
+        share = min(demand, capacity * weight / weight_left) if weight_left > 0 else 0.0
+        shares[key] = share
+        capacity = max(0.0, capacity - share)
+        weight_left -= weight
+    return shares
+
+class _Flow:
+    """A stream's share of the egress budget and the token bucket it sends through"""
+    def __init__(self, username, tokens, capacity):
+        self.username = username
+        self.rate = 0.0
+        self.tokens = tokens
+        self.capacity = capacity
+        self.last_refill = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+class EgressScheduler:
+    """Shares a total egress budget between the streams of this process.
+
+    Each stream is first given its track's bitrate, so it can play in
+    real time (admission control keeps those within the budget). The rest
+    is split by weighted max-min fairness: between users by their weight,
+    then between each user's streams, highest priority first and evenly
+    within a priority, so a user with several tabs open gets no more than
+    one with a single tab, and prefetches only get what the playing song
+    leaves. Streams that want less than their share, being paced or
+    paused, leave it to the others.
+
+    This is the fluid model that weighted fair queuing approximates. Each
+    stream sends through a token bucket at its share, holding at most two
+    chunks, so its chunks go out evenly spaced rather than in bursts. Shares
+    are recomputed every REALLOCATE_INTERVAL and whenever a stream starts or ends.
+    """
+    def __init__(self, rate=0, weights=None, default_weight=1.0, chunk_size=32768):
+        self.rate = rate  # Bytes/s for all streams together
+        self.weights = weights or {}  # username -> weight
+        self.default_weight = default_weight
+        self.chunk_size = chunk_size
+        self._flows = {}  # StreamPacer -> _Flow
+        self._allocated_at = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, pacer, username=None):
+        """Start sharing the budget with a stream; its first chunk can go at once"""
+        with self._lock:
+            self._flows[pacer] = _Flow(username, self.chunk_size, self.chunk_size * 2)
+            self._allocated_at = 0.0
+
+    def remove(self, pacer):
+        with self._lock:
+            if self._flows.pop(pacer, None) is not None:
+                self._allocated_at = 0.0
+
+    def _allocate(self, now):
+        flows = list(self._flows.items())
+        demands = {pacer: pacer.demand() for pacer, _ in flows}
+        shares = {pacer: min(demand, pacer.bitrate / 8) for pacer, demand in demands.items()}
+        guaranteed = sum(shares.values())
+        if guaranteed > self.rate:
+            # More admitted than fits (no admission control): everyone slows down alike
+            shares = {pacer: share * self.rate / guaranteed for pacer, share in shares.items()}
+        spare = self.rate - sum(shares.values())
+        if spare > 0:
+            users = {}
+            for pacer, flow in flows:
+                users.setdefault(flow.username, []).append(pacer)
+            wanted = {pacer: demands[pacer] - shares[pacer] for pacer in shares}
+            user_shares = fair_shares(spare, [
+                (username, self.weights.get(username, self.default_weight), sum(wanted[p] for p in pacers))
+                for username, pacers in users.items()])
+            for username, pacers in users.items():
+                left = user_shares[username]
+                for priority in sorted({pacer.priority for pacer in pacers}, reverse=True):
+                    claims = [(pacer, 1.0, wanted[pacer]) for pacer in pacers if pacer.priority == priority]
+                    for pacer, share in fair_shares(left, claims).items():
+                        shares[pacer] += share
+                        left = max(0.0, left - share)
+        for pacer, flow in flows:
+            flow.refill(now)
+            flow.rate = shares[pacer]
+        self._allocated_at = now
+
+    def reserve(self, pacer, nbytes):
+        """Take nbytes from a stream's share and return how long to wait before sending them"""
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        with self._lock:
+            flow = self._flows.get(pacer)
+            if flow is None:
+                return 0.0
+            if flow.rate <= 0 or now - self._allocated_at >= REALLOCATE_INTERVAL:
+                self._allocate(now)
+            if flow.rate <= 0:
+                return REALLOCATE_INTERVAL  # Nothing left for it right now; ask again soon
+            flow.refill(now)
+            flow.tokens -= nbytes
+            return -flow.tokens / flow.rate if flow.tokens < 0 else 0.0
+
+    def share(self, pacer):
+        """A stream's current share in bytes/s, or None if it isn't sharing the budget"""
+        flow = self._flows.get(pacer)
+        return int(flow.rate) if flow is not None and self.rate > 0 else None
+
+    def stats(self):
+        with self._lock:
+            flows = list(self._flows.values())
+        users = {}
+        for flow in flows:
+            users[flow.username] = users.get(flow.username, 0) + flow.rate
+        return {
+            "budget": int(self.rate) or None,
+            "streams": len(flows),
+            "allocated": int(sum(flow.rate for flow in flows)),
+            "users": {username: int(rate) for username, rate in users.items()},
+        }
+
+# Registry of streams currently being sent, for per-stream stats
+_streams_lock = threading.Lock()
+_active_streams = {}
+_next_stream_id = 0
+
+def register_stream(pacer, song_name, username=None):
+    """Record an active stream and return its id"""
+    global _next_stream_id
+    if pacer.egress is not None:
+        pacer.egress.add(pacer, username)
+    with _streams_lock:
+        _next_stream_id += 1
+        _active_streams[_next_stream_id] = (pacer, song_name, username)
+        return _next_stream_id
+
+def unregister_stream(stream_id):
+    with _streams_lock:
+        entry = _active_streams.pop(stream_id, None)
+    if entry is not None and entry[0].egress is not None:
+        entry[0].egress.remove(entry[0])
+
+def stream_stats(username=None):
+    """Return stats for active streams, optionally only those of one user"""
+    with _streams_lock:
+        streams = list(_active_streams.items())
+    return [
+        dict(pacer.stats(), id=stream_id, name=song_name, username=user)
+        for stream_id, (pacer, song_name, user) in streams
+        if username is None or user == username
+    ]
@@ -0,0 +1,172 @@
+import array
+import bisect
+import heapq
+import os
+import re
+import threading
+import time
+import unicodedata
+
+_WORD = re.compile(r"\w+")
+
+# Scores for how well one query word matches a word of a track
+EXACT_MATCH = 3
+PREFIX_MATCH = 2
+SUBSTRING_MATCH = 1
+
+def normalize(text):
+    """Lowercase text and strip accents, so "Beyoncé" matches "beyonce" """
+    decomposed = unicodedata.normalize("NFKD", text)
+    return "".join(c for c in decomposed if not unicodedata.combining(c)).casefold()
+
+def tokenize(text):
+    return _WORD.findall(normalize(text))
+
+def trigrams(word):
+    return {word[i:i + 3] for i in range(len(word) - 2)}
+
+class _Index:
+    """One immutable build of the search index.
+
+    words is the sorted list of distinct words, so the words starting with a
+    prefix are a contiguous range found by bisection. postings[i] holds the
+    ids (positions in names) of the tracks containing words[i]. word_trigrams
+    maps each trigram to the ids of the words containing it, for matching
+    inside words.
+    """
+    def __init__(self, names, words, postings, word_trigrams, generation):
+        self.names = names
+        self.words = words
+        self.postings = postings
+        self.word_trigrams = word_trigrams
+        self.generation = generation
+
+    def match_word(self, query_word):
+        """Return {track id: score} for the tracks with a word matching query_word"""
+        matches = {}
+        i = bisect.bisect_left(self.words, query_word)
+        while i < len(self.words) and self.words[i].startswith(query_word):
+            score = EXACT_MATCH if self.words[i] == query_word else PREFIX_MATCH
+            for track_id in self.postings[i]:
+                if matches.get(track_id, 0) < score:
+                    matches[track_id] = score
+            i += 1
+        if len(query_word) >= 3:
+            # Words containing every trigram of the query are candidates for a substring match
+            candidates = None
+            for postings in sorted((self.word_trigrams.get(t, ()) for t in trigrams(query_word)), key=len):
+                candidates = set(postings) if candidates is None else candidates.intersection(postings)
+                if not candidates:
+                    break
+            for word_id in candidates or ():
+                word = self.words[word_id]
+                if query_word in word and not word.startswith(query_word):
+                    for track_id in self.postings[word_id]:
+                        matches.setdefault(track_id, SUBSTRING_MATCH)
+        return matches
+
+class SearchIndex:
+    """Prefix and trigram search over track file names, titles and artists.
+
+    The index is built from the catalog and the tags the TrackIndexer has
+    already read, and rebuilt in a background thread whenever either
+    changes; searches keep using the previous build until the new one is
+    ready. start() makes the first build before it returns, so a search
+    never waits for one; until then there is nothing to find. Every word of a query has to match a word of the track, exactly,
+    as a prefix, or (for 3+ characters) anywhere inside it. Better matches
+    rank first, then tracks in name order.
+    """
+    def __init__(self, catalog, indexer, poll_interval=2.0):
+        self.catalog = catalog
+        self.indexer = indexer
+        self.poll_interval = poll_interval
+        self._index = None
+        self._lock = threading.Lock()
+        self._thread = None
+        self.build_time = 0.0
+
+    def _generation(self):
+        return (self.catalog.generation, self.indexer.generation)
+
+    def build(self):
+        """Build a fresh index of the library and start using it"""
+        with self._lock:
+            generation = self._generation()
+            started = time.time()
+            names = self.catalog.songs()
+            word_ids = {}
+            postings = []
+            for track_id, name in enumerate(names):
+                text = [os.path.splitext(name)[0]]
+                metadata = self.indexer.cached_metadata(name) or {}
+                text.extend(metadata.get(field) or "" for field in ("title", "artist", "album"))
+                for word in set(tokenize(" ".join(text))):
+                    word_id = word_ids.get(word)
+                    if word_id is None:
+                        word_id = word_ids[word] = len(postings)
+                        postings.append(array.array("I"))
+                    postings[word_id].append(track_id)
+
+            # Renumber the words in sorted order for prefix lookups
+            words = sorted(word_ids)
+            sorted_postings = [postings[word_ids[word]] for word in words]
+            word_trigrams = {}
+            for word_id, word in enumerate(words):
+                for trigram in trigrams(word):
+                    word_trigrams.setdefault(trigram, array.array("I")).append(word_id)
+            self._index = _Index(names, words, sorted_postings, word_trigrams, generation)
+            self.build_time = time.time() - started
+            return self._index
+
+    def search(self, query, limit):
+        """Return up to limit track names matching query, best matches first"""
+        index = self._index
+        query_words = tokenize(query)
+        if index is None or not query_words:
+            return []
+        scores = None
+        for query_word in sorted(set(query_words), key=len, reverse=True):
+            matches = index.match_word(query_word)
+            if scores is None:
+                scores = matches
+            else:
+                scores = {track_id: score + matches[track_id]
+                          for track_id, score in scores.items() if track_id in matches}
+            if not scores:
+                return []
+        best = heapq.nsmallest(limit, ((-score, track_id) for track_id, score in scores.items()))
+        return [index.names[track_id] for _, track_id in best]
+
+    def start(self):
+        """Build the index if it is out of date, then keep it up to date in a background thread"""
+        if self._thread is not None:
+            return
+        def update():
+            index = self._index
+            if index is None or index.generation != self._generation():
+                try:
+                    self.build()
+                    print(f"Built search index of {len(self._index.names)} songs "
+                          f"({len(self._index.words)} words) in {self.build_time:.2f}s")
+                except Exception as e:
+                    print(f"Error building search index: {e}")
+        def run():
+            while True:
+                time.sleep(self.poll_interval)
+                update()
+        update()
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+
+    def after_fork(self):
+        """Reset state inherited from the parent process; call start() again to keep up to date"""
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def stats(self):
+        index = self._index
+        return {
+            "songs": len(index.names) if index else 0,
+            "words": len(index.words) if index else 0,
+            "build_seconds": round(self.build_time, 3),
+        }
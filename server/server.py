@@ -7,27 +7,101 @@ import base64
 import ssl
 import http.server
 import struct
+import argparse
+import asyncio
+import select
+import mimetypes
+import bisect
+import math
 from uuid import uuid4
 
 # Add this import
 import re
 import time
 
+from catalog import MusicCatalog
+from chunk_cache import ChunkCache, TrackReader
+from mp3info import TrackIndexer, load_track_index, read_bitrate
+from transcode import RenditionStore, RENDITION_BITRATES
+from analyze import LibraryAnalyzer, analysis_available
+from search import SearchIndex
+from workers import WorkerPool, cluster_stats
+from session_tokens import SessionTokens
+from broadcast import Broadcaster
+from metrics import MetricsRegistry, merge_snapshots, render, serve_metrics
+from logs import log, setup_logging, restart_log_writer, stop_logging, log_stats
+from diagnostics import Diagnostics, DEFAULT_SAMPLE_INTERVAL, DEFAULT_HEAP_FRAMES, DEFAULT_TRACE_SAMPLE_RATE
+from http_tracks import (HTTPRequestReader, HTTPError, TRACKS_PREFIX, parse_range, etag_matches,
+                         http_date, build_response, error_response)
+from multiplex import (OutgoingStream, StreamScheduler, MUX_SUBPROTOCOL, MAX_STREAM_ID, PRIORITIES,
+                       STREAM_ID)
+from pacing import (StreamPacer, EgressScheduler, DEFAULT_BITRATE, send_queue_bytes, send_buffer_size,
+                    register_stream, unregister_stream, stream_stats)
+from admission import AdmissionControl, Busy, UserStreamCounts
+
 # Server configuration
 HOST = '0.0.0.0'  # Listen on all available network interfaces
 PORT = 8443       # Standard secure WebSocket port (changed from 8080)
 USE_SSL = True    # Enable SSL/TLS
+SERVER_MODE = "threaded"  # "threaded" (thread per connection) or "asyncio" (single event loop)
+LISTEN_BACKLOG = 1024     # Connections the kernel queues until they are accepted
+HANDSHAKE_TIMEOUT = 10.0  # Seconds allowed for the TLS handshake (and then the first request)
+HTTP_KEEPALIVE_TIMEOUT = 15.0  # Seconds an idle HTTP connection waits for its next /tracks request
+HTTP_MAX_REQUESTS = 100        # Requests served on one HTTP connection before it is closed
+CERT_TYPE = "rsa"         # "rsa" or "ecdsa" (P-256, cheaper handshakes) for the generated certificate
+TLS_NUM_TICKETS = 2       # TLS 1.3 session tickets issued per connection, so reconnects can resume
+WORKERS = 1               # Worker processes sharing the port via SO_REUSEPORT (1 = serve in this process)
+REUSE_PORT = False        # Set when running as one of several workers
+CHUNK_SIZE = 32768        # Bytes of audio per binary frame
+MAX_STREAMS = 4           # Songs one multiplexed connection may stream at once
+SONG_PAGE_SIZE = 100      # Songs per SONG_LIST page (and in AUTH_SUCCESS) unless the client asks otherwise
+SONG_PAGE_MAX = 1000      # Largest page (or number of search results) a client can ask for
+SEARCH_LIMIT = 50         # Search results returned unless the client asks otherwise
+PACING_MULTIPLIER = 1.5   # Steady-state send rate as a multiple of the track bitrate (0 disables pacing)
+PACING_BURST_SECONDS = 10.0  # Seconds of audio sent at full speed before pacing starts
+CHUNK_CACHE_BYTES = 128 * 1024 * 1024  # Memory budget for the shared chunk cache (0 disables caching)
+CACHE_MAX_TRACK_FRACTION = 0.25  # Tracks larger than this share of the budget bypass the cache
+RENDITION_CACHE_BYTES = 2 * 1024 * 1024 * 1024  # Disk budget for transcoded lower-bitrate copies
+TRANSCODE_WORKERS = max(1, (os.cpu_count() or 2) // 2)  # ffmpeg processes encoding in the background
+LIVE_TRANSCODES = os.cpu_count() or 2  # On-the-fly transcodes at once; beyond that streams get the original
+AUTO_DEFAULT_QUALITY = None  # Quality "auto" picks before the user's link is measured (None: the original file)
+AUTO_HEADROOM = 1.5         # The link must carry this multiple of a rendition's bitrate for "auto" to pick it
+ANALYZE_IN_BACKGROUND = False  # Analyse new tracks (loudness, waveform) while serving; see analyze.py
+ANALYSIS_WORKERS = 1           # Processes decoding tracks for background analysis
+CHANNEL_RING_CHUNKS = 64       # Chunks a broadcast channel keeps for listeners that fall behind
+CHANNEL_JOIN_BURST_SECONDS = 5.0  # Audio a channel listener gets at once when joining
+MAX_CHANNEL_NAME = 64          # Longest broadcast channel name
+METRICS_HOST = "127.0.0.1"     # Interface the Prometheus metrics endpoint listens on (local only)
+METRICS_PORT = 9464            # Port of the metrics endpoint, at /metrics (0 disables it)
+LOG_LEVEL = "info"             # "debug" also logs every message received and streaming progress
+MAX_CONNECTIONS = 2048         # Open connections; more are answered with BUSY (0 = no limit)
+MAX_ACTIVE_STREAMS = 0         # Streams sending at once, over all users (0 = no limit)
+MAX_USER_STREAMS = 0           # Streams one user may have at once, unless user_config.json says otherwise
+EGRESS_MBPS = 0                # Egress budget for audio streams in Mbit/s, shared fairly between users (0 = none)
 
 # Get absolute path for music directory
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 PROJECT_DIR = os.path.dirname(BASE_DIR)
 MUSIC_DIR = os.path.join(PROJECT_DIR, 'music')  # Directory containing audio files
 CERT_DIR = os.path.join(BASE_DIR, "certs")
-CERT_FILE = os.path.join(CERT_DIR, "server.crt")
+CERT_FILE = os.path.join(CERT_DIR, "server.crt")  # ECDSA: server-ecdsa.crt (see generate_cert.cert_paths)
 KEY_FILE = os.path.join(CERT_DIR, "server.key")
+CATALOG_SNAPSHOT = os.path.join(BASE_DIR, "catalog.db")  # Persisted music index
+CATALOG_POLL_INTERVAL = 2.0  # Seconds between checks for changes in MUSIC_DIR
+INDEX_CACHE_DIR = os.path.join(BASE_DIR, "cache", "index")  # Per-track MP3 frame indexes
+RENDITION_CACHE_DIR = os.path.join(BASE_DIR, "cache", "renditions")  # Transcoded copies of tracks
+ANALYSIS_CACHE_DIR = os.path.join(BASE_DIR, "cache", "analysis")  # Loudness and waveform sidecars
+DIAGNOSTICS_DIR = os.path.join(BASE_DIR, "cache", "diagnostics")  # Profiles, heap snapshots and traces
+DIAGNOSTICS_PREFIX = "/admin/diagnostics/"  # Admin users download those files at /admin/diagnostics/<name>
+SESSION_SECRET_FILE = os.path.join(CERT_DIR, "session.key")  # Signing key for session tokens
+SESSION_TOKEN_TTL = 24 * 60 * 60  # Seconds a session token stays valid after it is issued
 
 # Simple user database - in production, use a proper database
-# Try to load users from config file, or use defaults if file doesn't exist
+# Try to load users from config file, or use defaults if file doesn't exist.
+# Users with "admin": true may profile and trace the server (ADMIN messages);
+# "max_streams" overrides MAX_USER_STREAMS and "weight" sets a user's share of EGRESS_MBPS
+USER_STREAM_LIMITS = {}
+USER_WEIGHTS = {}
 try:
     import json
     user_config_path = os.path.join(BASE_DIR, "user_config.json")
@@ -36,6 +110,11 @@ try:
         with open(user_config_path, 'r') as f:
             user_data = json.load(f)
             USERS = {u['username']: u['password_hash'] for u in user_data['users']}
+            ADMIN_USERS = {u['username'] for u in user_data['users'] if u.get('admin')}
+            USER_STREAM_LIMITS = {u['username']: int(u['max_streams']) for u in user_data['users']
+                                  if 'max_streams' in u}
+            USER_WEIGHTS = {u['username']: float(u['weight']) for u in user_data['users']
+                            if float(u.get('weight', 0)) > 0}
             print(f"Loaded {len(USERS)} users from configuration file")
     else:
         # Default users for testing
@@ -43,6 +122,7 @@ try:
             "user1": hashlib.sha256("password1".encode()).hexdigest(),
             "user2": hashlib.sha256("password2".encode()).hexdigest()
         }
+        ADMIN_USERS = set()  # Admin rights are opt-in; never for the well-known test accounts
         
         # Create example user config file
         example_config = {
@@ -64,24 +144,41 @@ except Exception as e:
         "user1": hashlib.sha256("password1".encode()).hexdigest(),
         "user2": hashlib.sha256("password2".encode()).hexdigest()
     }
+    ADMIN_USERS = set()
 
 # WebSocket constants
 GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+OPCODE_CONTINUATION = 0x0
+OPCODE_TEXT = 0x1
+OPCODE_BINARY = 0x2
+OPCODE_CLOSE = 0x8
+OPCODE_PING = 0x9
+OPCODE_PONG = 0xA
+MAX_MESSAGE_SIZE = 1024 * 1024  # Largest client message accepted (1MB)
+RECV_SIZE = 65536               # Bytes requested per recv() call
+MAX_FRAME_HEADER = 10           # Largest header of an unmasked server frame
+CLOSE_TRY_AGAIN_LATER = 1013    # Close code after BUSY, for connections over MAX_CONNECTIONS
 
 # Create SSL context
-def create_ssl_context():
-    # Generate certificates if they don't exist
+def ensure_certificates():
+    """Generate a self-signed certificate if there is none; returns False on failure"""
     if not os.path.exists(CERT_FILE) or not os.path.exists(KEY_FILE):
         try:
             from generate_cert import generate_self_signed_cert
-            generate_self_signed_cert(CERT_DIR)
+            generate_self_signed_cert(CERT_DIR, CERT_TYPE)
         except ImportError:
             print("Error importing generate_cert module. Make sure PyOpenSSL is installed.")
             print("Run: pip install pyopenssl")
-            return None
+            return False
         except Exception as e:
             print(f"Error generating certificates: {e}")
-            return None
+            return False
+    return True
+
+def create_ssl_context():
+    # Generate certificates if they don't exist
+    if not ensure_certificates():
+        return None
     
     try:
         # Create SSL context
@@ -97,60 +194,139 @@ def create_ssl_context():
         # Prefer server's cipher selection
         context.options |= ssl.OP_CIPHER_SERVER_PREFERENCE
         
+        # Let reconnecting clients resume instead of paying for a full handshake:
+        # session tickets for TLS 1.3, plus the server-side session cache for TLS 1.2
+        context.options &= ~ssl.OP_NO_TICKET
+        context.num_tickets = TLS_NUM_TICKETS
+        
         # Print SSL configuration
         print(f"SSL configuration:")
         print(f" - Certificate: {CERT_FILE}")
         print(f" - Private key: {KEY_FILE}")
+        print(f" - Session tickets: {TLS_NUM_TICKETS} per connection")
         
         return context
     except Exception as e:
         print(f"Error creating SSL context: {e}")
         return None
 
-# Create a list of available songs
-def get_song_list():
+# Created once by get_ssl_context(); forked workers inherit it, and with it the
+# ticket keys, so a session resumes on whichever worker the client lands on
+ssl_context = None
+
+def get_ssl_context():
+    """Return the server's SSL context, creating it on first use (None if SSL is unavailable)"""
+    global ssl_context
+    if ssl_context is None:
+        ssl_context = create_ssl_context()
+    return ssl_context
+
+def tls_stats():
+    """Return handshake and session resumption counters, or None without SSL"""
+    if ssl_context is None:
+        return None
+    stats = ssl_context.session_stats()
+    return {
+        "handshakes": stats["accept_good"],
+        "resumed": stats["hits"],
+        "cache_misses": stats["misses"],
+        "cached_sessions": stats["number"],
+    }
+
+# In-memory index of MUSIC_DIR, refreshed in the background (see init_catalog)
+catalog = MusicCatalog(MUSIC_DIR, CATALOG_SNAPSHOT, CATALOG_POLL_INTERVAL)
+# Frame indexes and tags for every catalog track, built in the background
+indexer = TrackIndexer(catalog, INDEX_CACHE_DIR, CATALOG_POLL_INTERVAL)
+# Loudness and waveforms, written by analyze.py (or in the background with ANALYZE_IN_BACKGROUND)
+analyzer = LibraryAnalyzer(catalog, ANALYSIS_CACHE_DIR, ANALYSIS_WORKERS, CATALOG_POLL_INTERVAL)
+# Word index over file names and tags for SEARCH, rebuilt when either changes
+search_index = SearchIndex(catalog, indexer, CATALOG_POLL_INTERVAL)
+
+def init_catalog():
+    """Load the catalog snapshot, rescan what changed and start watching for changes"""
     # Create music directory if it doesn't exist
     if not os.path.exists(MUSIC_DIR):
         os.makedirs(MUSIC_DIR)
         print(f"Created music directory at: {MUSIC_DIR}")
         print("Please add MP3 files to this directory.")
     
-    songs = [f for f in os.listdir(MUSIC_DIR) if f.endswith('.mp3')]
-    print(f"Available songs: {songs}")
-    return songs
+    if catalog.load_snapshot():
+        print(f"Loaded catalog snapshot with {len(catalog)} songs")
+    catalog.refresh()
+    catalog.start_polling()
+    indexer.start()
+    search_index.start()
+    if ANALYZE_IN_BACKGROUND:
+        analyzer.start()
+    print(f"Available songs: {len(catalog)}")
+
+def page_limit(value, default):
+    """Clamp a client-supplied page size to 1..SONG_PAGE_MAX"""
+    try:
+        return max(1, min(SONG_PAGE_MAX, int(value))) if value is not None else default
+    except (TypeError, ValueError):
+        return default
+
+# One page of the available songs, in name order
+def get_song_list(cursor=None, limit=SONG_PAGE_SIZE):
+    """Return the songs, next_cursor and total fields of a SONG_LIST page"""
+    songs, next_cursor = catalog.page(cursor, limit)
+    return {"songs": songs, "next_cursor": next_cursor, "total": len(catalog)}
+
+def build_handshake_response(data):
+    """Build the 101 response for a WebSocket upgrade request, or None if the key is missing"""
+    # Parse the WebSocket handshake request
+    key_match = re.search(r'Sec-WebSocket-Key: (.*)\r\n', data)
+    if not key_match:
+        log.warning("WebSocket key not found in request")
+        return None
+        
+    websocket_key = key_match.group(1).strip()
+    log.debug("WebSocket key: %s", websocket_key)
+    
+    # Calculate the WebSocket accept key
+    accept_key = base64.b64encode(
+        hashlib.sha1((websocket_key + GUID).encode()).digest()
+    ).decode()
+    
+    # Clients asking for the multiplexing subprotocol get stream ids on binary messages
+    protocol = f"Sec-WebSocket-Protocol: {MUX_SUBPROTOCOL}\r\n" if wants_multiplexing(data) else ""
+    return (
+        "HTTP/1.1 101 Switching Protocols\r\n"
+        "Upgrade: websocket\r\n"
+        "Connection: Upgrade\r\n"
+        f"{protocol}"
+        f"Sec-WebSocket-Accept: {accept_key}\r\n\r\n"
+    ).encode()
+
+def wants_multiplexing(data):
+    """Whether a WebSocket upgrade request offers the multiplexing subprotocol"""
+    match = re.search(r'Sec-WebSocket-Protocol: (.*)\r\n', data, re.IGNORECASE)
+    return match is not None and MUX_SUBPROTOCOL in (p.strip() for p in match.group(1).split(","))
 
 def handle_websocket_handshake(conn, data):
     """Handle the WebSocket handshake protocol"""
     try:
-        # Parse the WebSocket handshake request
-        key_match = re.search(r'Sec-WebSocket-Key: (.*)\r\n', data)
-        if not key_match:
-            print("WebSocket key not found in request")
+        handshake_response = build_handshake_response(data)
+        if handshake_response is None:
             return False
-            
-        websocket_key = key_match.group(1).strip()
-        print(f"WebSocket key: {websocket_key}")
-        
-        # Calculate the WebSocket accept key
-        accept_key = base64.b64encode(
-            hashlib.sha1((websocket_key + GUID).encode()).digest()
-        ).decode()
         
         # Send the WebSocket handshake response
-        handshake_response = (
-            "HTTP/1.1 101 Switching Protocols\r\n"
-            "Upgrade: websocket\r\n"
-            "Connection: Upgrade\r\n"
-            f"Sec-WebSocket-Accept: {accept_key}\r\n\r\n"
-        )
-        
-        conn.send(handshake_response.encode())
-        print("WebSocket handshake completed")
+        conn.sendall(handshake_response)
+        log.debug("WebSocket handshake completed")
         return True
     except Exception as e:
-        print(f"WebSocket handshake error: {e}")
+        log.warning("WebSocket handshake error: %s", e)
         return False
 
+def unmask_payload(payload, mask_key):
+    """Unmask a client payload by XORing it with the repeated mask as one big integer"""
+    length = len(payload)
+    if length == 0:
+        return b""
+    mask = (bytes(mask_key) * (length // 4 + 1))[:length]
+    return (int.from_bytes(payload, "big") ^ int.from_bytes(mask, "big")).to_bytes(length, "big")
+
 def decode_websocket_frame(data):
     """Decode a WebSocket frame"""
     try:
@@ -181,37 +357,227 @@ def decode_websocket_frame(data):
             mask_key = data[payload_start:payload_start+4]
             payload_start += 4
             
-            payload = bytearray(data[payload_start:payload_start+payload_length])
-            for i in range(len(payload)):
-                payload[i] ^= mask_key[i % 4]
-                
+            payload = unmask_payload(data[payload_start:payload_start+payload_length], mask_key)
             return payload.decode()
         else:
             return data[payload_start:payload_start+payload_length].decode()
     except Exception as e:
-        print(f"Error decoding WebSocket frame: {e}")
+        log.warning("Error decoding WebSocket frame: %s", e)
         return None
 
-def encode_websocket_frame(message, opcode=0x01):
-    """Encode a message as a WebSocket frame"""
-    if isinstance(message, str):
-        message = message.encode()
+class WebSocketProtocolError(Exception):
+    """Raised when a peer violates RFC 6455; close_code is sent in the close frame"""
+    def __init__(self, message, close_code=1002):
+        super().__init__(message)
+        self.close_code = close_code
+
+class WebSocketFrameReader:
+    """Incremental WebSocket parser fed with raw socket data.
+
+    Bytes are buffered until a whole frame is available, so frames split
+    across recv() calls or coalesced into one are both handled. Fragmented
+    messages are reassembled; control frames (close/ping/pong) may arrive
+    between fragments and are returned as soon as they are complete.
+    """
+    def __init__(self, max_message_size=MAX_MESSAGE_SIZE):
+        self.buffer = bytearray()
+        self.max_message_size = max_message_size
+        self._fragment_opcode = None
+        self._fragments = []
+        self._fragment_size = 0
+
+    def feed(self, data):
+        """Append received bytes to the buffer"""
+        self.buffer += data
+
+    def _read_frame(self):
+        """Remove one complete frame from the buffer, or return None if it is incomplete"""
+        buffer = self.buffer
+        if len(buffer) < 2:
+            return None
+        
+        fin = (buffer[0] & 0x80) != 0
+        opcode = buffer[0] & 0x0F
+        is_masked = (buffer[1] & 0x80) != 0
+        payload_length = buffer[1] & 0x7F
+        
+        header_length = 2
+        if payload_length == 126:
+            if len(buffer) < 4:
+                return None
+            payload_length = struct.unpack_from(">H", buffer, 2)[0]
+            header_length = 4
+        elif payload_length == 127:
+            if len(buffer) < 10:
+                return None
+            payload_length = struct.unpack_from(">Q", buffer, 2)[0]
+            header_length = 10
+        
+        if payload_length > self.max_message_size:
+            raise WebSocketProtocolError(f"Frame of {payload_length} bytes exceeds limit", 1009)
+        
+        mask_key = None
+        if is_masked:
+            mask_key = bytes(buffer[header_length:header_length + 4])
+            header_length += 4
+        
+        frame_length = header_length + payload_length
+        if len(buffer) < frame_length:
+            return None
         
+        payload = bytes(buffer[header_length:frame_length])
+        del buffer[:frame_length]
+        if mask_key is not None:
+            payload = unmask_payload(payload, mask_key)
+        return fin, opcode, payload
+
+    def messages(self):
+        """Yield (opcode, payload) for every complete message currently buffered"""
+        while True:
+            frame = self._read_frame()
+            if frame is None:
+                return
+            fin, opcode, payload = frame
+            
+            if opcode >= OPCODE_CLOSE:
+                # Control frames are never fragmented and carry at most 125 bytes
+                if not fin or len(payload) > 125:
+                    raise WebSocketProtocolError("Invalid control frame")
+                yield opcode, payload
+            elif opcode == OPCODE_CONTINUATION:
+                if self._fragment_opcode is None:
+                    raise WebSocketProtocolError("Continuation frame without a message to continue")
+                self._append_fragment(payload)
+                if fin:
+                    message = b"".join(self._fragments)
+                    message_opcode = self._fragment_opcode
+                    self._fragment_opcode = None
+                    self._fragments = []
+                    self._fragment_size = 0
+                    yield message_opcode, message
+            elif opcode in (OPCODE_TEXT, OPCODE_BINARY):
+                if self._fragment_opcode is not None:
+                    raise WebSocketProtocolError("New message started before the previous one finished")
+                if fin:
+                    yield opcode, payload
+                else:
+                    self._fragment_opcode = opcode
+                    self._append_fragment(payload)
+            else:
+                raise WebSocketProtocolError(f"Unknown opcode {opcode:#x}")
+
+    def _append_fragment(self, payload):
+        self._fragment_size += len(payload)
+        if self._fragment_size > self.max_message_size:
+            raise WebSocketProtocolError("Fragmented message exceeds limit", 1009)
+        self._fragments.append(payload)
+
+def handle_control_frame(opcode, payload):
+    """Return (reply_frame, should_close) for a close/ping/pong frame"""
+    if opcode == OPCODE_PING:
+        return encode_websocket_frame(payload, opcode=OPCODE_PONG), False
+    if opcode == OPCODE_CLOSE:
+        # Echo the status code back, as RFC 6455 requires
+        return encode_websocket_frame(payload[:2], opcode=OPCODE_CLOSE), True
+    return None, False
+
+def close_frame(close_code):
+    """Build a close frame carrying the given status code"""
+    return encode_websocket_frame(struct.pack(">H", close_code), opcode=OPCODE_CLOSE)
+
+def websocket_frame_header(length, opcode=0x01):
+    """Build the header of an unmasked, final WebSocket frame with the given payload length"""
     # First byte: FIN bit (1) + reserved bits (000) + opcode (4 bits)
     first_byte = 0x80 | opcode  # 0x01 for text, 0x02 for binary
     
     # Second byte: MASK bit (0) + payload length (7 bits)
-    length = len(message)
     if length < 126:
-        frame = bytes([first_byte, length])
+        return bytes((first_byte, length))
     elif length < 65536:
-        frame = bytes([first_byte, 126]) + struct.pack(">H", length)
+        return struct.pack(">BBH", first_byte, 126, length)
     else:
-        frame = bytes([first_byte, 127]) + struct.pack(">Q", length)
-        
-    # Append payload
-    frame += message
-    return frame
+        return struct.pack(">BBQ", first_byte, 127, length)
+
+def encode_websocket_frame(message, opcode=0x01):
+    """Encode a message as a WebSocket frame"""
+    if isinstance(message, str):
+        message = message.encode()
+    
+    # Header and payload are copied exactly once, into the joined frame
+    return b"".join((websocket_frame_header(len(message), opcode), message))
+
+def audio_frame_header(length, prefix=b""):
+    """Header of a binary message carrying length bytes of audio after a stream id prefix"""
+    return websocket_frame_header(length + len(prefix), OPCODE_BINARY) + prefix
+
+def encode_audio_chunk(payload, prefix=b""):
+    """Frame an audio chunk as a binary message; returns (frame, bytes in front of the audio)"""
+    header = audio_frame_header(len(payload), prefix)
+    return b"".join((header, payload)), len(header)
+
+def audio_frame_from_cache(entry, skip=0, prefix=b""):
+    """Return (buffers, payload_length) for a cached chunk, dropping the first skip payload bytes"""
+    frame, header_length = entry
+    if skip or prefix:
+        # A seek landed inside this chunk, or the stream id goes first: send a new header plus a view of the rest
+        payload = memoryview(frame)[header_length + skip:]
+        return (audio_frame_header(len(payload), prefix), payload), len(payload)
+    return (frame,), len(frame) - header_length
+
+class AudioFrameBuffer:
+    """Reusable buffer that reads a chunk in place, just behind room for its frame header.
+
+    The frame is returned as a memoryview into the buffer, so sending a chunk
+    allocates nothing; the view is only valid until the next read_frame().
+    """
+    HEADROOM = MAX_FRAME_HEADER + STREAM_ID.size
+
+    def __init__(self, chunk_size):
+        self.buffer = bytearray(self.HEADROOM + chunk_size)
+        self.view = memoryview(self.buffer)
+
+    def read_frame(self, f, offset, length, prefix=b""):
+        f.seek(offset)
+        read = f.readinto(self.view[self.HEADROOM:self.HEADROOM + length])
+        header = audio_frame_header(read, prefix)
+        start = self.HEADROOM - len(header)
+        self.view[start:self.HEADROOM] = header
+        return self.view[start:self.HEADROOM + read], read
+
+def send_all(conn, buffers):
+    """Send a sequence of buffers in order, retrying partial writes.
+
+    Plain sockets use one scatter-gather sendmsg() call per attempt; TLS
+    sockets don't support sendmsg(), so each buffer goes through sendall().
+    Neither path joins or copies the buffers.
+    """
+    if isinstance(conn, ssl.SSLSocket):
+        for buffer in buffers:
+            conn.sendall(buffer)
+        return
+    views = [memoryview(buffer) for buffer in buffers]
+    while views:
+        sent = conn.sendmsg(views)
+        while views and sent >= len(views[0]):
+            sent -= len(views[0])
+            views.pop(0)
+        if sent:
+            views[0] = views[0][sent:]
+
+def send_file_chunk(conn, f, offset, length, prefix=b""):
+    """Send a binary frame whose payload goes straight from the file with os.sendfile (plain sockets only)"""
+    # MSG_MORE keeps the small header in the kernel until the payload follows
+    header = audio_frame_header(length, prefix)
+    view = memoryview(header)
+    while view:
+        view = view[conn.send(view, getattr(socket, "MSG_MORE", 0)):]
+    remaining = length
+    while remaining:
+        sent = os.sendfile(conn.fileno(), f.fileno(), offset, remaining)
+        if sent == 0:
+            raise EOFError("Track ended before the frame was complete")
+        offset += sent
+        remaining -= sent
 
 def send_websocket_message(conn, message):
     """Send a message over WebSocket"""
@@ -219,10 +585,10 @@ def send_websocket_message(conn, message):
         if isinstance(message, dict):
             message = json.dumps(message)
         frame = encode_websocket_frame(message)
-        conn.send(frame)
+        conn.sendall(frame)
         return True
     except Exception as e:
-        print(f"Error sending WebSocket message: {e}")
+        log.warning("Error sending WebSocket message: %s", e)
         return False
 
 def authenticate(conn, username, password):
@@ -230,172 +596,1290 @@ def authenticate(conn, username, password):
     password_hash = hashlib.sha256(password.encode()).hexdigest()
     
     if username in USERS and USERS[username] == password_hash:
-        print(f"Authentication successful for user: {username}")
+        log.info("Authentication successful for user: %s", username)
         return True
     else:
-        print(f"Authentication failed for user: {username}")
+        log.warning("Authentication failed for user: %s", username)
         return False
 
+# Tokens handed out with AUTH_SUCCESS, so a reconnecting client can skip the password
+session_tokens = SessionTokens(SESSION_SECRET_FILE, SESSION_TOKEN_TTL)
+
+def auth_success(username):
+    """Build the AUTH_SUCCESS message, including a fresh session token"""
+    token, expires = session_tokens.issue(username)
+    # Only the first page of songs: logging in shouldn't cost O(library)
+    reply = {
+        "type": "AUTH_SUCCESS",
+        "token": token,
+        "token_expires": expires
+    }
+    reply.update(get_song_list())
+    return reply
+
+# Audio chunks shared by every stream; see CHUNK_CACHE_BYTES
+chunk_cache = ChunkCache(CHUNK_CACHE_BYTES, CHUNK_SIZE, encode_audio_chunk)
+
+def use_chunk_cache(file_size):
+    """Whether a track should be streamed through the shared chunk cache"""
+    # Very large tracks (long mixes) would just flush everything else out
+    return chunk_cache.budget_bytes > 0 and file_size <= chunk_cache.budget_bytes * CACHE_MAX_TRACK_FRACTION
+
+# Lower-bitrate copies for slow links; see RENDITION_CACHE_BYTES
+renditions = RenditionStore(RENDITION_CACHE_DIR, RENDITION_CACHE_BYTES, TRANSCODE_WORKERS,
+                            live_limit=LIVE_TRANSCODES)
+
+# username -> throughput of their last stream (see ClientSession.record_stream); clients that open
+# a connection per song would otherwise never have a measurement for quality "auto" to go by
+user_throughput = {}
+
+def broadcast_track(song_name):
+    """Open a track for a broadcast channel: (path, size, bitrate, frame index, SONG_METADATA)"""
+    song_path, st, etag, track_info, _, _ = select_stream_source(song_name)
+    bitrate = track_info.get("bitrate") or read_bitrate(song_path)
+    return song_path, st.st_size, bitrate, indexer.index(song_name), song_metadata(
+        song_name, st.st_size, track_info, etag=etag)
+
+def next_channel_song(song_name):
+    """Channels play on through the library in name order, like a radio station"""
+    songs = catalog.songs()
+    if not songs:
+        return None
+    return songs[bisect.bisect_right(songs, song_name) % len(songs)]
+
+# Radio / listening-party channels; see JOIN_CHANNEL
+broadcaster = Broadcaster(broadcast_track, next_channel_song, encode_audio_chunk, CHUNK_SIZE,
+                          CHANNEL_RING_CHUNKS, CHANNEL_JOIN_BURST_SECONDS)
+
+# Limits on connections and streams, and the egress budget streams share fairly; see MAX_CONNECTIONS
+admission = AdmissionControl(MAX_CONNECTIONS, MAX_ACTIVE_STREAMS, MAX_USER_STREAMS, USER_STREAM_LIMITS,
+                             EGRESS_MBPS * 1000000 / 8)
+egress = EgressScheduler(EGRESS_MBPS * 1000000 / 8, USER_WEIGHTS, chunk_size=CHUNK_SIZE)
+
+# Counters and latency histograms, served in Prometheus format on METRICS_PORT
+metrics = MetricsRegistry()
+connections_total = metrics.counter("bytebeats_connections_total", "Connections accepted")
+connections_active = metrics.gauge("bytebeats_connections_active", "Connections open now")
+handshake_seconds = metrics.histogram(
+    "bytebeats_handshake_seconds",
+    "Connection accepted to WebSocket handshake answered (asyncio engine: from the end of the TLS handshake)")
+auth_total = metrics.counter("bytebeats_auth_total", "Logins by password or session token", ["result"])
+auth_seconds = metrics.histogram("bytebeats_auth_seconds",
+                                 "AUTH_REQUIRED sent to successful login, including the client's reply")
+first_byte_seconds = metrics.histogram("bytebeats_first_byte_seconds",
+                                       "PLAY_SONG or JOIN_CHANNEL received to the first audio chunk sent")
+bytes_sent_total = metrics.counter("bytebeats_bytes_sent_total", "Audio bytes sent, by send path", ["path"])
+chunk_send_seconds = metrics.histogram("bytebeats_chunk_send_seconds",
+                                       "Time to read (unless cached) and send one audio chunk, by send path", ["path"])
+catalog_lookups_total = metrics.counter("bytebeats_catalog_lookups_total",
+                                        "Song names requested by clients, by whether they exist", ["result"])
+track_open_seconds = metrics.histogram("bytebeats_track_open_seconds",
+                                       "Time to find, stat and describe the file to stream for a song")
+streams_started_total = metrics.counter("bytebeats_streams_started_total", "Streams started", ["kind"])
+stream_errors_total = metrics.counter("bytebeats_stream_errors_total", "Streams ended by an error", ["kind"])
+streams_active = metrics.gauge("bytebeats_streams_active", "Streams sending now, not counting channel listeners",
+                               function=lambda: len(stream_stats()))
+metrics.gauge("bytebeats_channel_listeners", "Listeners of broadcast channels now",
+              function=lambda: sum(channel["listeners"] for channel in broadcaster.stats().values()))
+http_requests_total = metrics.counter("bytebeats_http_requests_total", "HTTP requests answered", ["status"])
+busy_total = metrics.counter("bytebeats_busy_total", "Connections and streams turned away as BUSY, by limit",
+                             ["reason"])
+metrics.gauge("bytebeats_egress_allocated_bytes_per_second", "Egress budget shared out between streams now",
+              function=lambda: egress.stats()["allocated"])
+metrics.counter("bytebeats_chunk_cache_hits_total", "Chunk cache hits",
+                function=lambda: chunk_cache.stats()["hits"])
+metrics.counter("bytebeats_chunk_cache_misses_total", "Chunk cache misses",
+                function=lambda: chunk_cache.stats()["misses"])
+metrics.gauge("bytebeats_chunk_cache_bytes", "Audio held in the chunk cache",
+              function=lambda: chunk_cache.stats()["bytes"])
+metrics.counter("bytebeats_log_records_dropped_total", "Log records dropped because the log queue was full",
+                function=lambda: log_stats()["dropped"])
+metrics.counter("bytebeats_log_records_suppressed_total", "Log records dropped by the per-line rate limit",
+                function=lambda: log_stats()["suppressed"])
+
+# Profiling, heap snapshots and request tracing on demand; see admin_command()
+diagnostics = Diagnostics(DIAGNOSTICS_DIR)
+
+def trace_span(trace, name, start, **attrs):
+    """Record a span from start until now on a sampled connection's trace (None if it isn't sampled)"""
+    if trace is not None:
+        trace.span(name, start, time.monotonic(), **attrs)
+
+def record_chunk(request, path, send_started, payload_length, first):
+    """Count one audio chunk sent for request; first is whether it was the stream's first"""
+    now = time.monotonic()
+    chunk_send_seconds.labels(path).observe(now - send_started)
+    bytes_sent_total.labels(path).inc(payload_length)
+    if first:
+        first_byte_seconds.observe(now - request.requested_at)
+        trace_span(request.trace, "first_chunk", request.requested_at, song=request.name, path=path)
+    if request.trace is not None:
+        request.last_chunk_at = now
+
+def song_exists(song_name):
+    """Whether a song a client asked for is in the catalog"""
+    found = song_name in catalog
+    catalog_lookups_total.labels("hit" if found else "miss").inc()
+    return found
+
+def busy_reply(busy):
+    """The BUSY message for a connection or stream admission control turned away"""
+    busy_total.labels(busy.reason).inc()
+    log.info("Busy (%s), retry after %ss", busy.reason, busy.retry_after)
+    return {"type": "BUSY", "reason": busy.reason, "retry_after": busy.retry_after}
+
+def busy_http_response(busy):
+    """The 503 for an HTTP request on a connection admission control turned away"""
+    busy_total.labels(busy.reason).inc()
+    http_requests_total.labels("503").inc()
+    # Readable cross-origin, so the web app can tell a busy server from a broken track
+    headers = {
+        "Retry-After": str(math.ceil(busy.retry_after)),
+        "Access-Control-Allow-Origin": "*",
+        "Access-Control-Expose-Headers": "Retry-After"
+    }
+    return error_response(503, "Server busy", headers, keep_alive=False)
+
+def stream_rate(song_name, quality=None):
+    """Bytes/s a stream of a song needs to play in real time (without indexing it, if it isn't yet)"""
+    if quality:
+        return quality * 1000 / 8
+    info = indexer.cached_metadata(song_name) or {}
+    return (info.get("bitrate") or DEFAULT_BITRATE) / 8
+
+def admit_stream(session, stream_id, song_name, quality=None):
+    """Take an admission slot for a stream on stream_id; returns the BUSY reply if there's no room, else None.
+
+    A request replacing the stream (or queued request) on stream_id takes
+    over its slot, so switching songs never comes back BUSY.
+    """
+    if stream_id in session.slots:
+        return None
+    try:
+        session.slots[stream_id] = admission.acquire(session.username, stream_rate(song_name, quality))
+    except Busy as e:
+        return session.tag(dict(busy_reply(e), name=song_name), stream_id)
+    return None
+
+def parse_quality(value, session=None):
+    """Turn a requested quality into kbps, or None for the original file.
+
+    "auto" picks from the throughput measured for this user. Raises
+    ValueError for a bitrate we don't offer.
+    """
+    if value is None or value == "original":
+        return None
+    if value == "auto":
+        return session.pick_quality() if session else AUTO_DEFAULT_QUALITY
+    kbps = int(value)
+    if kbps not in RENDITION_BITRATES:
+        raise ValueError(f"Unsupported quality: {value}")
+    return kbps
+
+def select_stream_source(song_name, quality=None):
+    """Pick the file to stream for a song at a quality (kbps, or None for the original).
+
+    Returns (path, stat, etag, track_info, quality, live). With live=True the
+    rendition isn't ready yet (one has been queued) and path is the original
+    file, to be transcoded on the fly. Qualities at or above the track's own
+    bitrate, or without ffmpeg, fall back to the original.
+    """
+    started = time.monotonic()
+    try:
+        song_path = catalog.path(song_name)
+        st = os.stat(song_path)
+        track_info = indexer.metadata(song_name)
+        etag = song_etag(st.st_size, st.st_mtime_ns)
+        bitrate = track_info.get("bitrate")
+        if quality is None or not renditions.available or (bitrate and quality * 1000 >= bitrate):
+            return song_path, st, etag, track_info, None, False
+        
+        track_info = dict(track_info, bitrate=quality * 1000)
+        rendition = renditions.lookup(song_path, st.st_size, st.st_mtime_ns, quality)
+        if rendition is None:
+            renditions.request(song_path, st.st_size, st.st_mtime_ns, quality)
+            return song_path, st, None, track_info, quality, True
+        return rendition, os.stat(rendition), f"{etag}-{quality}k", track_info, quality, False
+    finally:
+        track_open_seconds.observe(time.monotonic() - started)
+
+def current_etag(song_name, quality=None):
+    """The (etag, size) select_stream_source would stream a song with now, without indexing it.
+
+    For the if_none_match and if_match checks, which run on the asyncio
+    event loop, where select_stream_source could scan the whole track: this
+    takes a stat or two, and the track's bitrate only if it is already in
+    memory. The etag is None when it can't be told that cheaply (or there'd
+    be a live transcode, which has none).
+    """
+    song_path = catalog.path(song_name)
+    if song_path is None:
+        return None, None
+    st = os.stat(song_path)
+    etag = song_etag(st.st_size, st.st_mtime_ns)
+    if quality is None or not renditions.available:
+        return etag, st.st_size
+    bitrate = (indexer.cached_metadata(song_name) or {}).get("bitrate")
+    if bitrate and quality * 1000 >= bitrate:
+        return etag, st.st_size
+    rendition = renditions.lookup(song_path, st.st_size, st.st_mtime_ns, quality)
+    if rendition is None:
+        return None, None
+    return f"{etag}-{quality}k", os.stat(rendition).st_size
+
+def resolve_start_position(song_name, file_size, start_time=None, start_offset=None, exact=False,
+                           rendition_path=None):
+    """Map a requested start time or byte offset to the nearest MPEG frame boundary.
+
+    Returns (byte_offset, start_time); start_time is None when the track has
+    no usable frame index and a byte offset was streamed as given. With
+    exact=True the byte offset is used as is, for clients resuming a
+    download that already hold every byte before it. Offsets into a
+    rendition are resolved against that rendition's own frames.
+    """
+    if not start_time and not start_offset:
+        return 0, 0.0
+    if exact:
+        return min(int(start_offset or 0), file_size), None
+    if rendition_path:
+        try:
+            index = load_track_index(rendition_path, INDEX_CACHE_DIR)
+        except OSError:
+            index = None
+    else:
+        index = indexer.index(song_name)
+    if index is None or not len(index.offsets):
+        offset = min(int(start_offset or 0), file_size)
+        return offset, (0.0 if offset == 0 else None)
+    
+    if start_offset:
+        frame = index.frame_at_offset(start_offset)
+        # Snap back instead if the previous frame boundary is closer
+        if frame > 0 and (frame == len(index.offsets) or
+                          start_offset - index.offsets[frame - 1] < index.offsets[frame] - start_offset):
+            frame -= 1
+    else:
+        frame = index.frame_at_time(start_time)
+    return index.offsets[frame], round(index.time_of_frame(frame), 3)
+
+def stream_start(song_name, song_path, file_size, track_info, request, quality):
+    """Return (start_offset, start_time, bitrate) for a stream; both may read files"""
+    start_offset, start_time = resolve_start_position(song_name, file_size, request.start_time,
+                                                      request.start_offset, request.exact,
+                                                      song_path if quality else None)
+    return start_offset, start_time, track_info.get("bitrate") or read_bitrate(song_path)
+
+def song_etag(file_size, mtime_ns):
+    """Identify one version of a track, so clients can revalidate cached copies"""
+    return f"{file_size:x}-{mtime_ns:x}"
+
+def song_metadata(song_name, file_size, track_info, start_offset=0, start_time=0.0, etag=None, quality=None):
+    """Build the SONG_METADATA message for a stream.
+
+    A live transcode has no size or etag yet: it can't be cached or resumed.
+    replaygain is None until the track has been analysed.
+    """
+    analysis = analyzer.get(song_name)
+    return {
+        "type": "SONG_METADATA",
+        "name": song_name,
+        "size": file_size,
+        "etag": etag,
+        "quality": quality or "original",
+        "duration": track_info.get("duration"),
+        "bitrate": track_info.get("bitrate"),
+        "title": track_info.get("title"),
+        "artist": track_info.get("artist"),
+        "replaygain": round(analysis.gain, 2) if analysis else None,
+        "start_offset": start_offset,
+        "start_time": start_time
+    }
+
+# Plain HTTP on the WebSocket port: GET/HEAD /tracks/<song>, so browsers can
+# stream, seek and cache tracks with an <audio> element
+def http_user(request):
+    """Return the user an HTTP request is authorised as, or None.
+
+    Media elements can't set headers, so the session token from
+    AUTH_SUCCESS may come as ?token= as well as "Authorization: Bearer".
+    """
+    token = request.query.get("token")
+    authorization = request.headers.get("authorization", "")
+    if authorization[:7].lower() == "bearer ":
+        token = authorization[7:].strip()
+    return session_tokens.verify(token)
+
+def diagnostics_response(request, keep_alive=True):
+    """Answer GET/HEAD /admin/diagnostics/<name>: a profile, heap snapshot or trace, for admin users"""
+    if request.method not in ("GET", "HEAD"):
+        return error_response(405, headers={"Allow": "GET, HEAD"}, keep_alive=keep_alive)
+    username = http_user(request)
+    if username is None:
+        return error_response(401, "A valid session token is required",
+                              {"WWW-Authenticate": "Bearer"}, keep_alive)
+    if username not in ADMIN_USERS:
+        return error_response(403, keep_alive=keep_alive)
+    name = request.path[len(DIAGNOSTICS_PREFIX):]
+    path = diagnostics.file_path(name)
+    if path is None:
+        return error_response(404, f"No such file: {name}", keep_alive=keep_alive)
+    size = os.path.getsize(path)
+    headers = {
+        "Content-Type": "application/octet-stream",
+        "Content-Length": str(size),
+        "Content-Disposition": f'attachment; filename="{name}"',
+        "Cache-Control": "no-store"
+    }
+    log.info("HTTP %s diagnostics %s by %s", request.method, name, username)
+    body = (path, 0, size) if request.method == "GET" and size else b""
+    return build_response(200, headers, keep_alive), body
+
+def http_response(request, keep_alive=True):
+    """Answer one HTTP request that isn't a WebSocket upgrade.
+
+    Returns (response header bytes, body): body is bytes, or (path,
+    offset, length) of the part of a file to send after the headers.
+    Supports single byte ranges (206), If-Range and If-None-Match (304);
+    ?quality= picks a rendition, falling back to the original file while
+    the rendition is still being transcoded, since ranges need the whole file.
+    """
+    if request.path.startswith(DIAGNOSTICS_PREFIX):
+        return diagnostics_response(request, keep_alive)
+    if not request.path.startswith(TRACKS_PREFIX):
+        return error_response(400, "WebSocket connection required", keep_alive=False)
+    if request.method not in ("GET", "HEAD"):
+        return error_response(405, headers={"Allow": "GET, HEAD"}, keep_alive=keep_alive)
+    if http_user(request) is None:
+        return error_response(401, "A valid session token is required",
+                              {"WWW-Authenticate": "Bearer"}, keep_alive)
+    song_name = request.path[len(TRACKS_PREFIX):]
+    if not song_exists(song_name):
+        return error_response(404, f"Song not found: {song_name}", keep_alive=keep_alive)
+    try:
+        quality = parse_quality(request.query.get("quality"))
+    except ValueError as e:
+        return error_response(400, str(e), keep_alive=keep_alive)
+
+    path, st, etag, _, quality, live = select_stream_source(song_name, quality)
+    if live:
+        path, st, etag, _, quality, _ = select_stream_source(song_name)
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": f'"{etag}"',
+        "Last-Modified": http_date(st.st_mtime),
+        # Cacheable, but revalidated with the ETag since the file can be replaced
+        "Cache-Control": "private, no-cache",
+        "Access-Control-Allow-Origin": "*"
+    }
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and etag_matches(if_none_match, etag):
+        return build_response(304, headers, keep_alive), b""
+
+    size = st.st_size
+    # A Range with an If-Range for another version of the file gets the whole new version
+    if_range = request.headers.get("if-range")
+    try:
+        byte_range = parse_range(request.headers.get("range"), size) if if_range in (None, headers["ETag"]) else None
+    except HTTPError:
+        headers["Content-Range"] = f"bytes */{size}"
+        return error_response(416, headers=headers, keep_alive=keep_alive)
+    status, first, last = 200, 0, size - 1
+    if byte_range is not None:
+        status, (first, last) = 206, byte_range
+        headers["Content-Range"] = f"bytes {first}-{last}/{size}"
+    headers["Content-Type"] = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    headers["Content-Length"] = str(last - first + 1)
+    log.info("HTTP %s %s (%s): %s, bytes %s-%s/%s", request.method, song_name, quality or "original", status,
+             first, last, size)
+    body = (path, first, last - first + 1) if request.method == "GET" and size else b""
+    return build_response(status, headers, keep_alive), body
+
+class ConnectionReceiver:
+    """Reads and handles the client's messages on a threaded connection.
+
+    serve_streams() calls receive() whenever it has nothing to send, and
+    briefly after every chunk, so PAUSE, RESUME, STOP and new songs take
+    effect within a chunk rather than after the whole file. Receiving stays
+    on the connection's own thread, so a TLS socket is never read and
+    written concurrently and replies never split a frame.
+    """
+    def __init__(self, conn, session):
+        self.conn = conn
+        self.session = session
+        self.frames = WebSocketFrameReader()
+
+    def receive(self, timeout=None):
+        """Handle every message that arrives within timeout seconds (None waits for data)"""
+        conn = self.conn
+        session = self.session
+        try:
+            if not (isinstance(conn, ssl.SSLSocket) and conn.pending()):
+                if not select.select([conn], [], [], timeout)[0]:
+                    return
+            conn.setblocking(False)
+            try:
+                data = conn.recv(RECV_SIZE)
+            except (ssl.SSLWantReadError, ssl.SSLWantWriteError, BlockingIOError):
+                return  # Only part of a TLS record so far
+            finally:
+                conn.setblocking(True)
+            if not data:
+                log.debug("Client disconnected")
+                session.closed = True
+                return
+            self.frames.feed(data)
+            
+            for opcode, payload in self.frames.messages():
+                if opcode >= OPCODE_CLOSE:
+                    reply_frame, closing = handle_control_frame(opcode, payload)
+                    if reply_frame:
+                        conn.sendall(reply_frame)
+                    if closing:
+                        log.debug("Client closed the connection")
+                        session.closed = True
+                        return
+                    continue
+                if opcode != OPCODE_TEXT:
+                    continue
+                
+                message = payload.decode()
+                log.debug("Received WebSocket message: %s", message)
+                for reply in session.handle(message):
+                    send_websocket_message(conn, reply)
+        except WebSocketProtocolError as e:
+            log.warning("WebSocket protocol error from %s: %s", session.addr, e)
+            conn.sendall(close_frame(e.close_code))
+            session.closed = True
+        except ConnectionResetError:
+            log.info("Connection reset by %s", session.addr)
+            session.closed = True
+        except OSError as e:
+            log.warning("Error in WebSocket communication: %s", e)
+            session.closed = True
+
+def serve_streams(conn, session):
+    """Handle the client's messages and send its streams, a chunk at a time, until it goes away"""
+    receiver = ConnectionReceiver(conn, session)
+    streams = session.streams
+    
+    def step(stream):
+        try:
+            delay = next(stream.steps)
+        except StopIteration:
+            for reply in session.finish_stream(stream):
+                send_websocket_message(conn, reply)
+            return
+        streams.stepped(stream, delay, time.monotonic())
+    
+    try:
+        while not session.closed:
+            for stream in session.start_streams():
+                if stream.request.channel is not None:
+                    stream.steps = stream_channel(conn, session, stream)
+                else:
+                    stream.steps = stream_song(conn, session, stream)
+                step(stream)  # Sends SONG_METADATA and reads the first chunk
+            streams.update_pauses(session.paused)
+            stream, wait = streams.next_ready(time.monotonic(), session.paused)
+            if stream is None:
+                receiver.receive(wait)
+                continue
+            if not stream.cancelled and stream.pacer is not None:
+                # Hold off while the client isn't draining what we already sent.
+                # SO_SNDBUF grows with TCP autotuning, so read it each time
+                backoff = stream.pacer.backpressure_delay(send_queue_bytes(conn), send_buffer_size(conn))
+                if backoff:
+                    receiver.receive(backoff)
+                    continue
+            step(stream)
+            receiver.receive(0)
+            diagnostics.checkpoint()
+    finally:
+        for stream in streams:
+            stream.steps.close()
+        session.release_slots()
+
+def stream_stopped(stream, total_sent):
+    """The message ending a stream cancelled by STOP or another PLAY_SONG"""
+    log.info("Stopped sending song: %s after %s bytes", stream.name, total_sent)
+    return stream.tag({"type": "SONG_STOPPED", "name": stream.name, "bytes_sent": total_sent})
+
 # Add this function to stream song data in chunks
-def stream_song(conn, song_name):
-    """Stream a song over the WebSocket connection"""
+def stream_song(conn, session, stream):
+    """Stream a song over the WebSocket connection, optionally from a time or byte offset.
+
+    A generator run by serve_streams(): each step sends one chunk and yields
+    the seconds until the next one may be sent. The stream's pacing stats
+    (None if it failed) are left in stream.stats.
+    """
+    request = stream.request
+    song_name = stream.name
+    stream_id = None
     try:
-        song_path = os.path.join(MUSIC_DIR, song_name)
+        opened = time.monotonic()
+        song_path, st, etag, track_info, quality, live = select_stream_source(song_name, request.quality)
+        if live and not renditions.start_live():
+            # Too many transcodes running already: the original is better than a stalled stream
+            song_path, st, etag, track_info, quality, live = select_stream_source(song_name)
+        trace_span(request.trace, "catalog", opened, song=song_name, quality=quality, live=live)
+        if live:
+            try:
+                yield from stream_live_transcode(conn, session, stream, song_path, track_info, quality)
+            finally:
+                renditions.end_live()
+            return
         # First, send audio metadata
-        file_size = os.path.getsize(song_path)
-        metadata = {
-            "type": "SONG_METADATA",
-            "name": song_name,
-            "size": file_size
-        }
-        send_websocket_message(conn, metadata)
-        print(f"Sending song: {song_name}, size: {file_size} bytes")
+        file_size = st.st_size
+        start_offset, start_time, bitrate = stream_start(song_name, song_path, file_size, track_info,
+                                                         request, quality)
+        metadata = song_metadata(song_name, file_size, track_info, start_offset, start_time, etag, quality)
+        send_websocket_message(conn, stream.tag(metadata))
+        log.info("Sending song: %s, size: %s bytes, from byte %s", song_name, file_size, start_offset)
+        
+        # Pace to the track's bitrate after an initial burst
+        pacer = stream.pacer = StreamPacer(bitrate, CHUNK_SIZE, PACING_MULTIPLIER, PACING_BURST_SECONDS, egress)
+        stream_id = register_stream(pacer, song_name, session.username)
+        streams_started_total.labels("song").inc()
+        
+        # Hot tracks come from the shared chunk cache. Others are read into one
+        # reused buffer, or with plain ws:// go from the file via sendfile().
+        use_cache = use_chunk_cache(file_size)
+        use_sendfile = not use_cache and not isinstance(conn, ssl.SSLSocket) and hasattr(os, "sendfile")
+        frame_buffer = None if use_cache or use_sendfile else AudioFrameBuffer(CHUNK_SIZE)
+        path = "cache" if use_cache else "sendfile" if use_sendfile else "buffer"
         
         # Stream the file in chunks
-        chunk_size = 32768  # 32KB chunks
         total_sent = 0
-        with open(song_path, 'rb') as f:
-            while True:
-                chunk = f.read(chunk_size)
-                if not chunk:
+        offset = start_offset
+        chunks_sent = 0
+        with TrackReader(song_path) as track:
+            while offset < file_size:
+                buffers = None
+                if use_cache:
+                    chunk_number, skip = divmod(offset, CHUNK_SIZE)
+                    entry = chunk_cache.get(song_path, file_size, st.st_mtime_ns, chunk_number, track.read)
+                    buffers, payload_length = audio_frame_from_cache(entry, skip, stream.prefix)
+                else:
+                    payload_length = min(CHUNK_SIZE, file_size - offset)
+                if payload_length <= 0:
                     break
                 
-                # Use binary opcode (0x02) for audio data
-                frame = encode_websocket_frame(chunk, opcode=0x02)
-                conn.send(frame)
-                total_sent += len(chunk)
+                yield pacer.reserve(payload_length)
+                # STOP and new songs take effect here; the rest of the file is never read
+                if stream.cancelled:
+                    send_websocket_message(conn, stream_stopped(stream, total_sent))
+                    stream.stats = pacer.stats()
+                    return
                 
-                # Log progress for larger files
-                if total_sent % (chunk_size * 10) == 0:  # Log every ~320KB
-                    print(f"Sent {total_sent / (1024 * 1024):.2f} MB of {file_size / (1024 * 1024):.2f} MB")
+                send_started = time.monotonic()
+                if buffers is not None:
+                    send_all(conn, buffers)
+                elif use_sendfile:
+                    send_file_chunk(conn, track.file, offset, payload_length, stream.prefix)
+                else:
+                    frame, payload_length = frame_buffer.read_frame(track.file, offset, payload_length,
+                                                                    stream.prefix)
+                    if payload_length <= 0:
+                        break
+                    send_all(conn, (frame,))
+                record_chunk(request, path, send_started, payload_length, chunks_sent == 0)
+                offset += payload_length
+                total_sent += payload_length
+                chunks_sent += 1
+                pacer.record_sent(payload_length)
                 
-                # Small delay to prevent overwhelming the connection
-                time.sleep(0.01)
+                # Log progress for larger files
+                if chunks_sent % 10 == 0:  # Log every ~320KB
+                    log.debug("Sent %.2f MB of %.2f MB", total_sent / (1024 * 1024), file_size / (1024 * 1024))
         
         # Send end of stream message
-        send_websocket_message(conn, {"type": "SONG_ENDED"})
-        print(f"Finished sending song: {song_name}, total: {total_sent} bytes")
+        send_websocket_message(conn, stream.tag({"type": "SONG_ENDED"}))
+        log.info("Finished sending song: %s, total: %s bytes, stats: %s", song_name, total_sent, pacer.stats())
+        stream.stats = pacer.stats()
+    except Exception as e:
+        log.error("Error streaming song: %s", e)
+        stream_errors_total.labels("song").inc()
+        send_websocket_message(conn, stream.tag({"type": "STREAM_ERROR", "error": str(e)}))
+    finally:
+        if stream_id is not None:
+            unregister_stream(stream_id)
+
+def stream_channel(conn, session, stream):
+    """Send a broadcast channel to one listener; a generator like stream_song() that ends with the channel.
+
+    The audio frames come ready-made from the channel's ring, so a listener
+    costs a send per chunk and nothing else.
+    """
+    subscription = broadcaster.join(stream.request.channel, stream.name)
+    log.info("%s joined channel %s", session.username, stream.request.channel)
+    streams_started_total.labels("channel").inc()
+    chunks_sent = 0
+    try:
+        while True:
+            message, wait = subscription.next_message()
+            if message is None and wait is None:
+                break
+            if isinstance(message, dict):
+                if message["type"] == "SONG_PLAYING":
+                    stream.name = message["name"]
+                send_websocket_message(conn, stream.tag(message))
+            elif message is not None:
+                send_started = time.monotonic()
+                buffers, payload_length = audio_frame_from_cache(message.entry, 0, stream.prefix)
+                send_all(conn, buffers)
+                record_chunk(stream.request, "channel", send_started, payload_length, chunks_sent == 0)
+                chunks_sent += 1
+            yield wait or 0.0
+            if stream.cancelled:
+                send_websocket_message(conn, stream_stopped(stream, subscription.bytes_sent))
+                return
+    finally:
+        subscription.close()
+        log.info("%s left channel %s after %s bytes, skipped forward %s times", session.username,
+                 stream.request.channel, subscription.bytes_sent, subscription.skips)
+
+def live_start_time(song_name, start_time=None, start_offset=None):
+    """A live transcode can only seek by time, so map a byte offset in the original to one"""
+    if start_time or not start_offset:
+        return start_time or None
+    index = indexer.index(song_name)
+    if index is None or not len(index.offsets):
+        return None
+    return round(index.time_of_frame(min(index.frame_at_offset(start_offset), len(index.offsets) - 1)), 3)
+
+def stream_live_transcode(conn, session, stream, song_path, track_info, quality):
+    """Stream a song through an on-the-fly ffmpeg transcode while its rendition is being made"""
+    song_name = stream.name
+    stream_id = None
+    process = None
+    try:
+        start_time = live_start_time(song_name, stream.request.start_time, stream.request.start_offset)
+        send_websocket_message(conn, stream.tag(
+            song_metadata(song_name, None, track_info, 0, start_time or 0.0, None, quality)))
+        log.info("Sending song: %s, live transcode to %s kbps", song_name, quality)
+        process = renditions.open_live(song_path, quality, start_time)
+        
+        pacer = stream.pacer = StreamPacer(quality * 1000, CHUNK_SIZE, PACING_MULTIPLIER, PACING_BURST_SECONDS,
+                                           egress)
+        stream_id = register_stream(pacer, song_name, session.username)
+        streams_started_total.labels("transcode").inc()
+        total_sent = 0
+        while True:
+            chunk = process.stdout.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield pacer.reserve(len(chunk))
+            if stream.cancelled:
+                # Killing ffmpeg in the finally block stops the transcode too
+                send_websocket_message(conn, stream_stopped(stream, total_sent))
+                stream.stats = pacer.stats()
+                return
+            send_started = time.monotonic()
+            send_all(conn, (encode_audio_chunk(chunk, stream.prefix)[0],))
+            record_chunk(stream.request, "transcode", send_started, len(chunk), total_sent == 0)
+            total_sent += len(chunk)
+            pacer.record_sent(len(chunk))
+        if process.wait() != 0:
+            raise RuntimeError(f"Transcoding failed (ffmpeg exit code {process.returncode})")
+        
+        send_websocket_message(conn, stream.tag({"type": "SONG_ENDED"}))
+        log.info("Finished sending song: %s, total: %s bytes, stats: %s", song_name, total_sent, pacer.stats())
+        stream.stats = pacer.stats()
+    except Exception as e:
+        log.error("Error streaming song: %s", e)
+        stream_errors_total.labels("transcode").inc()
+        send_websocket_message(conn, stream.tag({"type": "STREAM_ERROR", "error": str(e)}))
+    finally:
+        if process is not None and process.poll() is None:
+            process.kill()
+            process.wait()
+        if stream_id is not None:
+            unregister_stream(stream_id)
+
+class ClientSession:
+    """Per-connection protocol state, shared by the threaded and asyncio engines"""
+    def __init__(self, conn, addr, multiplexed=False):
+        self.conn = conn
+        self.addr = addr
+        self.is_authenticated = False
+        self.username = None
+        self.throughput = None  # (bytes/s, whether the link was the bottleneck) of the last stream
+        self.closed = False
+        self.multiplexed = multiplexed  # Negotiated MUX_SUBPROTOCOL: several streams, each tagged with its id
+        # Stream control, updated by process_message while songs are streaming
+        self.streams = StreamScheduler(MAX_STREAMS if multiplexed else 1)
+        self.queued = {}       # stream id -> PlayRequest to start once that stream id is free
+        self.paused = False    # PAUSE without a stream id: hold every stream until RESUME
+        self.replacing = None  # Stream the message being handled has cancelled, see handle()
+        self.connected_at = time.monotonic()  # When the handshake finished and AUTH_REQUIRED went out
+        self.trace = None  # Trace of a connection sampled by diagnostics.tracer
+        self.slots = {}    # stream id -> admission StreamSlot, held from the request until the stream ends
+
+    def handle(self, message):
+        """Process one text message and return the replies to send now.
+
+        Songs to stream are left in queued for the engine. The replies to a
+        PLAY_SONG that cancels a running stream are deferred until that
+        stream has said SONG_STOPPED, so the client never hears about the
+        next song first.
+        """
+        self.replacing = None
+        replies, play_request = process_message(self, message)
+        if play_request is not None:
+            play_request.trace = self.trace
+            self.queued[play_request.stream_id] = play_request
+        if self.replacing is not None:
+            self.replacing.deferred.extend(replies)
+            return []
+        return replies
+
+    def tag(self, message, stream_id):
+        """Add a stream id to a reply, on multiplexed connections"""
+        if self.multiplexed:
+            message["stream_id"] = stream_id
+        return message
+
+    def start_streams(self):
+        """Turn queued requests into streams, once their stream ids are free; returns the new streams"""
+        started = []
+        for stream_id in list(self.queued):
+            if self.streams.get(stream_id) is None:
+                stream = OutgoingStream(self.queued.pop(stream_id), self.multiplexed)
+                self.streams.add(stream)
+                started.append(stream)
+        return started
+
+    def finish_stream(self, stream):
+        """Forget a stream that has ended; returns the replies deferred until now"""
+        self.streams.remove(stream)
+        self.record_stream(stream.stats)
+        if stream.stream_id not in self.queued:
+            self.release_slot(stream.stream_id)
+        request = stream.request
+        if request.last_chunk_at is not None:
+            request.trace.span("last_chunk", request.requested_at, request.last_chunk_at, song=stream.name,
+                               cancelled=stream.cancelled)
+        if not len(self.streams):
+            self.paused = False
+        return stream.deferred
+
+    def release_slot(self, stream_id):
+        """Give back the admission slot of a stream id that is no longer streaming or queued"""
+        slot = self.slots.pop(stream_id, None)
+        if slot is not None:
+            admission.release(slot)
+
+    def release_slots(self):
+        """Give back every slot, once the connection has closed"""
+        for stream_id in list(self.slots):
+            self.release_slot(stream_id)
+
+    def record_stream(self, stats):
+        """Remember how fast the last stream went, for quality "auto" """
+        if stats and stats["elapsed"] > 0:
+            # Backoffs mean the send queue filled up: the link, not pacing, set the rate
+            self.throughput = (stats["average_rate"], stats["backoffs"] > 0)
+            user_throughput[self.username] = self.throughput
+
+    def pick_quality(self):
+        """Choose a rendition (kbps, or None for the original) from the measured throughput"""
+        # A new connection goes by the user's last stream on any connection
+        throughput = self.throughput or user_throughput.get(self.username)
+        if throughput is None:
+            return AUTO_DEFAULT_QUALITY
+        rate, link_limited = throughput
+        if not link_limited:
+            return None
+        for kbps in sorted(RENDITION_BITRATES, reverse=True):
+            if kbps * 1000 / 8 * AUTO_HEADROOM <= rate:
+                return kbps
+        return min(RENDITION_BITRATES)
+
+class PlayRequest:
+    """A song (or broadcast channel) to stream once the PLAY_SONG (JOIN_CHANNEL) replies have been sent"""
+    def __init__(self, name, start_time=None, start_offset=None, exact=False, quality=None, stream_id=0,
+                 priority=PRIORITIES["playback"], channel=None):
+        self.name = name
+        self.channel = channel  # Listen to this broadcast channel instead of playing name on its own
+        self.stream_id = stream_id
+        self.priority = priority
+        self.quality = quality  # Rendition kbps, or None for the original file
+        self.start_time = float(start_time) if start_time is not None else None
+        self.start_offset = int(start_offset) if start_offset is not None else None
+        self.exact = exact  # Stream from start_offset as given instead of the nearest frame
+        self.requested_at = time.monotonic()  # For the time-to-first-byte metric
+        self.trace = None          # The connection's trace, if it is sampled
+        self.last_chunk_at = None  # When the last chunk went out, on traced connections
+        if (self.start_time or 0) < 0 or (self.start_offset or 0) < 0:
+            raise ValueError("Start position must not be negative")
+
+def resume_session(session, message):
+    """Handle RESUME_SESSION: authenticate with a session token instead of a password.
+
+    The request may also name a song and the byte offset the client already
+    has, in which case streaming continues from exactly that byte. Passing
+    the etag from SONG_METADATA as if_match makes sure the file hasn't
+    changed in between.
+    """
+    try:
+        request = json.loads(message)
+    except json.JSONDecodeError:
+        auth_total.labels("failure").inc()
+        return [{"type": "AUTH_FAILED"}], None
+    username = None
+    if isinstance(request, dict) and request.get("type") == "RESUME_SESSION":
+        username = session_tokens.verify(request.get("token"))
+    if username is None or username not in USERS:
+        log.warning("Session resume failed: invalid or expired token")
+        auth_total.labels("failure").inc()
+        return [{"type": "AUTH_FAILED", "reason": "Session expired"}], None
+    
+    session.is_authenticated = True
+    session.username = username
+    auth_total.labels("resumed").inc()
+    auth_seconds.observe(time.monotonic() - session.connected_at)
+    trace_span(session.trace, "auth", session.connected_at, user=username, method="token")
+    log.info("Session resumed for user: %s", username)
+    replies = [auth_success(username)]
+    
+    song_name = request.get("name")
+    if song_name is None:
+        return replies, None
+    try:
+        stream_id = parse_stream_id(session, request.get("stream_id"))
+    except ValueError as e:
+        replies.append({"type": "STREAM_ERROR", "error": str(e)})
+        return replies, None
+    if not song_exists(song_name):
+        replies.append(session.tag({"type": "SONG_NOT_FOUND"}, stream_id))
+        return replies, None
+    try:
+        play_request = PlayRequest(song_name, start_offset=request.get("offset") or 0, exact=True,
+                                   quality=parse_quality(request.get("quality"), session), stream_id=stream_id)
+    except (TypeError, ValueError):
+        replies.append(session.tag({"type": "STREAM_ERROR", "error": "Invalid start position or quality"},
+                                   stream_id))
+        return replies, None
+    if_match = request.get("if_match")
+    if if_match:
+        etag, _ = current_etag(song_name, play_request.quality)
+        if etag != if_match:
+            replies.append(session.tag({"type": "STREAM_ERROR", "error": "Song changed since the stream started"},
+                                       stream_id))
+            return replies, None
+    busy = admit_stream(session, stream_id, song_name, play_request.quality)
+    if busy is not None:
+        replies.append(busy)
+        return replies, None
+    replies.append(session.tag({"type": "SONG_PLAYING", "name": song_name}, stream_id))
+    log.info("Resuming song: %s from byte %s", song_name, play_request.start_offset)
+    return replies, play_request
+
+def parse_stream_id(session, value):
+    """Check the stream id of a request; 0 (the default) is the only one without multiplexing"""
+    if value is None:
+        return 0
+    if isinstance(value, bool) or not isinstance(value, int) or not 0 <= value <= MAX_STREAM_ID:
+        raise ValueError(f"Invalid stream id: {value}")
+    if value and not session.multiplexed:
+        raise ValueError(f"Stream ids need the {MUX_SUBPROTOCOL} subprotocol")
+    return value
+
+def replace_stream(session, stream_id):
+    """Make room for a new request on stream_id, cancelling what streams there now.
+
+    Returns False if the stream id is free but the connection already has
+    as many streams as it may.
+    """
+    current = session.streams.get(stream_id)
+    if current is not None:
+        if current.cancelled:
+            current.deferred = []  # What it was going to be replaced with is replaced in turn
+        current.cancelled = True
+        session.replacing = current
         return True
+    return stream_id in session.queued or len(session.streams) + len(session.queued) < session.streams.max_streams
+
+def join_channel(session, request):
+    """Handle JOIN_CHANNEL; returns (replies, PlayRequest or None) like process_message.
+
+    A channel that isn't running starts with the requested song (or the
+    first one in the library); joining a running channel picks up what it
+    is playing now.
+    """
+    channel = request.get("channel")
+    try:
+        stream_id = parse_stream_id(session, request.get("stream_id"))
+    except ValueError as e:
+        return [{"type": "STREAM_ERROR", "error": str(e)}], None
+    if not isinstance(channel, str) or not channel or len(channel) > MAX_CHANNEL_NAME:
+        return [session.tag({"type": "STREAM_ERROR", "error": "Invalid channel name"}, stream_id)], None
+    song_name = broadcaster.current_song(channel) or request.get("name")
+    if song_name is None:
+        songs = catalog.songs()
+        song_name = songs[0] if songs else None
+    if not song_exists(song_name):
+        return [session.tag({"type": "SONG_NOT_FOUND"}, stream_id)], None
+    if not replace_stream(session, stream_id):
+        return [session.tag({"type": "STREAM_ERROR", "error": "Too many streams"}, stream_id)], None
+    busy = admit_stream(session, stream_id, song_name)
+    if busy is not None:
+        return [busy], None
+    session.paused = False
+    log.info("Joining channel %s, playing %s", channel, song_name)
+    return [session.tag({"type": "CHANNEL_JOINED", "channel": channel, "name": song_name}, stream_id)], \
+        PlayRequest(song_name, stream_id=stream_id, channel=channel)
+
+def play_song(session, request):
+    """Handle PLAY_SONG; returns (replies, PlayRequest or None) like process_message"""
+    song_name = request.get("name")
+    try:
+        stream_id = parse_stream_id(session, request.get("stream_id"))
+    except ValueError as e:
+        return [{"type": "STREAM_ERROR", "error": str(e)}], None
+    priority = PRIORITIES.get(request.get("priority") or "playback")
+    if priority is None:
+        return [session.tag({"type": "STREAM_ERROR", "error": "Invalid priority"}, stream_id)], None
+    
+    # A new song replaces whatever is streaming on this stream id now, even if it isn't found
+    if not replace_stream(session, stream_id):
+        return [session.tag({"type": "STREAM_ERROR", "error": "Too many streams"}, stream_id)], None
+    if priority == PRIORITIES["playback"]:
+        session.paused = False
+    
+    if not song_exists(song_name):
+        return [session.tag({"type": "SONG_NOT_FOUND"}, stream_id)], None
+    try:
+        play_request = PlayRequest(song_name, request.get("start"), request.get("offset"), stream_id=stream_id,
+                                   priority=priority)
+    except (TypeError, ValueError):
+        return [session.tag({"type": "STREAM_ERROR", "error": "Invalid start position"}, stream_id)], None
+    try:
+        play_request.quality = parse_quality(request.get("quality"), session)
+    except (TypeError, ValueError):
+        return [session.tag({"type": "STREAM_ERROR", "error": "Invalid quality"}, stream_id)], None
+    # A client holding a cached copy only needs the bytes if the file changed
+    if_none_match = request.get("if_none_match")
+    if if_none_match:
+        etag, size = current_etag(song_name, play_request.quality)
+        if if_none_match == etag:
+            log.info("Song not modified, client plays from cache: %s", song_name)
+            return [session.tag({
+                "type": "SONG_NOT_MODIFIED",
+                "name": song_name,
+                "size": size,
+                "etag": etag
+            }, stream_id)], None
+    busy = admit_stream(session, stream_id, song_name, play_request.quality)
+    if busy is not None:
+        return [busy], None
+    # Acknowledge the song request
+    log.info("Playing song: %s", song_name)
+    return [session.tag({"type": "SONG_PLAYING", "name": song_name}, stream_id)], play_request
+
+def admin_command(session, request):
+    """Handle ADMIN: profile, snapshot the heap of, or trace this process (admin users only).
+
+    With several workers, a command reaches only the worker serving the
+    admin's connection. Result files are downloaded over HTTP from the
+    urls in the reply.
+    """
+    command = request.get("command")
+    if session.username not in ADMIN_USERS:
+        log.warning("ADMIN %s refused for user: %s", command, session.username)
+        return {"type": "ADMIN_ERROR", "command": command, "error": "Not allowed"}
+    result = {}
+    try:
+        if command == "profile_start":
+            # cProfile follows the connection threads started from now on (threaded engine),
+            # or the event loop that runs every connection (asyncio engine)
+            diagnostics.start_profile(request.get("profiler", "sampling"),
+                                      float(request.get("interval") or DEFAULT_SAMPLE_INTERVAL),
+                                      new_threads=SERVER_MODE == "threaded")
+        elif command == "profile_stop":
+            result["files"] = [diagnostics.stop_profile()]
+        elif command == "heap_start":
+            diagnostics.start_heap(int(request.get("frames") or DEFAULT_HEAP_FRAMES))
+        elif command == "heap_snapshot":
+            name, top = diagnostics.heap_snapshot(int(request.get("limit") or 10))
+            result["files"] = [name]
+            result["top"] = top
+        elif command == "heap_stop":
+            diagnostics.stop_heap()
+        elif command == "trace_start":
+            diagnostics.start_trace(float(request.get("sample_rate") or DEFAULT_TRACE_SAMPLE_RATE))
+        elif command == "trace_stop":
+            result["files"] = diagnostics.stop_trace()
+        elif command == "list":
+            result["available"] = diagnostics.files()
+        elif command != "status":
+            raise ValueError(f"Unknown command: {command}")
+    except (TypeError, ValueError) as e:
+        return {"type": "ADMIN_ERROR", "command": command, "error": str(e)}
+    log.info("ADMIN %s by %s", command, session.username)
+    reply = {"type": "ADMIN_RESULT", "command": command, "status": diagnostics.status()}
+    reply.update(result)
+    if "files" in reply:
+        reply["urls"] = [DIAGNOSTICS_PREFIX + name for name in reply["files"]]
+    return reply
+
+def process_message(session, message):
+    """Handle one text message from a client.
+
+    Returns a list of replies to send and a PlayRequest for a song to stream
+    afterwards (or None). Keeping this free of socket I/O lets both server
+    engines speak exactly the same protocol.
+    """
+    replies = []
+    song_to_stream = None
+    
+    # Handle message based on authentication state
+    if not session.is_authenticated:
+        if message.startswith("{"):
+            return resume_session(session, message)
+        # Try to authenticate
+        try:
+            auth_parts = message.split(":")
+            if len(auth_parts) == 2:
+                username, password = auth_parts
+                if authenticate(session.conn, username, password):
+                    session.is_authenticated = True
+                    session.username = username
+                    # Send authentication success and song list
+                    replies.append(auth_success(username))
+                else:
+                    replies.append({"type": "AUTH_FAILED"})
+            else:
+                replies.append({"type": "AUTH_FAILED"})
+        except Exception as e:
+            log.warning("Authentication error: %s", e)
+            replies.append({"type": "AUTH_FAILED"})
+        if session.is_authenticated:
+            auth_total.labels("success").inc()
+            auth_seconds.observe(time.monotonic() - session.connected_at)
+            trace_span(session.trace, "auth", session.connected_at, user=session.username, method="password")
+        else:
+            auth_total.labels("failure").inc()
+        return replies, song_to_stream
+    
+    # Handle authenticated requests
+    try:
+        request = json.loads(message)
+        if request.get("type") == "PLAY_SONG":
+            play_replies, song_to_stream = play_song(session, request)
+            replies.extend(play_replies)
+        elif request.get("type") == "JOIN_CHANNEL":
+            join_replies, song_to_stream = join_channel(session, request)
+            replies.extend(join_replies)
+        elif request.get("type") == "GET_SONGS":
+            cursor = request.get("cursor")
+            if cursor is not None and not isinstance(cursor, str):
+                cursor = None
+            reply = {"type": "SONG_LIST", "cursor": cursor}
+            reply.update(get_song_list(cursor, page_limit(request.get("limit"), SONG_PAGE_SIZE)))
+            replies.append(reply)
+        elif request.get("type") == "SEARCH":
+            query = request.get("query")
+            query = query if isinstance(query, str) else ""
+            replies.append({
+                "type": "SEARCH_RESULTS",
+                "query": query,
+                "songs": search_index.search(query, page_limit(request.get("limit"), SEARCH_LIMIT))
+            })
+        elif request.get("type") == "GET_ANALYSIS":
+            song_name = request.get("name")
+            if song_exists(song_name):
+                analysis = analyzer.get(song_name)
+                if analysis is None:
+                    replies.append({"type": "ANALYSIS_NOT_AVAILABLE", "name": song_name})
+                else:
+                    # Clients can ask for as many peaks as they have pixels to draw
+                    try:
+                        points = int(request.get("points") or 0)
+                    except (TypeError, ValueError):
+                        points = 0
+                    replies.append(analysis.message(song_name, max(0, points)))
+            else:
+                replies.append({"type": "SONG_NOT_FOUND"})
+        elif request.get("type") in ("PAUSE", "RESUME"):
+            pause = request["type"] == "PAUSE"
+            reply_type = "PAUSED" if pause else "RESUMED"
+            log.debug("Received %s command", request["type"].lower())
+            if "stream_id" in request:
+                # Just this stream; any others keep going
+                stream_id = request.get("stream_id")
+                stream = session.streams.get(stream_id)
+                if stream is not None:
+                    stream.paused = pause
+                replies.append(session.tag({"type": reply_type, "name": stream.name if stream else None}, stream_id))
+            else:
+                # Sending stops before the next chunk; without a stream this just acknowledges
+                session.paused = pause and len(session.streams) > 0
+                stream = session.streams.get(0)
+                replies.append({"type": reply_type, "name": stream.name if stream else None})
+        elif request.get("type") == "STOP":
+            stream_id = request.get("stream_id", 0)
+            # Also drops a song queued to play after the current one
+            session.queued.pop(stream_id, None)
+            stream = session.streams.get(stream_id)
+            if stream is not None:
+                log.info("Received stop command, cancelling %s", stream.name)
+                stream.deferred = []
+                stream.cancelled = True  # The stream replies with SONG_STOPPED
+            else:
+                session.release_slot(stream_id)
+                replies.append(session.tag({"type": "SONG_STOPPED", "name": None}, stream_id))
+        elif request.get("type") == "SET_PRIORITY":
+            # E.g. a prefetched song that has started playing
+            stream_id = request.get("stream_id", 0)
+            priority = PRIORITIES.get(request.get("priority"))
+            target = session.streams.get(stream_id) or session.queued.get(stream_id)
+            if priority is None:
+                replies.append(session.tag({"type": "STREAM_ERROR", "error": "Invalid priority"}, stream_id))
+            elif target is not None:
+                target.priority = priority
+        elif request.get("type") == "GET_STREAM_STATS":
+            replies.append({
+                "type": "STREAM_STATS",
+                "streams": stream_stats(session.username),
+                "chunk_cache": chunk_cache.stats(),
+                "renditions": renditions.stats(),
+                "analysis": analyzer.stats(),
+                "tls": tls_stats(),
+                "channels": broadcaster.stats(),
+                "log": log_stats(),
+                "admission": admission.stats(),
+                "egress": egress.stats(),
+                "cluster": cluster_stats()
+            })
+        elif request.get("type") == "ADMIN":
+            replies.append(admin_command(session, request))
+    except json.JSONDecodeError:
+        log.warning("Invalid JSON message: %s", message)
     except Exception as e:
-        print(f"Error streaming song: {e}")
-        send_websocket_message(conn, {"type": "STREAM_ERROR", "error": str(e)})
-        return False
+        log.error("Error handling request: %s", e)
+    return replies, song_to_stream
+
+def read_http_request(conn, requests):
+    """Read the next request's headers from a threaded connection; None if it closed first"""
+    while True:
+        request = requests.next_request()
+        if request is not None:
+            return request
+        data = conn.recv(RECV_SIZE)
+        if not data:
+            return None
+        requests.feed(data)
+
+def serve_http(conn, requests, request):
+    """Answer HTTP requests on a threaded connection until it closes or idles out"""
+    served = 0
+    while request is not None:
+        served += 1
+        diagnostics.checkpoint()
+        keep_alive = request.keep_alive and served < HTTP_MAX_REQUESTS
+        header, body = http_response(request, keep_alive)
+        # The status code, from the "HTTP/1.1 200 OK" line
+        http_requests_total.labels(header[9:12].decode()).inc()
+        conn.sendall(header)
+        if isinstance(body, tuple):
+            # socket.sendfile() uses os.sendfile on plain sockets and falls back to send() with TLS
+            path, offset, length = body
+            with open(path, "rb") as f:
+                conn.sendfile(f, offset, length)
+            bytes_sent_total.labels("http").inc(length)
+        elif body:
+            conn.sendall(body)
+        if not keep_alive:
+            return
+        conn.settimeout(HTTP_KEEPALIVE_TIMEOUT)
+        try:
+            request = read_http_request(conn, requests)
+        except socket.timeout:
+            return
+        except HTTPError as e:
+            conn.sendall(b"".join(error_response(e.status, str(e), keep_alive=False)))
+            return
+        finally:
+            conn.settimeout(None)
 
 # Handle client requests
-def handle_client(conn, addr):
-    print(f"Connected to {addr}")
+def handle_client(conn, addr, context=None):
+    log.debug("Connected to %s", addr)
+    accepted = time.monotonic()
+    trace = diagnostics.tracer.sample(accepted)
+    connections_total.inc()
+    connections_active.inc()
+    busy = None
+    try:
+        admission.connect()
+    except Busy as e:
+        busy = e  # Still answered, with BUSY (or a 503), once we know what the client speaks
+    try:
+        if context is not None:
+            try:
+                conn.settimeout(HANDSHAKE_TIMEOUT)
+                conn = context.wrap_socket(conn, server_side=True)
+                conn.settimeout(None)
+            except (ssl.SSLError, OSError) as e:
+                log.warning("TLS handshake with %s failed: %s", addr, e)
+                conn.close()
+                return
+            trace_span(trace, "tls", accepted, version=conn.version(), resumed=conn.session_reused)
+        serve_client(conn, addr, accepted, trace, busy)
+    finally:
+        connections_active.dec()
+        if busy is None:
+            admission.disconnect()
+        trace_span(trace, "connection", accepted, addr=f"{addr[0]}:{addr[1]}", engine="threaded")
+
+def serve_client(conn, addr, accepted, trace=None, busy=None):
+    """Serve one connection, once TLS (if any) is set up; with busy, just tell the client to come back later"""
     try:
-        # Receive initial data
-        data = conn.recv(1024).decode()
+        # Receive the request headers
+        requests = HTTPRequestReader()
+        conn.settimeout(HANDSHAKE_TIMEOUT)
+        try:
+            request = read_http_request(conn, requests)
+        except HTTPError as e:
+            conn.sendall(b"".join(error_response(e.status, str(e), keep_alive=False)))
+            return
+        conn.settimeout(None)
+        if request is None:
+            return
+        data = request.raw
         
         # Check if this is a WebSocket handshake request
-        if "Upgrade: websocket" in data:
+        if request.is_websocket_upgrade:
             if not handle_websocket_handshake(conn, data):
-                print("WebSocket handshake failed")
+                log.warning("WebSocket handshake failed")
+                return
+            handshake_seconds.observe(time.monotonic() - accepted)
+            trace_span(trace, "handshake", accepted, multiplexed=wants_multiplexing(data))
+            if busy is not None:
+                send_websocket_message(conn, busy_reply(busy))
+                conn.sendall(close_frame(CLOSE_TRY_AGAIN_LATER))
                 return
                 
             # WebSocket connection established
-            is_authenticated = False
+            session = ClientSession(conn, addr, wants_multiplexing(data))
+            session.trace = trace
             
             # Send authentication required message
             send_websocket_message(conn, {"type": "AUTH_REQUIRED"})
             
-            # WebSocket communication loop
-            while True:
-                try:
-                    # Receive message frame
-                    frame_data = conn.recv(1024)
-                    if not frame_data:
-                        print("Client disconnected")
-                        break
-                        
-                    # Decode the WebSocket frame
-                    message = decode_websocket_frame(frame_data)
-                    if not message:
-                        continue
-                        
-                    print(f"Received WebSocket message: {message}")
-                    
-                    # Handle message based on authentication state
-                    if not is_authenticated:
-                        # Try to authenticate
-                        try:
-                            auth_parts = message.split(":")
-                            if len(auth_parts) == 2:
-                                username, password = auth_parts
-                                if authenticate(conn, username, password):
-                                    is_authenticated = True
-                                    # Send authentication success and song list
-                                    songs = get_song_list()
-                                    send_websocket_message(conn, {
-                                        "type": "AUTH_SUCCESS",
-                                        "songs": songs
-                                    })
-                                else:
-                                    send_websocket_message(conn, {"type": "AUTH_FAILED"})
-                            else:
-                                send_websocket_message(conn, {"type": "AUTH_FAILED"})
-                        except Exception as e:
-                            print(f"Authentication error: {e}")
-                            send_websocket_message(conn, {"type": "AUTH_FAILED"})
-                    else:
-                        # Handle authenticated requests
-                        try:
-                            request = json.loads(message)
-                            if request.get("type") == "PLAY_SONG":
-                                song_name = request.get("name")
-                                songs = get_song_list()
-                                
-                                if song_name in songs:
-                                    # Acknowledge the song request
-                                    send_websocket_message(conn, {
-                                        "type": "SONG_PLAYING",
-                                        "name": song_name
-                                    })
-                                    
-                                    # Stream the song
-                                    print(f"Playing song: {song_name}")
-                                    stream_song(conn, song_name)
-                                else:
-                                    send_websocket_message(conn, {"type": "SONG_NOT_FOUND"})
-                            elif request.get("type") == "GET_SONGS":
-                                songs = get_song_list()
-                                send_websocket_message(conn, {
-                                    "type": "SONG_LIST",
-                                    "songs": songs
-                                })
-                            # Update this section in the handle_client function to handle PAUSE and RESUME:
-                            elif request.get("type") == "PAUSE":
-                                print("Received pause command")
-                                # You might implement additional server-side pause handling here
-                                # For now, we just acknowledge the command
-                                send_websocket_message(conn, {"type": "PAUSED"})
-                                
-                            elif request.get("type") == "RESUME":
-                                print("Received resume command")
-                                # You might implement additional server-side resume handling here
-                                # For now, we just acknowledge the command
-                                send_websocket_message(conn, {"type": "RESUMED"})
-                        except json.JSONDecodeError:
-                            print(f"Invalid JSON message: {message}")
-                            continue
-                        except Exception as e:
-                            print(f"Error handling request: {e}")
-                            continue
-                
-                except ConnectionResetError:
-                    print(f"Connection reset by {addr}")
-                    break
-                except Exception as e:
-                    print(f"Error in WebSocket communication: {e}")
-                    break
+            # WebSocket communication loop, interleaved with sending songs
+            serve_streams(conn, session)
+        elif busy is not None:
+            conn.sendall(b"".join(busy_http_response(busy)))
         else:
-            # Not a WebSocket request, handle as regular socket
-            print("Non-WebSocket connection received")
-            conn.send("HTTP/1.1 400 Bad Request\r\n\r\nWebSocket connection required".encode())
+            # Plain HTTP: track downloads, anything else gets a 400
+            serve_http(conn, requests, request)
             
+    except (BrokenPipeError, ConnectionResetError):
+        log.info("Connection reset by %s", addr)
     except Exception as e:
-        print(f"Error: {e}")
+        log.error("Error serving %s: %s", addr, e)
     finally:
         conn.close()
 
@@ -403,34 +1887,518 @@ def handle_client(conn, addr):
 def start_server():
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_socket:
         server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if REUSE_PORT:
+            # Every worker binds its own listener; the kernel balances connections between them
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         
-        # Apply SSL if enabled
+        # Apply SSL if enabled. The listening socket stays plain: each connection's
+        # handshake runs in its own thread, so a slow client can't stall accept()
         global USE_SSL
+        context = None
         if USE_SSL:
-            ssl_context = create_ssl_context()
-            if ssl_context is None:
+            context = get_ssl_context()
+            if context is None:
                 print("Failed to create SSL context. Starting server without SSL.")
                 USE_SSL = False
             else:
-                server_socket = ssl_context.wrap_socket(server_socket, server_side=True)
                 print(f"SSL enabled. Server will use secure WebSockets (wss://)")
         
         server_socket.bind((HOST, PORT))
-        server_socket.listen(5)
+        server_socket.listen(LISTEN_BACKLOG)
         protocol = "wss://" if USE_SSL else "ws://"
         print(f"Server listening on {protocol}{HOST}:{PORT}")
         
         while True:
             try:
                 conn, addr = server_socket.accept()
-                client_thread = threading.Thread(target=handle_client, args=(conn, addr))
+                client_thread = threading.Thread(target=handle_client, args=(conn, addr, context))
                 client_thread.daemon = True
                 client_thread.start()
             except KeyboardInterrupt:
                 print("\nServer shutting down...")
                 break
             except Exception as e:
-                print(f"Error accepting connection: {e}")
+                log.error("Error accepting connection: %s", e)
+
+# Asyncio engine: the same protocol as handle_client/stream_song, but every
+# connection is a coroutine on one event loop instead of an OS thread.
+async def async_send_websocket_message(writer, message):
+    """Send a message over WebSocket from a coroutine"""
+    try:
+        if isinstance(message, dict):
+            message = json.dumps(message)
+        writer.write(encode_websocket_frame(message))
+        await writer.drain()
+        return True
+    except Exception as e:
+        log.warning("Error sending WebSocket message: %s", e)
+        return False
+
+async def async_send_locked(session, message):
+    """Send a message from any coroutine without splitting a frame a stream is writing"""
+    async with session.send_lock:
+        return await async_send_websocket_message(session.conn, message)
+
+async def async_serve_streams(session):
+    """Coroutine counterpart of serve_streams: sends the session's streams a chunk at a time.
+
+    Runs as its own task next to the connection's receive loop, which
+    handles the client's messages and sets session.wakeup after each one.
+    """
+    writer = session.conn
+    sock = writer.get_extra_info('socket')
+    streams = session.streams
+    
+    async def step(stream):
+        try:
+            delay = await stream.steps.__anext__()
+        except StopAsyncIteration:
+            for reply in session.finish_stream(stream):
+                await async_send_locked(session, reply)
+            return
+        streams.stepped(stream, delay, time.monotonic())
+    
+    async def wait(timeout):
+        try:
+            await asyncio.wait_for(session.wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+    
+    try:
+        while not session.closed:
+            # Cleared before looking at the session, so no message can slip by unnoticed
+            session.wakeup.clear()
+            for stream in session.start_streams():
+                if stream.request.channel is not None:
+                    stream.steps = async_stream_channel(session, stream)
+                else:
+                    stream.steps = async_stream_song(session, stream)
+                await step(stream)  # Sends SONG_METADATA and reads the first chunk
+            streams.update_pauses(session.paused)
+            stream, wait_time = streams.next_ready(time.monotonic(), session.paused)
+            if stream is None:
+                await wait(wait_time)
+                continue
+            if not stream.cancelled and stream.pacer is not None:
+                # Back off while data is piling up in the transport or the kernel
+                queued = send_queue_bytes(sock)
+                if queued is not None:
+                    queued += writer.transport.get_write_buffer_size()
+                backoff = stream.pacer.backpressure_delay(queued, send_buffer_size(sock))
+                if backoff:
+                    await wait(backoff)
+                    continue
+            await step(stream)
+    finally:
+        for stream in streams:
+            await stream.steps.aclose()
+        session.release_slots()
+
+async def async_stream_song(session, stream):
+    """Stream a song over the WebSocket connection without blocking the event loop.
+
+    An async generator run by async_serve_streams(), a chunk per step like stream_song().
+    """
+    loop = asyncio.get_running_loop()
+    writer = session.conn
+    request = stream.request
+    song_name = stream.name
+    stream_id = None
+    try:
+        opened = time.monotonic()
+        song_path, st, etag, track_info, quality, live = await loop.run_in_executor(
+            None, select_stream_source, song_name, request.quality)
+        if live and not renditions.start_live():
+            # Too many transcodes running already: the original is better than a stalled stream
+            song_path, st, etag, track_info, quality, live = await loop.run_in_executor(
+                None, select_stream_source, song_name)
+        trace_span(request.trace, "catalog", opened, song=song_name, quality=quality, live=live)
+        if live:
+            try:
+                async for delay in async_stream_live_transcode(session, stream, song_path, track_info, quality):
+                    yield delay
+            finally:
+                renditions.end_live()
+            return
+        # First, send audio metadata
+        file_size = st.st_size
+        # Loading a frame index or reading the bitrate reads a file, so do it off the event loop
+        start_offset, start_time, bitrate = await loop.run_in_executor(
+            None, stream_start, song_name, song_path, file_size, track_info, request, quality)
+        metadata = song_metadata(song_name, file_size, track_info, start_offset, start_time, etag, quality)
+        await async_send_locked(session, stream.tag(metadata))
+        log.info("Sending song: %s, size: %s bytes, from byte %s", song_name, file_size, start_offset)
+        
+        # Pace to the track's bitrate after an initial burst
+        pacer = stream.pacer = StreamPacer(bitrate, CHUNK_SIZE, PACING_MULTIPLIER, PACING_BURST_SECONDS, egress)
+        stream_id = register_stream(pacer, song_name, session.username)
+        streams_started_total.labels("song").inc()
+        
+        # Hot tracks come from the shared chunk cache. Others are read straight
+        # into their frame, or with plain ws:// sent with loop.sendfile().
+        use_cache = use_chunk_cache(file_size)
+        use_sendfile = not use_cache and writer.get_extra_info('sslcontext') is None
+        path = "cache" if use_cache else "sendfile" if use_sendfile else "buffer"
+        
+        # Stream the file in chunks
+        total_sent = 0
+        offset = start_offset
+        chunks_sent = 0
+        with TrackReader(song_path) as track:
+            while offset < file_size:
+                buffers = None
+                if use_cache:
+                    chunk_number, skip = divmod(offset, CHUNK_SIZE)
+                    key = (song_path, file_size, st.st_mtime_ns, chunk_number)
+                    entry = chunk_cache.lookup(key)
+                    if entry is None:
+                        # Disk reads can block, so keep them off the event loop
+                        entry = await loop.run_in_executor(None, chunk_cache.get, *key, track.read)
+                    buffers, payload_length = audio_frame_from_cache(entry, skip, stream.prefix)
+                else:
+                    payload_length = min(CHUNK_SIZE, file_size - offset)
+                if payload_length <= 0:
+                    break
+                
+                yield pacer.reserve(payload_length)
+                # STOP and new songs take effect here; the rest of the file is never read
+                if stream.cancelled:
+                    await async_send_locked(session, stream_stopped(stream, total_sent))
+                    stream.stats = pacer.stats()
+                    return
+                
+                # Replies from the receive loop wait until the whole frame is written
+                async with session.send_lock:
+                    send_started = time.monotonic()
+                    if buffers is not None:
+                        writer.writelines(buffers)
+                    elif use_sendfile:
+                        writer.write(audio_frame_header(payload_length, stream.prefix))
+                        await loop.sendfile(writer.transport, track.file, offset, payload_length)
+                    else:
+                        # The transport may keep a reference to what we write, so each
+                        # chunk gets its own buffer rather than a reused one
+                        frame, payload_length = await loop.run_in_executor(
+                            None, AudioFrameBuffer(payload_length).read_frame, track.file, offset, payload_length,
+                            stream.prefix)
+                        if payload_length <= 0:
+                            break
+                        writer.write(frame)
+                    await writer.drain()
+                record_chunk(request, path, send_started, payload_length, chunks_sent == 0)
+                offset += payload_length
+                total_sent += payload_length
+                chunks_sent += 1
+                pacer.record_sent(payload_length)
+                
+                # Log progress for larger files
+                if chunks_sent % 10 == 0:  # Log every ~320KB
+                    log.debug("Sent %.2f MB of %.2f MB", total_sent / (1024 * 1024), file_size / (1024 * 1024))
+        
+        # Send end of stream message
+        await async_send_locked(session, stream.tag({"type": "SONG_ENDED"}))
+        log.info("Finished sending song: %s, total: %s bytes, stats: %s", song_name, total_sent, pacer.stats())
+        stream.stats = pacer.stats()
+    except Exception as e:
+        log.error("Error streaming song: %s", e)
+        stream_errors_total.labels("song").inc()
+        await async_send_locked(session, stream.tag({"type": "STREAM_ERROR", "error": str(e)}))
+    finally:
+        if stream_id is not None:
+            unregister_stream(stream_id)
+
+async def async_stream_channel(session, stream):
+    """Coroutine counterpart of stream_channel"""
+    writer = session.conn
+    subscription = broadcaster.join(stream.request.channel, stream.name)
+    log.info("%s joined channel %s", session.username, stream.request.channel)
+    streams_started_total.labels("channel").inc()
+    chunks_sent = 0
+    try:
+        while True:
+            message, wait = subscription.next_message()
+            if message is None and wait is None:
+                break
+            if isinstance(message, dict):
+                if message["type"] == "SONG_PLAYING":
+                    stream.name = message["name"]
+                await async_send_locked(session, stream.tag(message))
+            elif message is not None:
+                async with session.send_lock:
+                    send_started = time.monotonic()
+                    buffers, payload_length = audio_frame_from_cache(message.entry, 0, stream.prefix)
+                    writer.writelines(buffers)
+                    await writer.drain()
+                record_chunk(stream.request, "channel", send_started, payload_length, chunks_sent == 0)
+                chunks_sent += 1
+            yield wait or 0.0
+            if stream.cancelled:
+                await async_send_locked(session, stream_stopped(stream, subscription.bytes_sent))
+                return
+    finally:
+        subscription.close()
+        log.info("%s left channel %s after %s bytes, skipped forward %s times", session.username,
+                 stream.request.channel, subscription.bytes_sent, subscription.skips)
+
+async def async_stream_live_transcode(session, stream, song_path, track_info, quality):
+    """Asyncio version of stream_live_transcode, reading ffmpeg's output from the event loop"""
+    loop = asyncio.get_running_loop()
+    writer = session.conn
+    song_name = stream.name
+    stream_id = None
+    process = None
+    try:
+        start_time = await loop.run_in_executor(None, live_start_time, song_name, stream.request.start_time,
+                                                stream.request.start_offset)
+        await async_send_locked(session, stream.tag(
+            song_metadata(song_name, None, track_info, 0, start_time or 0.0, None, quality)))
+        log.info("Sending song: %s, live transcode to %s kbps", song_name, quality)
+        process = await asyncio.create_subprocess_exec(
+            *renditions.live_command(song_path, quality, start_time),
+            stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL)
+        
+        pacer = stream.pacer = StreamPacer(quality * 1000, CHUNK_SIZE, PACING_MULTIPLIER, PACING_BURST_SECONDS,
+                                           egress)
+        stream_id = register_stream(pacer, song_name, session.username)
+        streams_started_total.labels("transcode").inc()
+        total_sent = 0
+        while True:
+            try:
+                chunk = await process.stdout.readexactly(CHUNK_SIZE)
+            except asyncio.IncompleteReadError as e:
+                chunk = e.partial
+            if not chunk:
+                break
+            yield pacer.reserve(len(chunk))
+            if stream.cancelled:
+                # Killing ffmpeg in the finally block stops the transcode too
+                await async_send_locked(session, stream_stopped(stream, total_sent))
+                stream.stats = pacer.stats()
+                return
+            async with session.send_lock:
+                send_started = time.monotonic()
+                writer.write(encode_audio_chunk(chunk, stream.prefix)[0])
+                await writer.drain()
+            record_chunk(stream.request, "transcode", send_started, len(chunk), total_sent == 0)
+            total_sent += len(chunk)
+            pacer.record_sent(len(chunk))
+        if await process.wait() != 0:
+            raise RuntimeError(f"Transcoding failed (ffmpeg exit code {process.returncode})")
+        
+        await async_send_locked(session, stream.tag({"type": "SONG_ENDED"}))
+        log.info("Finished sending song: %s, total: %s bytes, stats: %s", song_name, total_sent, pacer.stats())
+        stream.stats = pacer.stats()
+    except Exception as e:
+        log.error("Error streaming song: %s", e)
+        stream_errors_total.labels("transcode").inc()
+        await async_send_locked(session, stream.tag({"type": "STREAM_ERROR", "error": str(e)}))
+    finally:
+        if process is not None and process.returncode is None:
+            process.kill()
+            await process.wait()
+        if stream_id is not None:
+            unregister_stream(stream_id)
+
+async def async_read_http_request(reader, requests, timeout):
+    """Coroutine counterpart of read_http_request; raises asyncio.TimeoutError after timeout idle seconds"""
+    while True:
+        request = requests.next_request()
+        if request is not None:
+            return request
+        data = await asyncio.wait_for(reader.read(RECV_SIZE), timeout)
+        if not data:
+            return None
+        requests.feed(data)
+
+async def async_serve_http(reader, writer, requests, request):
+    """Coroutine counterpart of serve_http"""
+    loop = asyncio.get_running_loop()
+    served = 0
+    while request is not None:
+        served += 1
+        keep_alive = request.keep_alive and served < HTTP_MAX_REQUESTS
+        # Looking the track up stats files and may read its frame index
+        header, body = await loop.run_in_executor(None, http_response, request, keep_alive)
+        http_requests_total.labels(header[9:12].decode()).inc()
+        writer.write(header)
+        await writer.drain()
+        if isinstance(body, tuple):
+            # Zero-copy on plain connections; asyncio reads and writes chunks itself with TLS
+            path, offset, length = body
+            with open(path, "rb") as f:
+                await loop.sendfile(writer.transport, f, offset, length)
+            bytes_sent_total.labels("http").inc(length)
+        elif body:
+            writer.write(body)
+            await writer.drain()
+        if not keep_alive:
+            return
+        try:
+            request = await async_read_http_request(reader, requests, HTTP_KEEPALIVE_TIMEOUT)
+        except asyncio.TimeoutError:
+            return
+        except HTTPError as e:
+            writer.write(b"".join(error_response(e.status, str(e), keep_alive=False)))
+            await writer.drain()
+            return
+
+async def handle_client_async(reader, writer):
+    """Coroutine counterpart of handle_client; TLS is already negotiated by asyncio"""
+    addr = writer.get_extra_info('peername')
+    log.debug("Connected to %s", addr)
+    accepted = time.monotonic()
+    trace = diagnostics.tracer.sample(accepted)
+    connections_total.inc()
+    connections_active.inc()
+    busy = None
+    try:
+        admission.connect()
+    except Busy as e:
+        busy = e
+    try:
+        # Receive the request headers
+        requests = HTTPRequestReader()
+        try:
+            request = await async_read_http_request(reader, requests, HANDSHAKE_TIMEOUT)
+        except HTTPError as e:
+            writer.write(b"".join(error_response(e.status, str(e), keep_alive=False)))
+            await writer.drain()
+            return
+        if request is None:
+            return
+        data = request.raw
+        
+        # Check if this is a WebSocket handshake request
+        if request.is_websocket_upgrade:
+            handshake_response = build_handshake_response(data)
+            if handshake_response is None:
+                log.warning("WebSocket handshake failed")
+                return
+            writer.write(handshake_response)
+            await writer.drain()
+            log.debug("WebSocket handshake completed")
+            handshake_seconds.observe(time.monotonic() - accepted)
+            trace_span(trace, "handshake", accepted, multiplexed=wants_multiplexing(data))
+            if busy is not None:
+                await async_send_websocket_message(writer, busy_reply(busy))
+                writer.write(close_frame(CLOSE_TRY_AGAIN_LATER))
+                await writer.drain()
+                return
+            
+            # WebSocket connection established
+            session = ClientSession(writer, addr, wants_multiplexing(data))
+            session.trace = trace
+            session.send_lock = asyncio.Lock()
+            session.wakeup = asyncio.Event()  # Set after every message, so the streams task rechecks the session
+            frames = WebSocketFrameReader()
+            closing = False
+            
+            # Send authentication required message
+            await async_send_websocket_message(writer, {"type": "AUTH_REQUIRED"})
+            streamer = asyncio.create_task(async_serve_streams(session))
+            
+            # WebSocket communication loop
+            while not closing:
+                try:
+                    # Receive whatever is available; the reader reassembles frames
+                    frame_data = await reader.read(RECV_SIZE)
+                    if not frame_data:
+                        log.debug("Client disconnected")
+                        break
+                    frames.feed(frame_data)
+                    
+                    for opcode, payload in frames.messages():
+                        if opcode >= OPCODE_CLOSE:
+                            reply_frame, closing = handle_control_frame(opcode, payload)
+                            if reply_frame:
+                                async with session.send_lock:
+                                    writer.write(reply_frame)
+                                    await writer.drain()
+                            if closing:
+                                log.debug("Client closed the connection")
+                                break
+                            continue
+                        if opcode != OPCODE_TEXT:
+                            continue
+                        
+                        message = payload.decode()
+                        log.debug("Received WebSocket message: %s", message)
+                        
+                        for reply in session.handle(message):
+                            await async_send_locked(session, reply)
+                        session.wakeup.set()
+                
+                except WebSocketProtocolError as e:
+                    log.warning("WebSocket protocol error from %s: %s", addr, e)
+                    writer.write(close_frame(e.close_code))
+                    await writer.drain()
+                    break
+                except ConnectionResetError:
+                    log.info("Connection reset by %s", addr)
+                    break
+                except Exception as e:
+                    log.warning("Error in WebSocket communication: %s", e)
+                    break
+            
+            session.closed = True
+            streamer.cancel()
+            try:
+                await streamer
+            except (asyncio.CancelledError, Exception):
+                pass
+        elif busy is not None:
+            writer.write(b"".join(busy_http_response(busy)))
+            await writer.drain()
+        else:
+            # Plain HTTP: track downloads, anything else gets a 400
+            await async_serve_http(reader, writer, requests, request)
+            
+    except (BrokenPipeError, ConnectionResetError):
+        log.info("Connection reset by %s", addr)
+    except Exception as e:
+        log.error("Error serving %s: %s", addr, e)
+    finally:
+        connections_active.dec()
+        if busy is None:
+            admission.disconnect()
+        trace_span(trace, "connection", accepted, addr=f"{addr[0]}:{addr[1]}", engine="asyncio")
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except Exception:
+            pass
+
+async def serve_async():
+    """Run the asyncio engine until cancelled"""
+    global USE_SSL
+    context = None
+    if USE_SSL:
+        context = get_ssl_context()
+        if context is None:
+            print("Failed to create SSL context. Starting server without SSL.")
+            USE_SSL = False
+        else:
+            print(f"SSL enabled. Server will use secure WebSockets (wss://)")
+    
+    server = await asyncio.start_server(
+        handle_client_async, HOST, PORT,
+        ssl=context,
+        ssl_handshake_timeout=HANDSHAKE_TIMEOUT if context else None,
+        backlog=LISTEN_BACKLOG,
+        reuse_address=True,
+        reuse_port=REUSE_PORT or None
+    )
+    protocol = "wss://" if USE_SSL else "ws://"
+    print(f"Server listening on {protocol}{HOST}:{PORT} (asyncio engine)")
+    async with server:
+        await server.serve_forever()
+
+def start_async_server():
+    try:
+        asyncio.run(serve_async())
+    except KeyboardInterrupt:
+        print("\nServer shutting down...")
 
 def start_http_redirect():
     class RedirectHandler(http.server.SimpleHTTPRequestHandler):
@@ -448,21 +2416,173 @@ def start_http_redirect():
     except Exception as e:
         print(f"Error starting HTTP redirect: {e}")
 
-# Start the HTTP redirect in a separate thread
-try:
-    redirect_thread = threading.Thread(target=start_http_redirect, daemon=True)
-    redirect_thread.start()
-except Exception as e:
-    print(f"Error starting HTTP redirect: {e}")
+def serve():
+    """Run the selected connection engine in this process"""
+    if SERVER_MODE == "asyncio":
+        start_async_server()
+    else:
+        start_server()
+
+def init_worker(worker_id):
+    """Set up a freshly forked worker: follow the supervisor's catalog instead of scanning"""
+    admission.user_streams.use_row(worker_id)
+    catalog.follow_snapshot()
+    indexer.after_fork()
+    analyzer.after_fork()
+    search_index.after_fork()
+    search_index.start()
+    broadcaster.after_fork()
+    metrics.after_fork()
+    diagnostics.after_fork()
+    restart_log_writer()
+
+def worker_stats():
+    """Stats a worker reports to the supervisor"""
+    return {"streams": stream_stats(), "chunk_cache": chunk_cache.stats(), "metrics": metrics.snapshot()}
+
+def start_metrics(collect):
+    """Serve collect() at http://METRICS_HOST:METRICS_PORT/metrics, unless disabled"""
+    if not METRICS_PORT:
+        return
+    try:
+        serve_metrics(METRICS_HOST, METRICS_PORT, collect)
+        print(f"Metrics at http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    except OSError as e:
+        print(f"Error starting metrics endpoint: {e}")
+
+def start_workers():
+    """Pre-fork WORKERS processes that each serve connections on the shared port"""
+    global REUSE_PORT
+    REUSE_PORT = True
+    # Create the SSL context (and certificate) once, before forking, so every
+    # worker shares the session ticket keys
+    if USE_SSL:
+        get_ssl_context()
+    session_tokens.load()
+    print(f"Starting {WORKERS} worker processes")
+    pool = WorkerPool(WORKERS, serve, worker_stats, init_worker)
+    # The supervisor serves the sum of the workers' metrics, as of their last reports
+    start_metrics(lambda: render(merge_snapshots(
+        [stats["metrics"] for _, stats in list(pool.worker_stats.values()) if "metrics" in stats])))
+    pool.run()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="ByteBeats Music Server")
+    parser.add_argument("--mode", choices=["threaded", "asyncio"], default=SERVER_MODE,
+                        help="Connection engine: one thread per client, or a single asyncio event loop")
+    parser.add_argument("--pacing-multiplier", type=float, default=PACING_MULTIPLIER,
+                        help="Send rate as a multiple of each track's bitrate (0 disables pacing)")
+    parser.add_argument("--burst-seconds", type=float, default=PACING_BURST_SECONDS,
+                        help="Seconds of audio sent at full speed at the start of each stream")
+    parser.add_argument("--no-ssl", action="store_true",
+                        help="Serve plain ws:// instead of wss://")
+    parser.add_argument("--port", type=int, default=PORT,
+                        help="Port for WebSocket and /tracks connections")
+    parser.add_argument("--music-dir", default=MUSIC_DIR,
+                        help="Directory of audio files to serve (indexed separately from the default one)")
+    parser.add_argument("--cert-type", choices=["rsa", "ecdsa"], default=CERT_TYPE,
+                        help="Key type of the generated certificate (ECDSA P-256 handshakes are cheaper)")
+    parser.add_argument("--cache-mb", type=int, default=CHUNK_CACHE_BYTES // (1024 * 1024),
+                        help="Memory budget in MB for audio chunks shared between streams (0 disables)")
+    parser.add_argument("--rendition-cache-mb", type=int, default=RENDITION_CACHE_BYTES // (1024 * 1024),
+                        help="Disk budget in MB for transcoded lower-bitrate copies of tracks")
+    parser.add_argument("--transcode-workers", type=int, default=TRANSCODE_WORKERS,
+                        help="Number of ffmpeg processes encoding renditions in the background")
+    parser.add_argument("--live-transcodes", type=int, default=LIVE_TRANSCODES,
+                        help="On-the-fly transcodes at once, while renditions are made; beyond that "
+                             "streams get the original file (0 = no limit)")
+    parser.add_argument("--analyze", action="store_true",
+                        help="Analyse new tracks (loudness, waveform) in the background while serving")
+    parser.add_argument("--analysis-workers", type=int, default=ANALYSIS_WORKERS,
+                        help="Number of processes decoding tracks for --analyze")
+    parser.add_argument("--workers", type=int, default=WORKERS,
+                        help="Number of worker processes sharing the port (each runs the selected engine)")
+    parser.add_argument("--max-connections", type=int, default=MAX_CONNECTIONS,
+                        help="Open connections before new ones are told BUSY (0 = no limit)")
+    parser.add_argument("--max-streams", type=int, default=MAX_ACTIVE_STREAMS,
+                        help="Streams sending at once over all users before new ones are told BUSY (0 = no limit)")
+    parser.add_argument("--max-user-streams", type=int, default=MAX_USER_STREAMS,
+                        help="Streams one user may have at once, unless user_config.json sets max_streams (0 = no limit)")
+    parser.add_argument("--egress-mbps", type=float, default=EGRESS_MBPS,
+                        help="Egress budget for audio in Mbit/s, shared fairly between users and their streams (0 = none)")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT,
+                        help=f"Local port for Prometheus metrics at /metrics on {METRICS_HOST} (0 disables)")
+    parser.add_argument("--log-level", choices=["debug", "info", "warning", "error"], default=LOG_LEVEL,
+                        help="Least severe messages to log (debug includes every client message)")
+    args = parser.parse_args()
+    # Each worker shares out only its own part of the budget, between the users it happens to serve
+    if args.workers > 1 and args.egress_mbps and USER_WEIGHTS:
+        parser.error("user weights in user_config.json need --workers 1 (or no --egress-mbps)")
+    return args
 
 if __name__ == "__main__":
+    args = parse_args()
+    SERVER_MODE = args.mode
+    PACING_MULTIPLIER = args.pacing_multiplier
+    PACING_BURST_SECONDS = args.burst_seconds
+    chunk_cache.budget_bytes = args.cache_mb * 1024 * 1024
+    # Like the other limits, each worker takes an equal part
+    renditions = RenditionStore(RENDITION_CACHE_DIR, args.rendition_cache_mb * 1024 * 1024,
+                                max(1, args.transcode_workers),
+                                live_limit=math.ceil(args.live_transcodes / max(1, args.workers)))
+    ANALYZE_IN_BACKGROUND = args.analyze
+    analyzer.workers = max(1, args.analysis_workers)
+    if args.no_ssl:
+        USE_SSL = False
+    PORT = args.port
+    if os.path.abspath(args.music_dir) != MUSIC_DIR:
+        # Another library gets its own snapshot, so it doesn't replace the default one
+        MUSIC_DIR = os.path.abspath(args.music_dir)
+        CATALOG_SNAPSHOT = os.path.join(BASE_DIR, "cache", "catalogs",
+                                        hashlib.sha1(MUSIC_DIR.encode()).hexdigest()[:16] + ".db")
+        os.makedirs(os.path.dirname(CATALOG_SNAPSHOT), exist_ok=True)
+        catalog.root = MUSIC_DIR
+        catalog.snapshot_path = CATALOG_SNAPSHOT
+    WORKERS = max(1, args.workers)
+    MAX_CONNECTIONS = args.max_connections
+    MAX_ACTIVE_STREAMS = args.max_streams
+    MAX_USER_STREAMS = args.max_user_streams
+    EGRESS_MBPS = args.egress_mbps
+    # Each worker enforces its own part of the overall limits; per-user streams are counted
+    # in shared memory, so a user's limit holds over all workers
+    admission = AdmissionControl(math.ceil(MAX_CONNECTIONS / WORKERS), math.ceil(MAX_ACTIVE_STREAMS / WORKERS),
+                                 MAX_USER_STREAMS, USER_STREAM_LIMITS, EGRESS_MBPS * 1000000 / 8 / WORKERS,
+                                 UserStreamCounts(USERS, WORKERS))
+    egress = EgressScheduler(EGRESS_MBPS * 1000000 / 8 / WORKERS, USER_WEIGHTS, chunk_size=CHUNK_SIZE)
+    METRICS_PORT = args.metrics_port
+    LOG_LEVEL = args.log_level
+    setup_logging(LOG_LEVEL)
+    CERT_TYPE = args.cert_type
+    if CERT_TYPE != "rsa":
+        CERT_FILE = os.path.join(CERT_DIR, f"server-{CERT_TYPE}.crt")
+        KEY_FILE = os.path.join(CERT_DIR, f"server-{CERT_TYPE}.key")
+    
+    # Start the HTTP redirect in a separate thread
+    try:
+        redirect_thread = threading.Thread(target=start_http_redirect, daemon=True)
+        redirect_thread.start()
+    except Exception as e:
+        print(f"Error starting HTTP redirect: {e}")
+    
     try:
         print(f"ByteBeats Music Server starting...")
         print(f"Music directory: {MUSIC_DIR}")
-        start_server()
+        if renditions.available:
+            print(f"Renditions: {', '.join(map(str, RENDITION_BITRATES))} kbps, cached in {RENDITION_CACHE_DIR}")
+        else:
+            print("ffmpeg or ffmpeg-python not found: streaming original files only")
+        if ANALYZE_IN_BACKGROUND and not analysis_available():
+            print("NumPy, ffmpeg or ffmpeg-python not found: background analysis disabled")
+        init_catalog()
+        if WORKERS > 1:
+            start_workers()
+        else:
+            start_metrics(lambda: render(metrics.snapshot()))
+            serve()
     except KeyboardInterrupt:
         print("\nServer terminated by user")
     except Exception as e:
         print(f"Error: {e}")
     finally:
-        print("Server shutdown complete")
\ No newline at end of file
+        stop_logging()
+        print("Server shutdown complete")
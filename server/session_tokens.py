@@ -0,0 +1,70 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+
+SECRET_BYTES = 32
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+class SessionTokens:
+    """Issues and checks signed, expiring session tokens.
+
+    A token is "<payload>.<signature>", both base64url: the payload is a
+    small JSON object with the username and expiry time, and the signature
+    an HMAC-SHA256 of it. The signing key is generated once and kept in
+    secret_path, so tokens survive restarts and are valid on every worker.
+    """
+    def __init__(self, secret_path, ttl):
+        self.secret_path = secret_path
+        self.ttl = ttl
+        self._secret = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Load the signing key, creating it on first use"""
+        with self._lock:
+            if self._secret is not None:
+                return self._secret
+            try:
+                os.makedirs(os.path.dirname(self.secret_path), exist_ok=True)
+                fd = os.open(self.secret_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+                with os.fdopen(fd, "wb") as f:
+                    f.write(os.urandom(SECRET_BYTES))
+                print(f"Generated session token key at {self.secret_path}")
+            except FileExistsError:
+                pass
+            with open(self.secret_path, "rb") as f:
+                self._secret = f.read()
+            return self._secret
+
+    def _sign(self, payload):
+        return hmac.new(self.load(), payload.encode("ascii"), hashlib.sha256).digest()
+
+    def issue(self, username):
+        """Return (token, expiry time in seconds since the epoch) for a user"""
+        expires = int(time.time() + self.ttl)
+        payload = _b64encode(json.dumps({"u": username, "exp": expires}, separators=(",", ":")).encode())
+        return f"{payload}.{_b64encode(self._sign(payload))}", expires
+
+    def verify(self, token):
+        """Return the username a token was issued to, or None if it is forged, malformed or expired"""
+        if not isinstance(token, str) or token.count(".") != 1:
+            return None
+        payload, signature = token.split(".")
+        try:
+            if not hmac.compare_digest(_b64decode(signature), self._sign(payload)):
+                return None
+            claims = json.loads(_b64decode(payload))
+        except (ValueError, UnicodeEncodeError):
+            return None
+        if not isinstance(claims, dict) or claims.get("exp", 0) < time.time():
+            return None
+        return claims.get("u")
@@ -0,0 +1,53 @@
+import multiprocessing
+
+import pytest
+
+from admission import AdmissionControl, Busy, UserStreamCounts
+
+def test_user_limit_and_release():
+    admission = AdmissionControl(max_user_streams=2, user_limits={"vip": 3})
+    slots = [admission.acquire("user1", 0), admission.acquire("user1", 0)]
+    with pytest.raises(Busy) as error:
+        admission.acquire("user1", 0)
+    assert error.value.reason == "user_streams"
+    for _ in range(3):
+        admission.acquire("vip", 0)
+    admission.release(slots[0])
+    admission.acquire("user1", 0)
+
+def worker(counts, row, username, results):
+    counts.use_row(row)
+    results.put([counts.try_add(username, 3)[0] for _ in range(2)])
+
+def test_user_counts_are_shared_between_forked_workers():
+    counts = UserStreamCounts(["user1", "user2"], workers=2)
+    results = multiprocessing.get_context("fork").Queue()
+    processes = [multiprocessing.get_context("fork").Process(target=worker, args=(counts, row, "user1", results))
+                 for row in range(2)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    added = results.get(timeout=5) + results.get(timeout=5)
+    # Four tries over two workers, against a limit of three
+    assert sorted(added) == [False, True, True, True]
+    assert counts.count("user1") == 3
+    assert counts.count("user2") == 0
+
+def test_restarted_worker_forgets_its_streams():
+    counts = UserStreamCounts(["user1"], workers=2)
+    counts.use_row(1)
+    counts.try_add("user1", 0)
+    counts.try_add("user1", 0)
+    counts.use_row(0)
+    counts.try_add("user1", 0)
+    assert counts.count("user1") == 3
+    counts.use_row(1)  # Worker 1 restarted
+    assert counts.count("user1") == 1
+
+def test_unknown_users_are_counted_locally():
+    counts = UserStreamCounts(["user1"], workers=2)
+    assert counts.try_add("guest", 1) == (True, 0)
+    assert counts.try_add("guest", 1) == (False, 1)
+    counts.remove("guest")
+    assert counts.count("guest") == 0
@@ -0,0 +1,89 @@
+from broadcast import BroadcastChannel, ChannelChunk, ChannelSubscription, ChannelTrack
+
+def encode(payload):
+    return b"\x82" + bytes([len(payload)]) + payload, 2
+
+def make_channel(ring_chunks=4, join_burst_seconds=2.5):
+    # The producer thread isn't started: tests publish chunks themselves
+    return BroadcastChannel("party", "a.mp3", None, None, encode, 10, ring_chunks, join_burst_seconds)
+
+def play(channel, name, chunks, start=0):
+    """Publish chunks of one second of song name, the first at chunk number start"""
+    if channel.track.name != name or channel.track.metadata is None:
+        channel.track = ChannelTrack(name, {"type": "SONG_METADATA", "name": name})
+    for i in range(start, start + chunks):
+        channel._publish(channel.track, i * 10, float(i), 1.0, bytes([i]) * 10)
+
+def drain(subscription):
+    """Every message and chunk a listener can get now, chunks as their payloads' first byte"""
+    received = []
+    while True:
+        item, wait = subscription.next_message()
+        if item is None:
+            return received
+        received.append(item.entry[0][2] if isinstance(item, ChannelChunk) else item["type"])
+
+def test_chunk_lookup():
+    channel = make_channel()
+    play(channel, "a.mp3", 6)
+    assert channel.chunk(6) is None   # Not published yet
+    assert channel.chunk(1) is False  # Overwritten
+    assert channel.chunk(2).seq == 2
+
+def test_join_burst_behind_the_head():
+    channel = make_channel(ring_chunks=8)
+    play(channel, "a.mp3", 6)
+    subscription = ChannelSubscription(None, channel)
+    # Three one-second chunks cover the 2.5 second burst
+    assert subscription.cursor == 3
+    assert drain(subscription) == ["SONG_PLAYING", "SONG_METADATA", 3, 4, 5]
+
+def test_join_stays_in_the_current_track():
+    channel = make_channel(ring_chunks=8)
+    play(channel, "a.mp3", 4)
+    play(channel, "b.mp3", 1)
+    assert ChannelSubscription(None, channel).cursor == 4
+
+def test_lapped_listener_skips_forward():
+    channel = make_channel(ring_chunks=4)
+    play(channel, "a.mp3", 2)
+    subscription = ChannelSubscription(None, channel)
+    assert drain(subscription) == ["SONG_PLAYING", "SONG_METADATA", 0, 1]
+    play(channel, "a.mp3", 10, start=2)
+    # Chunks 2 to 7 are gone; the listener rejoins a burst behind the head, in the same song
+    assert drain(subscription) == [9, 10, 11]
+    assert subscription.skips == 1
+    assert channel.skips == 1
+    play(channel, "a.mp3", 1, start=12)
+    assert drain(subscription) == [12]
+
+def test_lapped_into_the_next_track():
+    channel = make_channel(ring_chunks=4)
+    play(channel, "a.mp3", 2)
+    subscription = ChannelSubscription(None, channel)
+    drain(subscription)
+    play(channel, "a.mp3", 3, start=2)
+    play(channel, "b.mp3", 4)
+    assert drain(subscription) == ["SONG_ENDED", "SONG_PLAYING", "SONG_METADATA", 1, 2, 3]
+    assert subscription.track.name == "b.mp3"
+    assert subscription.skips == 1
+
+def test_metadata_says_where_the_listener_joined():
+    channel = make_channel(ring_chunks=8)
+    play(channel, "a.mp3", 6)
+    subscription = ChannelSubscription(None, channel)
+    subscription.next_message()
+    metadata, _ = subscription.next_message()
+    assert (metadata["start_offset"], metadata["start_time"], metadata["channel"]) == (30, 3.0, "party")
+
+def test_waits_for_the_producer_then_ends_with_the_channel():
+    channel = make_channel()
+    play(channel, "a.mp3", 1)
+    subscription = ChannelSubscription(None, channel)
+    drain(subscription)
+    item, wait = subscription.next_message()
+    assert item is None and wait is not None
+    channel.closed = True
+    channel.error = "disk on fire"
+    assert drain(subscription) == ["SONG_ENDED", "STREAM_ERROR"]
+    assert subscription.next_message() == (None, None)
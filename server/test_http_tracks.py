@@ -0,0 +1,59 @@
+import pytest
+
+from http_tracks import HTTPError, parse_range, etag_matches
+
+SIZE = 1000
+
+@pytest.mark.parametrize("header, expected", [
+    ("bytes=0-99", (0, 99)),
+    ("bytes=100-", (100, 999)),
+    ("bytes=-100", (900, 999)),
+    ("bytes=990-2000", (990, 999)),   # Clamped to the end of the file
+    ("bytes=-5000", (0, 999)),        # Suffix longer than the file
+    ("bytes=999-999", (999, 999)),
+    (" bytes=0-0 ", (0, 0)),
+])
+def test_single_ranges(header, expected):
+    assert parse_range(header, SIZE) == expected
+
+@pytest.mark.parametrize("header", [
+    None,
+    "",
+    "bytes=0-99,200-299",   # Multiple ranges are ignored, not half served
+    "bytes=0-0, -1",
+    "bytes=-",
+    "bytes=50-10",          # Last before first
+    "items=0-99",
+    "bytes=a-b",
+    "bytes=0-99\r\nX: y",
+])
+def test_ranges_served_as_the_whole_file(header):
+    assert parse_range(header, SIZE) is None
+
+@pytest.mark.parametrize("header, size", [
+    ("bytes=1000-", SIZE),
+    ("bytes=5000-6000", SIZE),
+    ("bytes=-0", SIZE),
+    ("bytes=0-", 0),
+    ("bytes=-10", 0),
+])
+def test_unsatisfiable_ranges(header, size):
+    with pytest.raises(HTTPError) as error:
+        parse_range(header, size)
+    assert error.value.status == 416
+
+@pytest.mark.parametrize("header, expected", [
+    ('"abc"', True),
+    ('W/"abc"', True),
+    ('"x", "abc"', True),
+    ('"x",W/"abc"', True),
+    ("*", True),
+    (" * ", True),
+    ('"abcd"', False),
+    ('"ab"', False),
+    ("abc", False),           # Unquoted
+    ('"x", "y"', False),
+    ("", False),
+])
+def test_etag_matches(header, expected):
+    assert etag_matches(header, "abc") is expected
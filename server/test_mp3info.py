@@ -0,0 +1,103 @@
+import struct
+
+import pytest
+
+from mp3info import BITRATES, read_bitrate, scan_track
+
+SAMPLE_RATE = 44100
+
+def frame(kbps, padding=0, mono=False, body=b""):
+    """An MPEG 1 layer III frame at kbps, 44.1 kHz, filled out with zeros after body"""
+    bitrate_index = BITRATES[(3, 3)].index(kbps)
+    header = bytes([0xFF, 0xFB, bitrate_index << 4 | padding << 1, 0xC0 if mono else 0x00])
+    length = 144 * kbps * 1000 // SAMPLE_RATE + padding
+    return (header + body).ljust(length, b"\x00")
+
+def xing_frame(frame_count):
+    # In a stereo MPEG 1 frame the Xing header follows 32 bytes of side information
+    return frame(128, body=b"\x00" * 32 + b"Xing" + struct.pack(">II", 0x01, frame_count))
+
+def syncsafe(size):
+    return bytes((size >> shift) & 0x7F for shift in (21, 14, 7, 0))
+
+def id3v23_frame(frame_id, body):
+    return frame_id + struct.pack(">I", len(body)) + b"\x00\x00" + body
+
+def id3v2_tag(frames, padding=64):
+    body = b"".join(frames) + b"\x00" * padding
+    return b"ID3\x03\x00\x00" + syncsafe(len(body)) + body
+
+def id3v1_trailer(title="", artist="", album=""):
+    fields = [value.encode("latin-1").ljust(30, b"\x00") for value in (title, artist, album)]
+    return b"TAG" + b"".join(fields) + b"\x00" * 35  # Year, comment and genre
+
+def write(tmp_path, *parts):
+    path = tmp_path / "track.mp3"
+    path.write_bytes(b"".join(parts))
+    return str(path)
+
+def test_cbr(tmp_path):
+    frames = [frame(128, padding=i % 2) for i in range(50)]
+    path = write(tmp_path, *frames)
+    index = scan_track(path)
+    assert len(index.offsets) == 50
+    assert list(index.offsets[:3]) == [0, len(frames[0]), len(frames[0]) + len(frames[1])]
+    assert not index.vbr
+    assert index.duration == pytest.approx(50 * 1152 / SAMPLE_RATE)
+    assert index.bitrate == pytest.approx(128000, rel=0.01)
+    assert read_bitrate(path) == 128000
+
+def test_vbr_with_xing_header(tmp_path):
+    rates = [32, 320, 128, 64, 256] * 20
+    frames = [frame(kbps) for kbps in rates]
+    path = write(tmp_path, xing_frame(len(frames)), *frames)
+    index = scan_track(path)
+    # The Xing frame carries no audio and isn't indexed
+    assert len(index.offsets) == len(frames)
+    assert index.offsets[0] == len(xing_frame(0))
+    assert index.vbr
+    assert index.audio_end == sum(len(f) for f in frames) + len(xing_frame(0))
+    assert index.bitrate == pytest.approx(sum(rates) / len(rates) * 1000, rel=0.01)
+    # Seeking maps times and offsets onto frame boundaries, whatever each frame's size
+    assert index.frame_at_time(10 * 1152 / SAMPLE_RATE) == 10
+    assert index.frame_at_offset(index.offsets[37]) == 37
+    assert index.frame_at_offset(index.offsets[37] + 1) == 38
+
+def test_id3v2_and_id3v1_tags(tmp_path):
+    tag = id3v2_tag([
+        id3v23_frame(b"TIT2", b"\x00Caf\xe9 Song"),  # Latin-1
+        id3v23_frame(b"TPE1", b"\x01" + "Beyoncé\x00".encode("utf-16")),  # UTF-16 with a BOM
+        id3v23_frame(b"TXXX", b"\x00something\x00else"),
+    ])
+    frames = [frame(192) for _ in range(20)]
+    trailer = id3v1_trailer(title="Ignored", album="The Album")
+    path = write(tmp_path, tag, *frames, trailer)
+    index = scan_track(path)
+    # ID3v2 wins; the ID3v1 trailer fills in what it lacks
+    assert index.tags == {"title": "Café Song", "artist": "Beyoncé", "album": "The Album"}
+    assert index.offsets[0] == len(tag)
+    assert len(index.offsets) == 20
+    # The trailer is not audio
+    assert index.audio_end == len(tag) + sum(len(f) for f in frames)
+    assert read_bitrate(path) == 192000
+
+def test_false_sync_before_the_first_frame(tmp_path):
+    # A lone frame header with garbage after it must not start the index
+    junk = frame(128)[:4] + b"\x01\x02\xff\xfb\x00"
+    frames = [frame(160) for _ in range(10)]
+    path = write(tmp_path, id3v2_tag([], padding=10), junk, *frames)
+    index = scan_track(path)
+    assert index.offsets[0] == 20 + len(junk)
+    assert len(index.offsets) == 10
+
+def test_truncated_last_frame(tmp_path):
+    frames = [frame(128) for _ in range(10)]
+    path = write(tmp_path, *frames, frame(128)[:100])
+    assert len(scan_track(path).offsets) == 10
+
+def test_not_mpeg_audio(tmp_path):
+    path = write(tmp_path, b"\x00" * 5000)
+    index = scan_track(path)
+    assert len(index.offsets) == 0
+    assert index.bitrate is None
+    assert read_bitrate(path) is None
@@ -0,0 +1,42 @@
+import pytest
+
+from pacing import fair_shares
+
+def test_equal_weights_split_evenly():
+    assert fair_shares(90, [("a", 1, 100), ("b", 1, 100), ("c", 1, 100)]) == pytest.approx(
+        {"a": 30, "b": 30, "c": 30})
+
+def test_nobody_gets_more_than_they_ask_for():
+    shares = fair_shares(90, [("a", 1, 10), ("b", 1, 100), ("c", 1, 100)])
+    # What a leaves is split between b and c
+    assert shares == pytest.approx({"a": 10, "b": 40, "c": 40})
+
+def test_capacity_left_over_when_everyone_is_satisfied():
+    shares = fair_shares(100, [("a", 1, 10), ("b", 1, 20)])
+    assert shares == pytest.approx({"a": 10, "b": 20})
+
+def test_weights():
+    shares = fair_shares(90, [("a", 2, 100), ("b", 1, 100)])
+    assert shares == pytest.approx({"a": 60, "b": 30})
+
+def test_weighted_leftovers_go_to_the_others_by_weight():
+    # c is satisfied with 10 of its 30; a and b split the other 80 by weight 3:1
+    shares = fair_shares(90, [("a", 3, 1000), ("b", 1, 1000), ("c", 1, 10)])
+    assert shares == pytest.approx({"a": 60, "b": 20, "c": 10})
+
+def test_max_min_allocation_properties():
+    claims = [("a", 1, 5), ("b", 2, 50), ("c", 1, 15), ("d", 0.5, 200), ("e", 1, 0)]
+    capacity = 100
+    shares = fair_shares(capacity, claims)
+    assert sum(shares.values()) == pytest.approx(capacity)
+    for key, weight, demand in claims:
+        assert 0 <= shares[key] <= demand + 1e-9
+    # Anyone short of their demand has at least as large a share per weight as anyone else
+    unsatisfied = [shares[key] / weight for key, weight, demand in claims if shares[key] < demand - 1e-9]
+    for key, weight, demand in claims:
+        for level in unsatisfied:
+            assert shares[key] / weight <= level + 1e-9
+
+def test_no_capacity_or_claims():
+    assert fair_shares(0, [("a", 1, 10)]) == {"a": 0}
+    assert fair_shares(100, []) == {}
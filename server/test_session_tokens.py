@@ -0,0 +1,54 @@
+import json
+import os
+import time
+
+import pytest
+
+from session_tokens import SessionTokens, _b64decode, _b64encode
+
+@pytest.fixture
+def tokens(tmp_path):
+    return SessionTokens(str(tmp_path / "certs" / "session.key"), ttl=60)
+
+def test_round_trip(tokens):
+    token, expires = tokens.issue("user1")
+    assert tokens.verify(token) == "user1"
+    assert expires == pytest.approx(time.time() + 60, abs=2)
+
+def test_key_is_kept_and_shared(tokens, tmp_path):
+    token, _ = tokens.issue("user1")
+    assert os.stat(tokens.secret_path).st_mode & 0o777 == 0o600
+    # Another process (or a restart) reading the same key accepts the token
+    assert SessionTokens(tokens.secret_path, ttl=60).verify(token) == "user1"
+    assert SessionTokens(str(tmp_path / "other.key"), ttl=60).verify(token) is None
+
+def test_expired(tokens, monkeypatch):
+    token, expires = tokens.issue("user1")
+    monkeypatch.setattr(time, "time", lambda: expires + 1)
+    assert tokens.verify(token) is None
+
+def test_tampered_payload(tokens):
+    token, _ = tokens.issue("user1")
+    payload, signature = token.split(".")
+    claims = json.loads(_b64decode(payload))
+    for forged in ({"u": "admin", "exp": claims["exp"]}, {"u": "user1", "exp": claims["exp"] + 10 ** 6}):
+        forged_payload = _b64encode(json.dumps(forged, separators=(",", ":")).encode())
+        assert tokens.verify(f"{forged_payload}.{signature}") is None
+
+def test_tampered_signature(tokens):
+    token, _ = tokens.issue("user1")
+    payload, signature = token.split(".")
+    flipped = bytearray(_b64decode(signature))
+    flipped[0] ^= 1
+    assert tokens.verify(f"{payload}.{_b64encode(bytes(flipped))}") is None
+    assert tokens.verify(f"{payload}.") is None
+    assert tokens.verify(f"{payload}.{signature[:-2]}") is None
+
+@pytest.mark.parametrize("token", [None, 42, "", "no-dot", "a.b.c", ".", "!!!.???", "é.é"])
+def test_malformed(tokens, token):
+    assert tokens.verify(token) is None
+
+def test_signed_garbage_payload(tokens):
+    # Validly signed, but not a JSON object of claims
+    for payload in (_b64encode(b"not json"), _b64encode(b"[1, 2]")):
+        assert tokens.verify(f"{payload}.{_b64encode(tokens._sign(payload))}") is None
@@ -0,0 +1,105 @@
+import os
+import struct
+
+import pytest
+
+from server import (WebSocketFrameReader, WebSocketProtocolError, unmask_payload, OPCODE_CONTINUATION,
+                    OPCODE_TEXT, OPCODE_BINARY, OPCODE_CLOSE, OPCODE_PING)
+
+def client_frame(payload, opcode=OPCODE_TEXT, fin=True, mask_key=b"\x12\x34\x56\x78"):
+    """Encode a masked frame, as a client sends it"""
+    header = bytes([(0x80 if fin else 0) | opcode])
+    if len(payload) < 126:
+        header += bytes([0x80 | len(payload)])
+    elif len(payload) < 65536:
+        header += bytes([0x80 | 126]) + struct.pack(">H", len(payload))
+    else:
+        header += bytes([0x80 | 127]) + struct.pack(">Q", len(payload))
+    masked = bytes(b ^ mask_key[i % 4] for i, b in enumerate(payload))
+    return header + mask_key + masked
+
+def read_all(*chunks, reader=None):
+    reader = reader or WebSocketFrameReader()
+    messages = []
+    for chunk in chunks:
+        reader.feed(chunk)
+        messages.extend(reader.messages())
+    return messages
+
+@pytest.mark.parametrize("length", [0, 1, 3, 4, 5, 125, 126, 65535, 65536])
+def test_unmask_payload_matches_bytewise_xor(length):
+    payload = os.urandom(length)
+    mask_key = b"\xa1\x00\xff\x5c"
+    assert unmask_payload(payload, mask_key) == bytes(b ^ mask_key[i % 4] for i, b in enumerate(payload))
+
+def test_unmask_payload_keeps_leading_zero_bytes():
+    mask_key = b"\x01\x02\x03\x04"
+    assert unmask_payload(b"\x01\x02\x03\x04\x05", mask_key) == b"\x00\x00\x00\x00\x04"
+
+@pytest.mark.parametrize("length", [5, 300])
+def test_frame_fed_byte_by_byte(length):
+    payload = os.urandom(length)
+    frame = client_frame(payload, OPCODE_BINARY)
+    reader = WebSocketFrameReader()
+    assert read_all(*(frame[i:i + 1] for i in range(len(frame))), reader=reader) == [(OPCODE_BINARY, payload)]
+    assert not reader.buffer
+
+def test_frame_split_inside_its_64_bit_length():
+    payload = os.urandom(70000)
+    frame = client_frame(payload, OPCODE_BINARY)
+    # Split inside the length, the mask and the payload
+    assert read_all(frame[:5], frame[5:12], frame[12:1000], frame[1000:]) == [(OPCODE_BINARY, payload)]
+
+def test_coalesced_frames():
+    data = client_frame(b"one") + client_frame(b"two") + client_frame(b"\x00\x01", OPCODE_BINARY)
+    assert read_all(data) == [(OPCODE_TEXT, b"one"), (OPCODE_TEXT, b"two"), (OPCODE_BINARY, b"\x00\x01")]
+
+def test_coalesced_with_a_partial_frame_left_over():
+    second = client_frame(b"second")
+    reader = WebSocketFrameReader()
+    assert read_all(client_frame(b"first") + second[:4], reader=reader) == [(OPCODE_TEXT, b"first")]
+    assert read_all(second[4:], reader=reader) == [(OPCODE_TEXT, b"second")]
+
+def test_fragmented_message_with_control_frames_between():
+    data = (client_frame(b"Hel", OPCODE_TEXT, fin=False)
+            + client_frame(b"ping", OPCODE_PING)
+            + client_frame(b"lo, ", OPCODE_CONTINUATION, fin=False)
+            + client_frame(b"world", OPCODE_CONTINUATION))
+    assert read_all(data) == [(OPCODE_PING, b"ping"), (OPCODE_TEXT, b"Hello, world")]
+
+def test_fragments_fed_one_per_call():
+    reader = WebSocketFrameReader()
+    assert read_all(client_frame(b"\x01", OPCODE_BINARY, fin=False), reader=reader) == []
+    assert read_all(client_frame(b"\x02", OPCODE_CONTINUATION, fin=False), reader=reader) == []
+    assert read_all(client_frame(b"\x03", OPCODE_CONTINUATION), reader=reader) == [(OPCODE_BINARY, b"\x01\x02\x03")]
+    # The reader is ready for the next message
+    assert read_all(client_frame(b"next"), reader=reader) == [(OPCODE_TEXT, b"next")]
+
+def test_close_frame():
+    payload = struct.pack(">H", 1000) + b"bye"
+    assert read_all(client_frame(payload, OPCODE_CLOSE)) == [(OPCODE_CLOSE, payload)]
+
+@pytest.mark.parametrize("frame", [
+    client_frame(b"x" * 126, OPCODE_PING),                       # Control frame over 125 bytes
+    client_frame(b"ping", OPCODE_PING, fin=False),               # Fragmented control frame
+    client_frame(b"more", OPCODE_CONTINUATION),                  # Nothing to continue
+    client_frame(b"a", OPCODE_TEXT, fin=False) + client_frame(b"b"),  # New message inside a fragmented one
+    client_frame(b"?", 0x3),                                     # Reserved opcode
+])
+def test_protocol_errors(frame):
+    with pytest.raises(WebSocketProtocolError) as error:
+        read_all(frame)
+    assert error.value.close_code == 1002
+
+def test_oversized_frame_is_refused_from_its_header():
+    reader = WebSocketFrameReader(max_message_size=1000)
+    with pytest.raises(WebSocketProtocolError) as error:
+        read_all(client_frame(b"x" * 1001)[:8], reader=reader)
+    assert error.value.close_code == 1009
+
+def test_oversized_fragmented_message():
+    reader = WebSocketFrameReader(max_message_size=1000)
+    data = client_frame(b"x" * 600, OPCODE_TEXT, fin=False) + client_frame(b"x" * 600, OPCODE_CONTINUATION)
+    with pytest.raises(WebSocketProtocolError) as error:
+        read_all(data, reader=reader)
+    assert error.value.close_code == 1009
@@ -0,0 +1,155 @@
+import hashlib
+import os
+import shutil
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import ffmpeg  # ffmpeg-python, used to build ffmpeg command lines
+except ImportError:
+    ffmpeg = None
+
+RENDITION_BITRATES = (64, 128, 192)  # kbps of the lower-bitrate copies we offer
+TRANSCODE_TIMEOUT = 600              # Seconds before a background transcode is abandoned
+
+def ffmpeg_command(source, kbps, output="pipe:1", start_time=None):
+    """Build the ffmpeg arguments to encode source as MP3 at kbps into output"""
+    stream = ffmpeg.input(source, ss=start_time) if start_time else ffmpeg.input(source)
+    stream = ffmpeg.output(stream.audio, output, format="mp3", acodec="libmp3lame",
+                           audio_bitrate=f"{kbps}k")
+    stream = stream.global_args("-hide_banner", "-loglevel", "error", "-nostdin")
+    return ffmpeg.compile(stream, overwrite_output=True)
+
+class RenditionStore:
+    """Lower-bitrate MP3 copies of tracks, kept in a size-bounded directory.
+
+    A rendition is identified by the source path, size and mtime plus its
+    bitrate, so an edited track simply gets new renditions and the old ones
+    age out. Renditions are encoded in the background by a small pool of
+    ffmpeg processes; until one is ready, open_live() encodes on the fly
+    into a pipe. At most live_limit of those run at once (0 = no limit):
+    start_live() says whether another may start, and end_live() gives its
+    place back. The least recently used files are deleted once the
+    directory grows past budget_bytes.
+    """
+    def __init__(self, cache_dir, budget_bytes, workers=2, bitrates=RENDITION_BITRATES, live_limit=0):
+        self.cache_dir = cache_dir
+        self.budget_bytes = budget_bytes
+        self.bitrates = tuple(bitrates)
+        self.available = ffmpeg is not None and shutil.which("ffmpeg") is not None
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="transcode")
+        self._pending = set()  # rendition paths being encoded
+        self._lock = threading.Lock()
+        self.produced = 0
+        self.failed = 0
+        self.evictions = 0
+        self.live_limit = live_limit
+        self.live = 0          # live transcodes running now
+        self.live_refused = 0  # streams sent the original because live_limit were running
+
+    def rendition_path(self, source, size, mtime_ns, kbps):
+        digest = hashlib.sha1(source.encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.cache_dir, f"{digest}-{size:x}-{mtime_ns:x}-{kbps}k.mp3")
+
+    def lookup(self, source, size, mtime_ns, kbps):
+        """Return the path of a finished rendition, or None"""
+        path = self.rendition_path(source, size, mtime_ns, kbps)
+        try:
+            os.utime(path)  # Mark as recently used for eviction
+        except OSError:
+            return None
+        return path
+
+    def request(self, source, size, mtime_ns, kbps):
+        """Queue a background transcode unless the rendition exists or is already being made"""
+        if not self.available:
+            return
+        path = self.rendition_path(source, size, mtime_ns, kbps)
+        with self._lock:
+            if path in self._pending or os.path.exists(path):
+                return
+            self._pending.add(path)
+        self._pool.submit(self._produce, source, path, kbps)
+
+    def _produce(self, source, path, kbps):
+        # Several worker processes may encode the same rendition; the first to finish wins
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            subprocess.run(ffmpeg_command(source, kbps, temp_path), check=True,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=TRANSCODE_TIMEOUT)
+            os.replace(temp_path, path)
+            self.produced += 1
+            print(f"Transcoded {os.path.basename(source)} to {kbps} kbps")
+            self.evict()
+        except (subprocess.SubprocessError, OSError) as e:
+            self.failed += 1
+            print(f"Error transcoding {source} to {kbps} kbps: {e}")
+            try:
+                os.unlink(temp_path)
+            except OSError:
+                pass
+        finally:
+            with self._lock:
+                self._pending.discard(path)
+
+    def start_live(self):
+        """Take a place for a live transcode; False if live_limit are running already"""
+        with self._lock:
+            if self.live_limit and self.live >= self.live_limit:
+                self.live_refused += 1
+                return False
+            self.live += 1
+            return True
+
+    def end_live(self):
+        """Give back the place of a live transcode taken with start_live()"""
+        with self._lock:
+            self.live -= 1
+
+    def live_command(self, source, kbps, start_time=None):
+        """Return the ffmpeg arguments for an on-the-fly transcode to stdout"""
+        return ffmpeg_command(source, kbps, start_time=start_time)
+
+    def open_live(self, source, kbps, start_time=None):
+        """Start an ffmpeg process encoding source to kbps on its stdout"""
+        return subprocess.Popen(self.live_command(source, kbps, start_time),
+                                stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL)
+
+    def evict(self):
+        """Delete the least recently used renditions beyond the byte budget"""
+        try:
+            entries = []
+            with os.scandir(self.cache_dir) as it:
+                for entry in it:
+                    if entry.name.endswith(".mp3"):
+                        st = entry.stat()
+                        entries.append((st.st_mtime, st.st_size, entry.path))
+        except OSError:
+            return
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.budget_bytes:
+                break
+            try:
+                os.unlink(path)
+                total -= size
+                self.evictions += 1
+            except OSError:
+                pass
+
+    def stats(self):
+        """Return transcoding counters"""
+        with self._lock:
+            pending = len(self._pending)
+        return {
+            "available": self.available,
+            "pending": pending,
+            "produced": self.produced,
+            "failed": self.failed,
+            "evictions": self.evictions,
+            "live": self.live,
+            "live_refused": self.live_refused,
+        }
@@ -0,0 +1,162 @@
+import multiprocessing
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+
+STATS_INTERVAL = 2.0        # Seconds between stats reports from each worker
+MIN_UPTIME = 5.0            # Workers dying sooner than this count as a crash loop
+MAX_RESTART_BACKOFF = 30.0  # Longest wait before restarting a crash-looping worker
+
+# Aggregate stats pushed down by the supervisor (only set inside worker processes)
+_cluster_stats = None
+
+def cluster_stats():
+    """Return the latest stats of all workers, or None when not running under a WorkerPool"""
+    return _cluster_stats
+
+class WorkerPool:
+    """Pre-forked worker processes that each accept connections on the same port.
+
+    Every worker calls serve(), which is expected to open its own
+    SO_REUSEPORT listener, so the kernel spreads new connections across
+    processes (and cores). Workers are forked, so they inherit the
+    supervisor's configuration and loaded catalog; init_worker(worker_id)
+    runs first in each, and a restarted worker keeps its id. The supervisor
+    restarts workers that exit, collects the stats each worker reports every
+    STATS_INTERVAL seconds and sends the combined view back to all of them.
+    """
+    def __init__(self, count, serve, collect_stats, init_worker=None):
+        self.count = count
+        self.serve = serve
+        self.collect_stats = collect_stats
+        self.init_worker = init_worker
+        self.context = multiprocessing.get_context("fork")
+        self.stats_queue = self.context.Queue()
+        self.workers = {}       # worker id -> (process, pipe to the worker, start time)
+        self.restarts = {}      # worker id -> number of restarts
+        self.backoff = {}       # worker id -> current restart delay
+        self.worker_stats = {}  # worker id -> latest report
+
+    def _spawn(self, worker_id):
+        parent_conn, child_conn = self.context.Pipe()
+        process = self.context.Process(
+            target=self._run_worker, args=(worker_id, child_conn, parent_conn),
+            name=f"bytebeats-worker-{worker_id}"
+        )
+        process.start()
+        child_conn.close()
+        self.workers[worker_id] = (process, parent_conn, time.monotonic())
+        print(f"Started worker {worker_id} (pid {process.pid})")
+
+    def _run_worker(self, worker_id, conn, parent_conn):
+        # Drop the supervisor's pipe ends inherited through fork, so each pipe
+        # reports EOF as soon as the supervisor itself exits
+        parent_conn.close()
+        for _, other_conn, _ in self.workers.values():
+            other_conn.close()
+        if self.init_worker:
+            self.init_worker(worker_id)
+
+        def report():
+            while True:
+                try:
+                    self.stats_queue.put((worker_id, os.getpid(), self.collect_stats()))
+                except Exception as e:
+                    print(f"Worker {worker_id} could not report stats: {e}")
+                time.sleep(STATS_INTERVAL)
+
+        def receive():
+            global _cluster_stats
+            try:
+                while True:
+                    _cluster_stats = conn.recv()
+            except (EOFError, OSError):
+                # The supervisor is gone; don't keep serving unsupervised
+                print(f"Worker {worker_id} lost its supervisor, exiting")
+                os._exit(1)
+
+        threading.Thread(target=report, daemon=True).start()
+        threading.Thread(target=receive, daemon=True).start()
+        try:
+            self.serve()
+        except KeyboardInterrupt:
+            pass
+
+    def aggregate(self):
+        """Combine the latest report of every live worker"""
+        workers = []
+        totals = {"streams": 0, "bytes_sent": 0, "cache_hits": 0, "cache_misses": 0}
+        for worker_id in sorted(self.worker_stats):
+            pid, stats = self.worker_stats[worker_id]
+            streams = stats.get("streams", [])
+            cache = stats.get("chunk_cache", {})
+            bytes_sent = sum(stream["bytes_sent"] for stream in streams)
+            workers.append({
+                "id": worker_id,
+                "pid": pid,
+                "restarts": self.restarts.get(worker_id, 0),
+                "streams": len(streams),
+                "bytes_sent": bytes_sent,
+                "chunk_cache": cache,
+            })
+            totals["streams"] += len(streams)
+            totals["bytes_sent"] += bytes_sent
+            totals["cache_hits"] += cache.get("hits", 0)
+            totals["cache_misses"] += cache.get("misses", 0)
+        return {"workers": workers, "totals": totals}
+
+    def _check_workers(self):
+        """Restart workers that exited, backing off if they keep crashing"""
+        now = time.monotonic()
+        for worker_id, (process, conn, started) in list(self.workers.items()):
+            if process.is_alive():
+                continue
+            process.join()
+            conn.close()
+            del self.workers[worker_id]
+            self.worker_stats.pop(worker_id, None)
+            print(f"Worker {worker_id} (pid {process.pid}) exited with code {process.exitcode}, restarting")
+            if now - started < MIN_UPTIME:
+                delay = min(MAX_RESTART_BACKOFF, max(1.0, self.backoff.get(worker_id, 0) * 2))
+                self.backoff[worker_id] = delay
+                print(f"Worker {worker_id} is crashing repeatedly, waiting {delay:.0f}s")
+                time.sleep(delay)
+            else:
+                self.backoff[worker_id] = 0
+            self.restarts[worker_id] = self.restarts.get(worker_id, 0) + 1
+            self._spawn(worker_id)
+
+    def run(self):
+        """Start the workers and supervise them until interrupted"""
+        # Make `kill` shut the workers down too, instead of orphaning them
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        for worker_id in range(self.count):
+            self._spawn(worker_id)
+        try:
+            while True:
+                try:
+                    worker_id, pid, stats = self.stats_queue.get(timeout=STATS_INTERVAL)
+                    if worker_id in self.workers:
+                        self.worker_stats[worker_id] = (pid, stats)
+                    # Drain whatever else arrived before broadcasting once
+                    while True:
+                        worker_id, pid, stats = self.stats_queue.get_nowait()
+                        if worker_id in self.workers:
+                            self.worker_stats[worker_id] = (pid, stats)
+                except queue.Empty:
+                    pass
+                self._check_workers()
+                combined = self.aggregate()
+                for process, conn, _ in self.workers.values():
+                    try:
+                        conn.send(combined)
+                    except (BrokenPipeError, OSError):
+                        pass  # Restarted on the next check
+        finally:
+            for process, conn, _ in self.workers.values():
+                process.terminate()
+            for process, conn, _ in self.workers.values():
+                process.join(5)
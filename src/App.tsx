@@ -1,5 +1,15 @@
 import React, { useState, useEffect, useRef } from 'react';
-import { Play, Pause, SkipForward, Volume2, Music2, Loader2, Settings, RefreshCw, Shield } from 'lucide-react';
+import { Play, Pause, SkipForward, Volume2, Music2, Loader2, Settings, RefreshCw, Shield, Search } from 'lucide-react';
+
+const WAVEFORM_BARS = 120; // Peaks requested for the progress bar waveform
+
+// Why the server may turn a connection away with BUSY (or a 503 over HTTP)
+const BUSY_REASONS: Record<string, string> = {
+  connections: 'too many listeners are connected',
+  streams: 'too many songs are streaming',
+  user_streams: 'your account is already streaming as many songs as it may',
+  bandwidth: 'there is no bandwidth left for another song',
+};
 
 interface Song {
   name: string;
@@ -19,22 +29,36 @@ function App() {
   const [audioBuffer, setAudioBuffer] = useState<ArrayBuffer | null>(null);
   const [audioContext, setAudioContext] = useState<AudioContext | null>(null);
   const [audioPlayer, setAudioPlayer] = useState<HTMLAudioElement | null>(null);
-  const [receivedChunks, setReceivedChunks] = useState<Uint8Array[]>([]);
-  const [receivingAudio, setReceivingAudio] = useState(false);
   const [isMuted, setIsMuted] = useState(false);
   const [showSettings, setShowSettings] = useState(false);
   const [connectionError, setConnectionError] = useState<string | null>(null);
   const [isReconnecting, setIsReconnecting] = useState(false);
   const [useSSL, setUseSSL] = useState(true); // Default to using SSL
   const [pendingCredentials, setPendingCredentials] = useState<{username: string, password: string} | null>(null);
+  // Shown while we wait out the retry_after (or Retry-After) of a server that was too busy
+  const [busyMessage, setBusyMessage] = useState<string | null>(null);
+  const busyTimerRef = useRef<number | null>(null);
+
+  // The server sends the library a page at a time; nextCursor asks for the page after the last one
+  const [nextCursor, setNextCursor] = useState<string | null>(null);
+  const [totalSongs, setTotalSongs] = useState(0);
+  const [searchQuery, setSearchQuery] = useState('');
+  const [searchResults, setSearchResults] = useState<Song[] | null>(null);
+  const searchQueryRef = useRef('');
   
-  // Add this ref to store chunks
-  const chunksRef = useRef<Uint8Array[]>([]);
+  // Songs play over HTTP (GET /tracks/<name>), so the browser streams, seeks and caches them
+  // itself; the session token from AUTH_SUCCESS authorises those requests
+  const tokenRef = useRef<string | null>(null);
+  const preloadRef = useRef<HTMLAudioElement | null>(null);
 
   // Add these states
   const [currentTime, setCurrentTime] = useState(0);
   const [duration, setDuration] = useState(0);
 
+  // Server-side analysis of the current song (see server/analyze.py)
+  const [waveform, setWaveform] = useState<number[]>([]);
+  const [replayGain, setReplayGain] = useState<number | null>(null);
+
   // Add this function to format time (MM:SS)
   const formatTime = (seconds: number) => {
     const mins = Math.floor(seconds / 60);
@@ -54,7 +78,24 @@ function App() {
     }
   }, [isAuthenticated, initialAuthDone, isConnected]);
 
-  const connectToServer = () => {
+  // Tell the user the server is busy and try again once it said there may be room
+  const retryWhenNotBusy = (message: string, retryAfter: number, retry: () => void) => {
+    if (busyTimerRef.current !== null) clearTimeout(busyTimerRef.current);
+    setBusyMessage(`Server busy: ${message}. Retrying in ${Math.ceil(retryAfter)}s...`);
+    busyTimerRef.current = window.setTimeout(() => {
+      busyTimerRef.current = null;
+      setBusyMessage(null);
+      retry();
+    }, retryAfter * 1000);
+  };
+
+  const cancelBusyRetry = () => {
+    if (busyTimerRef.current !== null) clearTimeout(busyTimerRef.current);
+    busyTimerRef.current = null;
+    setBusyMessage(null);
+  };
+
+  const connectToServer = (login = pendingCredentials) => {
     try {
       setConnectionError(null);
       setIsReconnecting(true);
@@ -74,119 +115,48 @@ function App() {
         console.log(`Connected to server at ${protocol}${serverAddress}:${port}`);
         
         // If we have pending credentials, send them now that the connection is open
-        if (pendingCredentials) {
+        if (login) {
           console.log('Sending credentials now that connection is established');
-          ws.send(`${pendingCredentials.username}:${pendingCredentials.password}`);
+          ws.send(`${login.username}:${login.password}`);
           setPendingCredentials(null);
         }
       };
 
       ws.onmessage = (event) => {
-        // If it's binary data (song chunks)
-        if (event.data instanceof Blob) {
-          console.log(`Received chunk of size: ${event.data.size} bytes`);
-          event.data.arrayBuffer().then((buffer: ArrayBuffer) => {
-            const chunk = new Uint8Array(buffer);
-            // Use ref for immediately available data
-            chunksRef.current = [...chunksRef.current, chunk];
-            // Also update state for component updates
-            setReceivedChunks(prev => [...prev, chunk]);
-          });
-          return;
-        }
-        
         // Try to parse as JSON
         try {
           const data = JSON.parse(event.data);
           console.log('Received message:', data);
           if (data.type === 'AUTH_REQUIRED') {
             setIsAuthenticated(false);
+          } else if (data.type === 'BUSY') {
+            // Sent instead of AUTH_REQUIRED when the server has no room; it closes the connection next
+            retryWhenNotBusy(BUSY_REASONS[data.reason] ?? data.reason, data.retry_after,
+                             () => connectToServer(credentials));
           } else if (data.type === 'AUTH_SUCCESS') {
+            tokenRef.current = data.token;
             setIsAuthenticated(true);
             setSongs(data.songs.map((name: string) => ({ name, duration: '00:00' })));
+            setNextCursor(data.next_cursor);
+            setTotalSongs(data.total);
           } else if (data.type === 'SONG_LIST') {
-            setSongs(data.songs.map((name: string) => ({ name, duration: '00:00' })));
-          } else if (data.type === 'SONG_PLAYING') {
-            // Clear previous audio data
-            chunksRef.current = [];
-            setReceivedChunks([]);
-            setReceivingAudio(true);
-            setIsLoading(true);
-            console.log(`Started receiving song: ${data.name}`);
-          } else if (data.type === 'SONG_METADATA') {
-            console.log(`Song metadata: ${data.name}, size: ${data.size} bytes`);
-          } else if (data.type === 'SONG_ENDED') {
-            setReceivingAudio(false);
-            setIsLoading(false);
-            console.log(`Finished receiving song. Total chunks: ${chunksRef.current.length}`);
-            
-            // Use the ref directly to access all chunks immediately
-            if (chunksRef.current.length > 0) {
-              const totalLength = chunksRef.current.reduce((acc, chunk) => acc + chunk.length, 0);
-              console.log(`Creating audio from ${totalLength} bytes`);
-              
-              const audioData = new Uint8Array(totalLength);
-              let offset = 0;
-              for (const chunk of chunksRef.current) {
-                audioData.set(chunk, offset);
-                offset += chunk.length;
-              }
-              
-              const blob = new Blob([audioData], { type: 'audio/mp3' });
-              const url = URL.createObjectURL(blob);
-              
-              if (audioPlayer) {
-                try {
-                  // Log audio player state
-                  console.log('Audio player before loading:', audioPlayer.readyState);
-                  
-                  // Clean up previous URL
-                  if (audioPlayer.src) URL.revokeObjectURL(audioPlayer.src);
-                  
-                  console.log('Setting audio source to:', url);
-                  audioPlayer.src = url;
-                  
-                  // Set oncanplaythrough before trying to play
-                  audioPlayer.oncanplaythrough = () => {
-                    console.log('Audio can play through, attempting playback');
-                    
-                    // Attempt to play with explicit user interaction handling
-                    const playPromise = audioPlayer.play();
-                    
-                    if (playPromise !== undefined) {
-                      playPromise
-                        .then(() => {
-                          console.log('Audio playing successfully');
-                          setIsPlaying(true);
-                        })
-                        .catch(err => {
-                          console.error('Error playing audio:', err);
-                          // Try a different approach if autoplay fails
-                          if (err.name === 'NotAllowedError') {
-                            console.log('Autoplay not allowed, require user interaction');
-                            // Update UI to show play button
-                            setIsPlaying(false);
-                          }
-                        });
-                    }
-                  };
-                  
-                  // Add loading and error handlers
-                  audioPlayer.onloadeddata = () => console.log('Audio data loaded');
-                  audioPlayer.onerror = (e) => console.error('Audio player error:', e);
-                } catch (err) {
-                  console.error('Error setting up audio player:', err);
-                }
-              } else {
-                console.error('No audio player available');
-              }
-            } else {
-              console.error('No chunks received for the song');
+            const page = data.songs.map((name: string) => ({ name, duration: '00:00' }));
+            // A page requested with a cursor continues the list we already have
+            setSongs(prev => (data.cursor ? [...prev, ...page] : page));
+            setNextCursor(data.next_cursor);
+            setTotalSongs(data.total);
+          } else if (data.type === 'SEARCH_RESULTS') {
+            // Ignore results for a query the user has typed past
+            if (data.query === searchQueryRef.current) {
+              setSearchResults(data.songs.map((name: string) => ({ name, duration: '00:00' })));
             }
-          } else if (data.type === 'STREAM_ERROR') {
-            console.error('Stream error:', data.error);
-            setReceivingAudio(false);
-            setIsLoading(false);
+          } else if (data.type === 'ANALYSIS') {
+            setWaveform(data.waveform);
+            setReplayGain(data.replaygain);
+            if (data.duration) setDuration(data.duration);
+          } else if (data.type === 'ANALYSIS_NOT_AVAILABLE') {
+            setWaveform([]);
+            setReplayGain(null);
           }
         } catch (e) {
           console.error('Error parsing message:', e);
@@ -248,7 +218,10 @@ function App() {
         console.log('Audio ended - playing next song');
         playNextSong();
       });
-      player.addEventListener('error', (e) => console.error('Audio error:', e));
+      player.addEventListener('error', (e) => {
+        console.error('Audio error:', e);
+        setIsLoading(false);
+      });
       
       player.addEventListener('loadedmetadata', () => {
         console.log('Audio metadata loaded, duration:', player.duration);
@@ -267,7 +240,6 @@ function App() {
         if (audioContext) context.close();
         if (player) {
           player.pause();
-          if (player.src) URL.revokeObjectURL(player.src);
           player.src = '';
         }
       };
@@ -276,6 +248,59 @@ function App() {
     }
   }, []);
 
+  // Search on the server once the user stops typing
+  useEffect(() => {
+    searchQueryRef.current = searchQuery;
+    if (!searchQuery.trim()) {
+      setSearchResults(null);
+      return;
+    }
+    const timer = setTimeout(() => {
+      if (socket && socket.readyState === WebSocket.OPEN) {
+        socket.send(JSON.stringify({ type: 'SEARCH', query: searchQuery }));
+      }
+    }, 250);
+    return () => clearTimeout(timer);
+  }, [searchQuery, socket]);
+
+  const loadMoreSongs = () => {
+    if (!socket || !nextCursor) return;
+    socket.send(JSON.stringify({ type: 'GET_SONGS', cursor: nextCursor }));
+  };
+
+  // Normalise loudness with ReplayGain; an audio element can only attenuate
+  useEffect(() => {
+    if (!audioPlayer) return;
+    audioPlayer.volume = replayGain === null ? 1 : Math.min(1, Math.pow(10, replayGain / 20));
+  }, [audioPlayer, replayGain]);
+
+  // The URL the audio element plays a song from; ranges let it start at once and seek
+  const trackUrl = (name: string) => {
+    const protocol = useSSL ? 'https://' : 'http://';
+    const port = useSSL ? '8443' : '8080';
+    return `${protocol}${serverAddress}:${port}/tracks/${encodeURIComponent(name)}?token=${encodeURIComponent(tokenRef.current ?? '')}`;
+  };
+
+  // Start loading the next song while this one plays, so skipping to it starts from the browser's cache
+  useEffect(() => {
+    if (!currentSong || !tokenRef.current) return;
+    const index = songs.findIndex(song => song.name === currentSong.name);
+    const next = index === -1 ? undefined : songs[(index + 1) % songs.length];
+    if (!next || next.name === currentSong.name) return;
+    if (!preloadRef.current) {
+      preloadRef.current = new Audio();
+      preloadRef.current.preload = 'auto';
+    }
+    preloadRef.current.src = trackUrl(next.name);
+  }, [currentSong, songs]);
+
+  // Jump to the clicked point of the progress bar
+  const seekTo = (e: React.MouseEvent<HTMLDivElement>) => {
+    if (!audioPlayer || !duration) return;
+    const rect = e.currentTarget.getBoundingClientRect();
+    audioPlayer.currentTime = ((e.clientX - rect.left) / rect.width) * duration;
+  };
+
   // Add helper function to open the HTTPS site to accept the certificate
   const openSecureWebsite = () => {
     const httpsUrl = `https://${serverAddress}:8443/`;
@@ -298,17 +323,43 @@ function App() {
   };
 
   const handlePlaySong = (song: Song) => {
-    if (!isAuthenticated || !socket) return;
+    if (!isAuthenticated || !socket || !audioPlayer) return;
   
+    cancelBusyRetry();
     setIsLoading(true);
     setCurrentTime(0);
     setDuration(0);
+    setWaveform([]);
+    setReplayGain(null);
     setCurrentSong(song);
     
-    socket.send(JSON.stringify({
-      type: 'PLAY_SONG',
-      name: song.name
-    }));
+    // The waveform and loudness come precomputed, no need to decode the file here
+    socket.send(JSON.stringify({ type: 'GET_ANALYSIS', name: song.name, points: WAVEFORM_BARS }));
+    
+    audioPlayer.src = trackUrl(song.name);
+    audioPlayer.play()
+      .then(() => {
+        console.log('Audio playing successfully');
+        setIsPlaying(true);
+      })
+      .catch(err => {
+        console.error('Error playing audio:', err);
+        // Autoplay can be refused; the play button starts it instead
+        setIsPlaying(false);
+        setIsLoading(false);
+        if (err.name === 'NotSupportedError') checkBusy(song);
+      });
+  };
+
+  // The audio element only says the song failed to load; ask the server whether it was too busy (a 503)
+  const checkBusy = (song: Song) => {
+    fetch(trackUrl(song.name), { method: 'HEAD' })
+      .then(response => {
+        if (response.status !== 503) return;
+        const retryAfter = Number(response.headers.get('Retry-After')) || 1;
+        retryWhenNotBusy('no room for another listener', retryAfter, () => handlePlaySong(song));
+      })
+      .catch(err => console.error('Error checking server:', err));
   };
 
   const togglePlayPause = () => {
@@ -323,9 +374,6 @@ function App() {
         playPromise
           .then(() => {
             setIsPlaying(true);
-            if (socket) {
-              socket.send(JSON.stringify({ type: 'RESUME' }));
-            }
           })
           .catch(err => {
             console.error('Error playing audio:', err);
@@ -335,9 +383,6 @@ function App() {
       // Pause
       audioPlayer.pause();
       setIsPlaying(false);
-      if (socket) {
-        socket.send(JSON.stringify({ type: 'PAUSE' }));
-      }
     }
   };
 
@@ -460,6 +505,12 @@ function App() {
               </div>
             )}
             
+            {busyMessage && (
+              <div className="bg-yellow-500/20 text-yellow-100 p-3 rounded-lg text-sm">
+                {busyMessage}
+              </div>
+            )}
+            
             <button
               type="submit"
               disabled={isReconnecting}
@@ -562,6 +613,12 @@ function App() {
               <h2 className="text-xl font-semibold text-white">Now Playing</h2>
             </div>
             
+            {busyMessage && (
+              <div className="bg-yellow-500/20 text-yellow-100 p-3 rounded-lg text-sm mb-6">
+                {busyMessage}
+              </div>
+            )}
+            
             <div className="flex items-center space-x-6">
               <div className="w-24 h-24 bg-gradient-to-br from-purple-500 to-pink-500 rounded-lg flex items-center justify-center">
                 {isLoading ? (
@@ -615,20 +672,51 @@ function App() {
                 <span>{formatTime(currentTime)}</span>
                 <span>{formatTime(duration)}</span>
               </div>
-              <div className="w-full bg-white/10 rounded-full h-1">
-                <div 
-                  className="bg-purple-500 h-1 rounded-full" 
-                  style={{ width: `${duration ? (currentTime / duration) * 100 : 0}%` }}
-                ></div>
-              </div>
+              {waveform.length > 0 ? (
+                <div className="w-full h-12 flex items-center space-x-px cursor-pointer" onClick={seekTo}>
+                  {waveform.map((peak, i) => (
+                    <div
+                      key={i}
+                      className={`flex-1 rounded-sm ${
+                        duration && (i + 0.5) / waveform.length <= currentTime / duration ? 'bg-purple-500' : 'bg-white/20'
+                      }`}
+                      style={{ height: `${Math.max(4, (peak / 255) * 100)}%` }}
+                    ></div>
+                  ))}
+                </div>
+              ) : (
+                <div className="w-full bg-white/10 rounded-full h-1 cursor-pointer" onClick={seekTo}>
+                  <div 
+                    className="bg-purple-500 h-1 rounded-full" 
+                    style={{ width: `${duration ? (currentTime / duration) * 100 : 0}%` }}
+                  ></div>
+                </div>
+              )}
             </div>
           </div>
 
           {/* Song List */}
           <div>
-            <h2 className="text-xl font-semibold text-white mb-6">Available Songs</h2>
+            <div className="flex items-center justify-between mb-6">
+              <h2 className="text-xl font-semibold text-white">
+                Available Songs{totalSongs > 0 && <span className="text-purple-300 text-base ml-2">({totalSongs})</span>}
+              </h2>
+              <div className="relative">
+                <Search className="w-4 h-4 text-purple-300 absolute left-3 top-1/2 -translate-y-1/2" />
+                <input
+                  type="text"
+                  value={searchQuery}
+                  onChange={(e) => setSearchQuery(e.target.value)}
+                  placeholder="Search songs, artists..."
+                  className="pl-9 pr-4 py-2 rounded-lg bg-white/5 border border-white/10 text-white focus:outline-none focus:border-purple-500"
+                />
+              </div>
+            </div>
             <div className="space-y-4">
-              {songs.map((song) => (
+              {searchResults !== null && searchResults.length === 0 && (
+                <p className="text-purple-300">No songs match "{searchQuery}"</p>
+              )}
+              {(searchResults ?? songs).map((song) => (
                 <button
                   key={song.name}
                   className="w-full bg-white/5 hover:bg-white/10 transition p-4 rounded-lg flex items-center justify-between group"
@@ -646,6 +734,14 @@ function App() {
                   <Play className="w-5 h-5 text-purple-300 opacity-0 group-hover:opacity-100 transition" />
                 </button>
               ))}
+              {searchResults === null && nextCursor && (
+                <button
+                  onClick={loadMoreSongs}
+                  className="w-full py-3 rounded-lg bg-white/5 hover:bg-white/10 text-purple-200 transition"
+                >
+                  Load more ({songs.length} of {totalSongs})
+                </button>
+              )}
             </div>
           </div>
         </div>